@@ -0,0 +1,300 @@
+import bz2
+import collections
+import lzma
+import multiprocessing
+import multiprocessing.pool
+import os
+import shutil
+import tarfile
+import zlib
+
+# zstd compression is optional, and only available if the zstandard package is installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Available codecs, and the extension of a tar archive compressed with each
+CODECS = collections.OrderedDict([('gz', '.tar.gz'), ('bz2', '.tar.bz2'), ('xz', '.tar.xz'), ('zst', '.tar.zst')])
+
+
+class Archiver(object):
+    """ Archive files into compressed tar files in-process, replacing `tar -zcf ... --remove-files` with GZIP=-9.
+
+    The codec and compression level are selectable, gzip and zstd compression use several threads, and archiving can
+    optionally happen in a background thread, so that a caller can get on with encoding the next movie while the
+    previous directory is archived.  Archives written with codec 'gz' are ordinary .tar.gz files.
+    """
+
+    def __init__(self, codec='gz', level=9, num_threads=None, background=False):
+        """
+        :param codec: one of CODECS (default 'gz')
+        :param level: compression level: 1-9 for gz, bz2 and xz, 1-22 for zst (default 9)
+        :param num_threads: number of compression threads for gz and zst (default None, meaning one per core)
+        :param background: whether submit() runs tasks in a background thread rather than immediately (default False)
+
+        :raise Exception: if codec is not one of CODECS, or is 'zst' and zstandard is not installed
+        :raise Exception: if num_threads is < 1
+        """
+        if codec not in CODECS:
+            raise Exception('archiver: Invalid codec: ' + str(codec))
+
+        if codec == 'zst' and zstandard is None:
+            raise Exception('archiver: zst codec requires the zstandard package: try pip install zstandard')
+
+        if num_threads is None:
+            num_threads = multiprocessing.cpu_count()
+
+        if num_threads < 1:
+            raise Exception('archiver: Invalid num_threads: ' + str(num_threads))
+
+        self.codec = codec
+        self.level = level
+        self.num_threads = num_threads
+
+        # A single background thread, so that archiving tasks for one directory happen in the order submitted
+        self.pool = multiprocessing.pool.ThreadPool(processes=1) if background else None
+        self.pending = []
+
+    def archive_name(self, archive_base):
+        """ The file name of an archive, e.g. svg_arch.tar.gz for archive_base svg_arch and codec gz """
+        return archive_base + CODECS[self.codec]
+
+    def archive_files(self, directory, file_names, archive_base, remove_files=True):
+        """ Stream files into a compressed tar archive, replacing any existing archive of the same name
+
+        :param directory: the directory containing the files, in which the archive is written
+        :param file_names: names of the files to archive, relative to directory
+        :param archive_base: name of the archive without extension, e.g. 'svg_arch'
+        :param remove_files: whether to remove the files once the archive is complete (default True)
+        :return: the file name of the archive
+
+        :raise Exception: if any file cannot be read, or the archive cannot be written, in which case no archive is left
+        """
+        archive_name = self.archive_name(archive_base)
+        archive_path = os.path.join(directory, archive_name)
+        temp_path = archive_path + '.part'
+
+        compressed_file = None
+        try:
+            with open(temp_path, 'wb') as raw_file:
+                compressed_file = self.open_compressor(raw_file)
+                with tarfile.open(fileobj=compressed_file, mode='w|') as tar:
+                    for file_name in file_names:
+                        tar.add(os.path.join(directory, file_name), arcname=file_name)
+                compressed_file.close()
+        except Exception:
+            # Don't leave compression threads running, or a partial archive behind.  Closing the compressor may itself
+            # fail, e.g. when the disk is full, so that is not allowed to hide the original exception
+            if compressed_file is not None:
+                try:
+                    compressed_file.close()
+                except Exception:
+                    pass
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+            raise
+
+        # Only replace the old archive, and remove the files, once the new archive is complete
+        os.rename(temp_path, archive_path)
+
+        if remove_files:
+            for file_name in file_names:
+                file_path = os.path.join(directory, file_name)
+                if os.path.isdir(file_path) and not os.path.islink(file_path):
+                    shutil.rmtree(file_path)
+                else:
+                    os.remove(file_path)
+
+        return archive_name
+
+    def open_compressor(self, raw_file):
+        """ Wrap a binary file in a write-only file object that compresses with this archiver's codec """
+        if self.codec == 'gz':
+            return ParallelGzipWriter(raw_file, level=self.level, num_threads=self.num_threads)
+        elif self.codec == 'bz2':
+            return bz2.BZ2File(raw_file, mode='wb', compresslevel=self.level)
+        elif self.codec == 'xz':
+            return lzma.LZMAFile(raw_file, mode='wb', preset=self.level)
+        else:
+            compressor = zstandard.ZstdCompressor(level=self.level, threads=self.num_threads)
+            return compressor.stream_writer(raw_file, closefd=False)
+
+    def submit(self, function, *args, **kwargs):
+        """ Run function(*args, **kwargs) now or, if this archiver is in background mode, in the background thread
+
+        :return: the result of the function, or None if run in the background
+        """
+        if self.pool is None:
+            return function(*args, **kwargs)
+
+        self.pending.append(self.pool.apply_async(function, args, kwargs))
+
+    def wait(self):
+        """ Wait for all tasks submitted in background mode to finish
+
+        :raise Exception: the first exception raised by any background task
+        """
+        pending, self.pending = self.pending, []
+        for result in pending:
+            result.get()
+
+    def close(self):
+        """ Wait for all background tasks to finish, and stop the background thread """
+        try:
+            self.wait()
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+
+
+class ParallelGzipWriter(object):
+    """ A write-only file object producing gzip output, compressing blocks concurrently in the manner of pigz.
+
+    Each block is compressed independently as a complete gzip member.  A concatenation of gzip members is itself a valid
+    gzip file, readable by gzip, tar and Python's tarfile.  zlib releases the GIL while compressing, so the blocks are
+    compressed in parallel.
+    """
+
+    def __init__(self, fileobj, level=9, num_threads=None, block_size=1024 * 1024):
+        """
+        :param fileobj: the binary file to write the gzip output to, which is not closed by close()
+        :param level: gzip compression level, 1-9 (default 9)
+        :param num_threads: number of compression threads (default None, meaning one per core)
+        :param block_size: number of uncompressed bytes per gzip member (default 1MiB)
+        """
+        if num_threads is None:
+            num_threads = multiprocessing.cpu_count()
+
+        self.fileobj = fileobj
+        self.level = level
+        self.num_threads = num_threads
+        self.block_size = block_size
+        self.buffer = []
+        self.buffered = 0
+        self.pending = collections.deque()
+        self.pool = multiprocessing.pool.ThreadPool(processes=num_threads)
+        self.closed = False
+
+    def write(self, data):
+        """ Buffer data, compressing each complete block in the background """
+        self.buffer.append(bytes(data))
+        self.buffered += len(data)
+
+        if self.buffered >= self.block_size:
+            joined = b''.join(self.buffer)
+            num_blocks = len(joined) // self.block_size
+            for i in range(num_blocks):
+                self.submit_block(joined[i * self.block_size:(i + 1) * self.block_size])
+            remainder = joined[num_blocks * self.block_size:]
+            self.buffer = [remainder]
+            self.buffered = len(remainder)
+
+        return len(data)
+
+    def submit_block(self, block):
+        """ Compress a block in the background, writing out finished blocks in order to bound memory use """
+        self.pending.append(self.pool.apply_async(compress_gzip_member, (block, self.level)))
+        while len(self.pending) > 2 * self.num_threads:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def flush(self):
+        """ Nothing to do: output is written as blocks complete, and on close() """
+        pass
+
+    def close(self):
+        """ Compress any remaining data and write out all blocks """
+        if self.closed:
+            return
+        self.closed = True
+
+        try:
+            if self.buffered > 0 or len(self.pending) == 0:
+                self.submit_block(b''.join(self.buffer))
+            while len(self.pending) > 0:
+                self.fileobj.write(self.pending.popleft().get())
+            self.fileobj.flush()
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+
+def compress_gzip_member(block, level):
+    """ Compress a block of bytes as a single complete gzip member
+
+    :param block: the bytes to compress
+    :param level: gzip compression level, 1-9
+    :return: the gzip member as bytes
+    """
+    # wbits of 16 + MAX_WBITS gives a gzip header and trailer
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush()
+
+
+def find_archive(directory, archive_base):
+    """ Find an archive written with any codec, e.g. svg_arch.tar.gz or svg_arch.tar.zst for archive_base svg_arch
+
+    :param directory: the directory to search in
+    :param archive_base: name of the archive without extension
+    :return: the file name of the archive, or None if there is none
+    """
+    for extension in CODECS.values():
+        if os.path.isfile(os.path.join(directory, archive_base + extension)):
+            return archive_base + extension
+    return None
+
+
+def is_archive(file_name):
+    """ Whether a file name is that of an archive written by an Archiver with any codec """
+    return any(file_name.endswith(extension) for extension in CODECS.values())
+
+
+def extract_archive(directory, archive_name):
+    """ Extract a tar archive written with any codec, overwriting existing files
+
+    :param directory: the directory containing the archive, into which it is extracted
+    :param archive_name: the file name of the archive
+    :return: a sorted list of the names of the extracted files
+
+    :raise Exception: if the archive is zst and zstandard is not installed
+    """
+    archive_path = os.path.join(directory, archive_name)
+
+    if archive_name.endswith(CODECS['zst']):
+        if zstandard is None:
+            raise Exception('archiver: extracting ' + archive_name + ' requires the zstandard package')
+        with open(archive_path, 'rb') as raw_file:
+            with zstandard.ZstdDecompressor().stream_reader(raw_file) as reader:
+                with tarfile.open(fileobj=reader, mode='r|') as tar:
+                    return extract_members(tar, directory)
+
+    # tarfile detects gz, bz2 and xz compression itself
+    with tarfile.open(archive_path, mode='r:*') as tar:
+        return extract_members(tar, directory)
+
+
+def extract_members(tar, directory):
+    """ Extract the regular files of an open tar archive into a directory, refusing paths outside it
+
+    :param tar: an open tarfile.TarFile
+    :param directory: the directory to extract into
+    :return: a sorted list of the names of the extracted files
+    """
+    real_directory = os.path.realpath(directory)
+    extracted = []
+    for member in tar:
+        target = os.path.realpath(os.path.join(directory, member.name))
+        if not target.startswith(real_directory + os.sep):
+            raise Exception('archiver: Refusing to extract ' + member.name + ' outside ' + directory)
+        if member.isfile():
+            if os.path.isfile(target):
+                os.remove(target)
+            tar.extract(member, directory)
+            extracted.append(member.name)
+    return sorted(extracted)
+
+
+if __name__ == '__main__':
+    quit('Create an archiver.Archiver() and pass it to svg_to_webm.svg_to_webm() or png_to_mp4.png_to_mp4()')
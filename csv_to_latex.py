@@ -1,30 +1,50 @@
 import csv
+import hashlib
+import json
+import multiprocessing
+import multiprocessing.pool
 import os
 import random
+import re
+import shutil
 import sys
 import subprocess
+import tempfile
 
+import latex_compile
 
-def print_usage():
-    """ Prints usage for this script """
-    print('Generate pdf via latex of responses to a google form in CSV format.')
-    print('Called with a valid csv file:')
-    print('\t' + sys.argv[0] + ' <file_name.csv>')
+# Seed for shuffling the order of responses, fixed so that every run numbers the responses the same way
+SHUFFLE_SEED = 0
+
+# Bytes buffered by each output document between writes to disk
+WRITE_BUFFER_BYTES = 1024 * 1024
+
+# Number of responses in each shard of a sharded build
+DEFAULT_SHARD_SIZE = 200
+
+# Name, without extension, of each document, and whether it leaves out respondents' names
+DOCUMENTS = [('anonymous_responses', True), ('plain_responses', False)]
+
+# Directory, in the output directory, caching the compiled fragment of each response between incremental builds.  It
+# starts with '.' so that it is left in place by the clean up of a full build
+FRAGMENT_CACHE_DIR = '.csv_to_latex_cache'
 
-# Expecting one additional arguments:
-if len(sys.argv) != 2:
-    quit(print_usage())
+# Name of the file, in FRAGMENT_CACHE_DIR, recording where in each fragment its response number goes
+FRAGMENT_INDEX_FILE = 'index.json'
 
-# Check file is valid
-csv_filename = sys.argv[1]
-if not os.path.isfile(csv_filename):
-    print('Expecting a valid csv file as command line argument.')
-    quit(print_usage())
+# Incremented whenever the entries recorded in FRAGMENT_INDEX_FILE change, so that older caches are ignored
+FRAGMENT_INDEX_VERSION = 1
 
-anonymous_tex = open('anonymous_responses.tex', 'w')
-plain_tex = open('plain_responses.tex', 'w')
+# Column holding the respondent's name, which appears only in the plain document
+NAME_COLUMN = 1
 
-tex_head = """\documentclass[11pt, a4paper]{article}
+# Column holding the amount requested, written in pounds
+AMOUNT_COLUMN = 4
+
+# Columns holding free text answers
+TEXT_COLUMNS = [5, 6, 7]
+
+TEX_HEAD = r"""\documentclass[11pt, a4paper]{article}
 
 % This package defines the page margins
 \usepackage[top=3.0cm, bottom=3.0cm, left=3.0cm, right=3.0cm]{geometry}
@@ -35,11 +55,39 @@ tex_head = """\documentclass[11pt, a4paper]{article}
 % Remove page numbering
 \pagenumbering{gobble}
 
-\\begin{document}
+\begin{document}
+"""
+
+TEX_TAIL = r"""\end{document}"""
+
+# Defines \numberslot, which marks the place in a fragment for its response number, which is not known until the
+# fragments are assembled, and records in the log where, in sp from the bottom left of the page, the number is to end.
+# The slot takes no space, the number hanging into the left margin, so that the fragment does not depend on how many
+# digits the largest response number has
+NUMBER_SLOT = r"""\newcommand{\numberslot}{\pdfsavepos%
+  \write-1{number position: \the\pdflastxpos,\the\pdflastypos}}
 """
 
-anonymous_tex.write(tex_head)
-plain_tex.write(tex_head)
+NUMBER_POSITION_PATTERN = re.compile(r'number position: (\d+),(\d+)')
+
+# Document joining the pdfs of a sharded build, page for page, in order
+MERGE_HEAD = r"""\documentclass[11pt, a4paper]{article}
+
+\usepackage{pdfpages}
+
+\begin{document}
+"""
+
+
+def print_usage():
+    """ Prints usage for this script """
+    print('Generate pdf via latex of responses to a google form in CSV format.')
+    print('Called with a valid csv file:')
+    print('\t' + sys.argv[0] + ' <file_name.csv>')
+    print('or, to compile shards of that many responses concurrently, with a number of responses per shard:')
+    print('\t' + sys.argv[0] + ' <file_name.csv> <shard_size>')
+    print('or, to recompile only responses that are new or have changed since the last such build:')
+    print('\t' + sys.argv[0] + ' <file_name.csv> incremental')
 
 
 def prepare_string(input_string):
@@ -51,13 +99,13 @@ def prepare_string(input_string):
     input_string = input_string.replace('^', '\\textasciicircum')
 
     # Special case all the symbols that need a backslash
-    input_string = input_string.replace('&', '\&')
-    input_string = input_string.replace('%', '\%')
-    input_string = input_string.replace('$', '\$')
-    input_string = input_string.replace('#', '\#')
-    input_string = input_string.replace('_', '\_')
-    input_string = input_string.replace('{', '\{')
-    input_string = input_string.replace('}', '\}')
+    input_string = input_string.replace('&', '\\&')
+    input_string = input_string.replace('%', '\\%')
+    input_string = input_string.replace('$', '\\$')
+    input_string = input_string.replace('#', '\\#')
+    input_string = input_string.replace('_', '\\_')
+    input_string = input_string.replace('{', '\\{')
+    input_string = input_string.replace('}', '\\}')
 
     # Handle quotes (not very robust...)
     input_string = input_string.replace(" '", " `")
@@ -79,63 +127,516 @@ def wrap_as_subsection(input_string):
     input_string = '\\subsection*{' + input_string + '}'
     return input_string
 
-with open(csv_filename, 'r') as csv_file:
-    csv_reader = csv.reader(csv_file, delimiter=',', quotechar='"')
 
-    header = next(csv_reader)
-    rows = []
+def iterate_records(csv_file):
+    """ Parse csv records from a file opened in binary mode, one at a time, noting where in the file each starts.  A
+    record may span several lines if a quoted field contains line breaks.
+
+    :param csv_file: a binary file object, positioned at the start of a record
+    :return: a generator of (byte offset, list of fields) tuples
+    """
+    # Offset of the next line not yet passed to the csv reader, which reads no further than the end of each record
+    position = [csv_file.tell()]
+
+    def lines():
+        for line in iter(csv_file.readline, b''):
+            position[0] += len(line)
+            yield line if sys.version_info[0] < 3 else line.decode('utf-8')
+
+    csv_reader = csv.reader(lines(), delimiter=',', quotechar='"')
+    while True:
+        offset = position[0]
+        try:
+            row = next(csv_reader)
+        except StopIteration:
+            return
+        yield offset, row
+
+
+def index_csv(csv_filename):
+    """ Read the header of a csv file, and the byte offset of each row, without holding the rows in memory
+
+    :param csv_filename: the csv file
+    :return: a tuple of (list of column headers, list of the byte offset of each row)
+
+    :raise Exception: if the csv file has no header
+    """
+    with open(csv_filename, 'rb') as csv_file:
+        records = iterate_records(csv_file)
+        try:
+            _, header = next(records)
+        except StopIteration:
+            raise Exception('csv_to_latex: No header in ' + csv_filename)
+        offsets = [offset for offset, _ in records]
+
+    return header, offsets
+
+
+def read_row(csv_file, offset):
+    """ Read the row starting at a byte offset of a csv file opened in binary mode, as found by index_csv() """
+    csv_file.seek(offset)
+    return next(iterate_records(csv_file))[1]
 
-    for row in csv_reader:
-        rows.append(row)
 
-random.seed(0)
-random.shuffle(rows)
+def shuffled_order(num_rows, seed=SHUFFLE_SEED):
+    """ The order in which to write rows: a seeded shuffle of their indices, matching exactly the order that shuffling
+    a list of the rows themselves with random.seed(seed) would give
 
-for i, row in enumerate(rows):
+    :param num_rows: the number of rows
+    :param seed: seed for the shuffle (default SHUFFLE_SEED)
+    :return: a list of row indices
+    """
+    order = list(range(num_rows))
+    random.Random(seed).shuffle(order)
+    return order
 
-    # Write unique ID
-    anonymous_tex.write(wrap_as_section(str(1 + i) + ':') + '\n\n')
-    plain_tex.write(wrap_as_section(str(1 + i) + ': ' + row[1]) + '\n\n')
 
-    anonymous_tex.write(wrap_as_subsection(header[4]) + '\n\n')
-    anonymous_tex.write('\\textsterling %.2f' % float(row[4]) + '\n\n')
-    plain_tex.write(wrap_as_subsection(header[4]) + '\n\n')
-    plain_tex.write('\\textsterling %.2f' % float(row[4]) + '\n\n')
+def iterate_responses(csv_filename, seed=SHUFFLE_SEED):
+    """ Read the responses in a csv file one at a time, in the shuffled order.  Only the offset of each row is held in
+    memory: rows are read back by seeking to them.
+
+    :param csv_filename: the csv file of responses
+    :param seed: seed for the shuffle (default SHUFFLE_SEED)
+    :return: a generator of (list of column headers, list of fields) tuples, one per response
+
+    :raise Exception: if the csv file has no header
+    """
+    header, offsets = index_csv(csv_filename)
+
+    with open(csv_filename, 'rb') as csv_file:
+        for row_index in shuffled_order(len(offsets), seed):
+            yield header, read_row(csv_file, offsets[row_index])
 
-    anonymous_tex.write(wrap_as_subsection(header[5]) + '\n\n')
-    anonymous_tex.write(prepare_string(row[5]) + '\n\n')
-    plain_tex.write(wrap_as_subsection(header[5]) + '\n\n')
-    plain_tex.write(prepare_string(row[5]) + '\n\n')
 
-    anonymous_tex.write(wrap_as_subsection(header[6]) + '\n\n')
-    anonymous_tex.write(prepare_string(row[6]) + '\n\n')
-    plain_tex.write(wrap_as_subsection(header[6]) + '\n\n')
-    plain_tex.write(prepare_string(row[6]) + '\n\n')
+def format_response(header, row, number, anonymous):
+    """ Format one response as latex, on a page of its own
 
-    anonymous_tex.write(wrap_as_subsection(header[7]) + '\n\n')
-    anonymous_tex.write(prepare_string(row[7]) + '\n\n')
-    plain_tex.write(wrap_as_subsection(header[7]) + '\n\n')
-    plain_tex.write(prepare_string(row[7]) + '\n\n')
+    :param header: list of column headers
+    :param row: list of fields of the response
+    :param number: the response's number, from 1, in the shuffled order, or latex to put in its place
+    :param anonymous: whether to leave out the respondent's name
+    :return: the latex for the response
+    """
+    if anonymous:
+        parts = [wrap_as_section(str(number) + ':')]
+    else:
+        parts = [wrap_as_section(str(number) + ': ' + row[NAME_COLUMN])]
+
+    parts.append(wrap_as_subsection(header[AMOUNT_COLUMN]))
+    parts.append('\\textsterling %.2f' % float(row[AMOUNT_COLUMN]))
 
-    anonymous_tex.write("""\clearpage\n\n""")
-    plain_tex.write("""\clearpage\n\n""")
+    for column in TEXT_COLUMNS:
+        parts.append(wrap_as_subsection(header[column]))
+        parts.append(prepare_string(row[column]))
 
-anonymous_tex.write("""\end{document}""")
-plain_tex.write("""\end{document}""")
+    parts.append('\\clearpage')
 
-anonymous_tex.close()
-plain_tex.close()
+    return ''.join(part + '\n\n' for part in parts)
+
+
+def write_documents(csv_filename, anonymous_filename='anonymous_responses.tex', plain_filename='plain_responses.tex',
+                    seed=SHUFFLE_SEED):
+    """ Write the anonymous and plain latex documents of the responses in a csv file, in one pass over the shuffled
+    rows, as from iterate_responses()
+
+    :param csv_filename: the csv file of responses
+    :param anonymous_filename: the latex file to write without names (default 'anonymous_responses.tex')
+    :param plain_filename: the latex file to write with names (default 'plain_responses.tex')
+    :param seed: seed for the shuffle (default SHUFFLE_SEED)
+    :return: the number of responses written
+
+    :raise Exception: if the csv file has no header
+    """
+    num_responses = 0
+
+    with open(anonymous_filename, 'w', WRITE_BUFFER_BYTES) as anonymous_tex, \
+            open(plain_filename, 'w', WRITE_BUFFER_BYTES) as plain_tex:
+        anonymous_tex.write(TEX_HEAD)
+        plain_tex.write(TEX_HEAD)
 
-subprocess.call(['pdflatex', 'anonymous_responses.tex'], stdout=open(os.devnull, 'w'))
-subprocess.call(['pdflatex', 'plain_responses.tex'], stdout=open(os.devnull, 'w'))
+        for num_responses, (header, row) in enumerate(iterate_responses(csv_filename, seed), 1):
+            anonymous_tex.write(format_response(header, row, num_responses, anonymous=True))
+            plain_tex.write(format_response(header, row, num_responses, anonymous=False))
+
+        anonymous_tex.write(TEX_TAIL)
+        plain_tex.write(TEX_TAIL)
+
+    return num_responses
+
+
+def write_shards(csv_filename, build_dir, shard_size=DEFAULT_SHARD_SIZE, seed=SHUFFLE_SEED):
+    """ Write each document as a sequence of shards of shard_size responses, each a complete latex document in a
+    directory of its own, in one pass over the shuffled rows.  Responses keep the numbers they have in the whole
+    document.
 
-# Clean up
-for local_file in os.listdir(os.getcwd()):
-    if local_file.endswith('.aux'):
-        subprocess.call(['rm', local_file])
-    elif local_file.endswith('.synctex.gz'):
-        subprocess.call(['rm', local_file])
-    elif local_file.endswith('.log'):
-        subprocess.call(['rm', local_file])
-    elif local_file.endswith('.tex'):
-        subprocess.call(['rm', local_file])
+    :param csv_filename: the csv file of responses
+    :param build_dir: the directory in which to make the shard directories
+    :param shard_size: the number of responses in each shard (default DEFAULT_SHARD_SIZE)
+    :param seed: seed for the shuffle (default SHUFFLE_SEED)
+    :return: a dict mapping each document name in DOCUMENTS to a list of its shard directories, in order
+
+    :raise Exception: if the csv file has no header, or no responses
+    """
+    shard_dirs = dict((document_name, []) for document_name, _ in DOCUMENTS)
+    shard_files = []
+
+    def close_shards():
+        for shard_file in shard_files:
+            shard_file.write(TEX_TAIL)
+            shard_file.close()
+        del shard_files[:]
+
+    try:
+        for i, (header, row) in enumerate(iterate_responses(csv_filename, seed)):
+            if i % shard_size == 0:
+                close_shards()
+                for document_name, _ in DOCUMENTS:
+                    shard_dir = os.path.join(build_dir, '%s_%04d' % (document_name, i // shard_size))
+                    os.mkdir(shard_dir)
+                    shard_dirs[document_name].append(shard_dir)
+                    shard_files.append(open(os.path.join(shard_dir, 'responses.tex'), 'w', WRITE_BUFFER_BYTES))
+                    shard_files[-1].write(TEX_HEAD)
+
+            for shard_file, (_, anonymous) in zip(shard_files, DOCUMENTS):
+                shard_file.write(format_response(header, row, 1 + i, anonymous))
+    finally:
+        close_shards()
+
+    if len(shard_dirs[DOCUMENTS[0][0]]) == 0:
+        raise Exception('csv_to_latex: No responses in ' + csv_filename)
+
+    return shard_dirs
+
+
+def compile_latex(tex_dir, tex_filename):
+    """ Compile a latex document with latex_compile.compile_latex(), in its own directory, stopping at the first error
+
+    :param tex_dir: the directory containing the document, in which pdflatex runs
+    :param tex_filename: the name of the document
+    :return: the path of the pdf
+
+    :raise Exception: if pdflatex fails, or writes no pdf
+    """
+    return_code = latex_compile.compile_latex(tex_dir, tex_filename, latex_options=['-halt-on-error'])['return_code']
+    pdf_path = os.path.join(tex_dir, os.path.splitext(tex_filename)[0] + '.pdf')
+    if return_code != 0 or not os.path.isfile(pdf_path):
+        raise Exception('csv_to_latex: pdflatex returned ' + str(return_code) + ' for ' +
+                        os.path.join(tex_dir, tex_filename))
+
+    return pdf_path
+
+
+def merge_pdfs(build_dir, document_name, pdf_paths, first_page_commands=None):
+    """ Join pdfs, page for page and in order, into a single pdf, using the pdfpages latex package
+
+    :param build_dir: the directory in which to write and compile the merging document
+    :param document_name: name, without extension, of the merged pdf
+    :param pdf_paths: paths of the pdfs to join, in order
+    :param first_page_commands: list of latex picture commands, one per pdf, to draw over the first page of each pdf,
+                                with the origin at the bottom left of the page (default None, meaning none)
+    :return: the path of the merged pdf, in build_dir
+
+    :raise Exception: if pdflatex fails
+    """
+    with open(os.path.join(build_dir, document_name + '.tex'), 'w') as merge_tex:
+        merge_tex.write(MERGE_HEAD)
+        for i, pdf_path in enumerate(pdf_paths):
+            options = 'pages=-'
+            if first_page_commands is not None:
+                options += ', picturecommand*={' + first_page_commands[i] + '}'
+
+            # Relative paths with forward slashes, which latex accepts on every platform
+            merge_tex.write('\\includepdf[' + options + ']{' +
+                            os.path.relpath(pdf_path, build_dir).replace(os.sep, '/') + '}\n')
+        merge_tex.write(TEX_TAIL)
+
+    return compile_latex(build_dir, document_name + '.tex')
+
+
+def build_sharded(csv_filename, output_dir='.', shard_size=DEFAULT_SHARD_SIZE, num_workers=None, seed=SHUFFLE_SEED,
+                  print_progress=False):
+    """ Build the anonymous and plain pdfs of the responses in a csv file by splitting the responses into shards,
+    compiling the shards concurrently, each in its own directory, and merging the shard pdfs in order.  The pdfs have
+    the same responses, in the same order and numbered the same way, one to a page, as compiling the documents of
+    write_documents() gives.
+
+    :param csv_filename: the csv file of responses
+    :param output_dir: the directory in which to write anonymous_responses.pdf and plain_responses.pdf (default '.')
+    :param shard_size: the number of responses in each shard (default DEFAULT_SHARD_SIZE)
+    :param num_workers: number of pdflatex processes to run at once (default None, meaning one per core)
+    :param seed: seed for the shuffle (default SHUFFLE_SEED)
+    :param print_progress: whether to print running trace of this function (default False)
+    :return: a list of the paths of the pdfs
+
+    :raise Exception: if shard_size or num_workers is < 1
+    :raise Exception: if the csv file has no header, or no responses
+    :raise Exception: if pdflatex fails on any shard, or on merging the shards
+    """
+    if shard_size < 1:
+        raise Exception('csv_to_latex: Invalid shard_size: ' + str(shard_size))
+
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+
+    if num_workers < 1:
+        raise Exception('csv_to_latex: Invalid num_workers: ' + str(num_workers))
+
+    # The directory name starts with '.' so that it is easily told apart from the results, should it be left behind
+    build_dir = tempfile.mkdtemp(prefix='.csv_to_latex_', dir=output_dir)
+    try:
+        shard_dirs = write_shards(csv_filename, build_dir, shard_size, seed)
+        jobs = [shard_dir for document_name, _ in DOCUMENTS for shard_dir in shard_dirs[document_name]]
+
+        if print_progress:
+            print('csv_to_latex: Compiling ' + str(len(jobs)) + ' shards of up to ' + str(shard_size) +
+                  ' responses with ' + str(min(num_workers, len(jobs))) + ' pdflatex processes')
+
+        # Each shard is compiled by a separate pdflatex process, so threads suffice to wait on them
+        def compile_shard(shard_dir):
+            return compile_latex(shard_dir, 'responses.tex')
+
+        pool = multiprocessing.pool.ThreadPool(processes=min(num_workers, len(jobs)))
+        try:
+            for num_done, _ in enumerate(pool.imap_unordered(compile_shard, jobs)):
+                if print_progress:
+                    print('\t' + str(num_done + 1) + ' of ' + str(len(jobs)) + ' shards compiled')
+        finally:
+            pool.close()
+            pool.join()
+
+        pdf_paths = []
+        for document_name, _ in DOCUMENTS:
+            shard_pdfs = [os.path.join(shard_dir, 'responses.pdf') for shard_dir in shard_dirs[document_name]]
+            merged_pdf = merge_pdfs(build_dir, document_name, shard_pdfs)
+            pdf_paths.append(os.path.join(output_dir, document_name + '.pdf'))
+            os.rename(merged_pdf, pdf_paths[-1])
+            if print_progress:
+                print('\t... merged shards into ' + pdf_paths[-1])
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+    return pdf_paths
+
+
+def load_fragment_index(cache_dir):
+    """ Read the index of a fragment cache
+
+    :param cache_dir: the directory containing FRAGMENT_INDEX_FILE
+    :return: a dict mapping the key of each cached fragment to its number position, empty if there is no usable index
+    """
+    try:
+        with open(os.path.join(cache_dir, FRAGMENT_INDEX_FILE), 'r') as index_file:
+            index = json.load(index_file)
+    except (IOError, OSError, ValueError):
+        return {}
+
+    if not isinstance(index, dict) or index.get('version') != FRAGMENT_INDEX_VERSION:
+        return {}
+    return index.get('fragments', {})
+
+
+def save_fragment_index(cache_dir, fragments):
+    """ Write the index of a fragment cache
+
+    :param cache_dir: the directory in which to write FRAGMENT_INDEX_FILE
+    :param fragments: a dict mapping the key of each cached fragment to its number position
+    """
+    # Write to a temporary file and rename, so an interrupted build never leaves a partial index
+    handle, temp_path = tempfile.mkstemp(dir=cache_dir, prefix=FRAGMENT_INDEX_FILE, suffix='.tmp')
+    with os.fdopen(handle, 'w') as temp_file:
+        json.dump({'version': FRAGMENT_INDEX_VERSION, 'fragments': fragments}, temp_file, sort_keys=True)
+    os.rename(temp_path, os.path.join(cache_dir, FRAGMENT_INDEX_FILE))
+
+
+def format_fragment(header, row, anonymous):
+    """ Format one response as a complete latex document, with a slot in place of its response number
+
+    :param header: list of column headers
+    :param row: list of fields of the response
+    :param anonymous: whether to leave out the respondent's name
+    :return: the latex document
+    """
+    return TEX_HEAD + NUMBER_SLOT + format_response(header, row, '\\numberslot', anonymous) + TEX_TAIL
+
+
+def fragment_key(fragment):
+    """ The key of a fragment in the cache: a hash of its latex, and so of the column headers and row contents """
+    return hashlib.sha1(fragment if isinstance(fragment, bytes) else fragment.encode('utf-8')).hexdigest()
+
+
+def read_number_position(log_path):
+    """ Read the position recorded by \\numberslot from a fragment's pdflatex log
+
+    :param log_path: the log
+    :return: a list of the [x, y] position in sp from the bottom left of the page
+
+    :raise Exception: if no position was recorded
+    """
+    with open(log_path, 'r') as log_file:
+        match = NUMBER_POSITION_PATTERN.search(log_file.read())
+    if match is None:
+        raise Exception('csv_to_latex: No number position in ' + log_path)
+    return [int(match.group(1)), int(match.group(2))]
+
+
+def number_command(number, position):
+    """ A latex picture command typesetting a response number, in the font of a section heading, to end at a position
+    in sp, as recorded by \\numberslot
+    """
+    return '\\setlength{\\unitlength}{1sp}\\put(%d,%d){\\makebox[0pt][r]{\\normalfont\\Large\\bfseries %d}}' % \
+        (position[0], position[1], number)
+
+
+def build_incremental(csv_filename, output_dir='.', cache_dir=None, num_workers=None, seed=SHUFFLE_SEED,
+                      print_progress=False):
+    """ Build the anonymous and plain pdfs of the responses in a csv file from a cache of compiled fragments, one per
+    response and document, compiling only those fragments not already in the cache.
+
+    A fragment is keyed by a hash of its latex, which depends on the column headers and the row, but not on the
+    response's number: new responses reorder the seeded shuffle, so numbers are typeset over each fragment's first
+    page as the fragments are assembled, ending where the slot is, so that even the number of digits in the largest
+    number does not change any fragment.  Fragments no longer used are removed from the cache.
+
+    :param csv_filename: the csv file of responses
+    :param output_dir: the directory in which to write anonymous_responses.pdf and plain_responses.pdf (default '.')
+    :param cache_dir: the fragment cache (default None, meaning FRAGMENT_CACHE_DIR in output_dir)
+    :param num_workers: number of pdflatex processes to run at once (default None, meaning one per core)
+    :param seed: seed for the shuffle (default SHUFFLE_SEED)
+    :param print_progress: whether to print running trace of this function (default False)
+    :return: a list of the paths of the pdfs
+
+    :raise Exception: if num_workers is < 1
+    :raise Exception: if the csv file has no header, or no responses
+    :raise Exception: if pdflatex fails on any fragment, or on assembling the fragments
+    """
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+
+    if num_workers < 1:
+        raise Exception('csv_to_latex: Invalid num_workers: ' + str(num_workers))
+
+    if cache_dir is None:
+        cache_dir = os.path.join(output_dir, FRAGMENT_CACHE_DIR)
+
+    header, offsets = index_csv(csv_filename)
+    if len(offsets) == 0:
+        raise Exception('csv_to_latex: No responses in ' + csv_filename)
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    fragments = load_fragment_index(cache_dir)
+    fragment_keys = dict((document_name, []) for document_name, _ in DOCUMENTS)
+    new_fragments = {}
+
+    build_dir = tempfile.mkdtemp(prefix='.csv_to_latex_', dir=output_dir)
+    try:
+        # Write each fragment that is not already cached to a directory of its own
+        with open(csv_filename, 'rb') as csv_file:
+            for row_index in shuffled_order(len(offsets), seed):
+                row = read_row(csv_file, offsets[row_index])
+                for document_name, anonymous in DOCUMENTS:
+                    fragment = format_fragment(header, row, anonymous)
+                    key = fragment_key(fragment)
+                    fragment_keys[document_name].append(key)
+
+                    cached = key in fragments and os.path.isfile(os.path.join(cache_dir, key + '.pdf'))
+                    if not cached and key not in new_fragments:
+                        new_fragments[key] = os.path.join(build_dir, key)
+                        os.mkdir(new_fragments[key])
+                        with open(os.path.join(new_fragments[key], 'responses.tex'), 'w') as fragment_tex:
+                            fragment_tex.write(fragment)
+
+        if print_progress:
+            print('csv_to_latex: Compiling ' + str(len(new_fragments)) + ' of ' +
+                  str(len(set(key for keys in fragment_keys.values() for key in keys))) + ' fragments')
+
+        def compile_fragment(key):
+            pdf_path = compile_latex(new_fragments[key], 'responses.tex')
+            position = read_number_position(os.path.join(new_fragments[key], 'responses.log'))
+            os.rename(pdf_path, os.path.join(cache_dir, key + '.pdf'))
+            return key, position
+
+        if len(new_fragments) > 0:
+            # Each fragment is compiled by a separate pdflatex process, so threads suffice to wait on them
+            pool = multiprocessing.pool.ThreadPool(processes=min(num_workers, len(new_fragments)))
+            try:
+                for num_done, (key, position) in enumerate(pool.imap_unordered(compile_fragment, new_fragments)):
+                    fragments[key] = position
+                    if print_progress and (num_done + 1) % 100 == 0:
+                        print('\t' + str(num_done + 1) + ' of ' + str(len(new_fragments)) + ' fragments compiled')
+            finally:
+                pool.close()
+                pool.join()
+
+                # Keep whatever was compiled, even if the build goes no further
+                save_fragment_index(cache_dir, fragments)
+
+        pdf_paths = []
+        for document_name, _ in DOCUMENTS:
+            keys = fragment_keys[document_name]
+            merged_pdf = merge_pdfs(build_dir, document_name, [os.path.join(cache_dir, key + '.pdf') for key in keys],
+                                    [number_command(1 + i, fragments[key]) for i, key in enumerate(keys)])
+            pdf_paths.append(os.path.join(output_dir, document_name + '.pdf'))
+            os.rename(merged_pdf, pdf_paths[-1])
+            if print_progress:
+                print('\t... assembled fragments into ' + pdf_paths[-1])
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+    # Drop fragments of responses that have since changed or gone
+    used_keys = set(key for keys in fragment_keys.values() for key in keys)
+    for key in set(fragments) - used_keys:
+        del fragments[key]
+        if os.path.isfile(os.path.join(cache_dir, key + '.pdf')):
+            os.remove(os.path.join(cache_dir, key + '.pdf'))
+    save_fragment_index(cache_dir, fragments)
+
+    return pdf_paths
+
+
+if __name__ == '__main__':
+
+    # Expecting one or two additional arguments:
+    if len(sys.argv) not in [2, 3]:
+        quit(print_usage())
+
+    # Check file is valid
+    csv_filename = sys.argv[1]
+    if not os.path.isfile(csv_filename):
+        print('Expecting a valid csv file as command line argument.')
+        quit(print_usage())
+
+    # Incrementally, build the pdfs from the fragment cache, which is kept for the next build
+    if len(sys.argv) == 3 and sys.argv[2] == 'incremental':
+        build_incremental(csv_filename, print_progress=True)
+        quit()
+
+    # With a shard size, build the pdfs from shards, each compiled and cleaned up in a directory of its own
+    if len(sys.argv) == 3:
+        try:
+            shard_size = int(sys.argv[2])
+        except ValueError:
+            shard_size = 0
+        if shard_size < 1:
+            print('Expecting a positive number of responses per shard.')
+            quit(print_usage())
+
+        build_sharded(csv_filename, shard_size=shard_size, print_progress=True)
+        quit()
+
+    write_documents(csv_filename)
+
+    latex_compile.compile_latex(os.getcwd(), 'anonymous_responses.tex', stop_on_error=False, print_progress=True)
+    latex_compile.compile_latex(os.getcwd(), 'plain_responses.tex', stop_on_error=False, print_progress=True)
+
+    # Clean up
+    for local_file in os.listdir(os.getcwd()):
+        if local_file.endswith('.aux'):
+            subprocess.call(['rm', local_file])
+        elif local_file.endswith('.synctex.gz'):
+            subprocess.call(['rm', local_file])
+        elif local_file.endswith('.log'):
+            subprocess.call(['rm', local_file])
+        elif local_file.endswith('.tex'):
+            subprocess.call(['rm', local_file])
@@ -0,0 +1,133 @@
+import collections
+import os
+
+# Movie containers, and the video codec used for each
+CONTAINERS = collections.OrderedDict([('mp4', 'libx264'), ('webm', 'libvpx-vp9')])
+
+# Valid presets for each codec, fastest first
+PRESETS = {'libx264': ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow'],
+           'libvpx-vp9': ['realtime', 'good', 'best']}
+
+# Named encoder settings for each container.  'args' are the codec options, and 'preset' trades encoding speed against
+# file size: for libx264 it is the -preset, for libvpx-vp9 the -deadline.  Every profile encodes with an explicit
+# thread count when one is given, and vp9 encodes use row multithreading so that threads are kept busy even on frames
+# too small for many tile columns.
+PROFILES = collections.OrderedDict([
+    # Lossless, as the movie functions have always produced.  Slow, and large
+    ('archival-lossless', {
+        'mp4': {'args': ['-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-crf', '0'],
+                'preset': 'slow'},
+        'webm': {'args': ['-c:v', 'libvpx-vp9', '-tile-columns', '6', '-frame-parallel', '1', '-lossless', '1'],
+                 'preset': 'good'},
+    }),
+    # Quick to encode, for checking a simulation looks right
+    ('fast-preview', {
+        'mp4': {'args': ['-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-crf', '28'],
+                'preset': 'ultrafast'},
+        'webm': {'args': ['-c:v', 'libvpx-vp9', '-tile-columns', '2', '-crf', '45', '-b:v', '0', '-cpu-used', '8'],
+                 'preset': 'realtime'},
+    }),
+    # Small files for sharing and embedding in web pages
+    ('web-small', {
+        'mp4': {'args': ['-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-crf', '23', '-movflags', '+faststart'],
+                'preset': 'medium'},
+        'webm': {'args': ['-c:v', 'libvpx-vp9', '-tile-columns', '2', '-crf', '33', '-b:v', '0', '-cpu-used', '2'],
+                 'preset': 'good'},
+    }),
+])
+
+DEFAULT_PROFILE = 'archival-lossless'
+
+
+def container_of(movie_name):
+    """ The container of a movie file, from its extension
+
+    :param movie_name: file name of the movie, e.g. 'results.webm'
+    :return: one of CONTAINERS
+
+    :raise Exception: if the extension is not one of CONTAINERS
+    """
+    container = os.path.splitext(movie_name)[1][1:]
+    if container not in CONTAINERS:
+        raise Exception('encode_profiles: Unsupported movie extension: ' + movie_name)
+    return container
+
+
+def encoder_args(profile, container, threads=None, preset=None, gop_size=None):
+    """ Get the ffmpeg codec options for encoding to a container with a named profile
+
+    :param profile: one of PROFILES
+    :param container: one of CONTAINERS
+    :param threads: number of threads the encoder may use (default None, meaning ffmpeg's own choice)
+    :param preset: overrides the profile's preset (default None)
+    :param gop_size: number of frames between keyframes (default None, meaning the encoder's own choice)
+    :return: a list of ffmpeg arguments
+
+    :raise Exception: if profile is not one of PROFILES, or threads or gop_size is < 1
+    :raise Exception: if preset is not one of the PRESETS of the container's codec
+    """
+    if profile not in PROFILES:
+        raise Exception('encode_profiles: Invalid profile: ' + str(profile))
+
+    if threads is not None and threads < 1:
+        raise Exception('encode_profiles: Invalid threads: ' + str(threads))
+
+    if gop_size is not None and gop_size < 1:
+        raise Exception('encode_profiles: Invalid gop_size: ' + str(gop_size))
+
+    settings = PROFILES[profile][container]
+    if preset is None:
+        preset = settings['preset']
+
+    if preset not in PRESETS[CONTAINERS[container]]:
+        raise Exception('encode_profiles: Invalid preset for ' + CONTAINERS[container] + ': ' + str(preset))
+
+    # Parameters for vp9:
+    #   -deadline preset   good, best or realtime
+    #   -row-mt 1          Encode rows of each tile in parallel, so more threads are useful
+    # and for h264:
+    #   -preset preset     ultrafast to veryslow
+    args = list(settings['args'])
+    if CONTAINERS[container] == 'libvpx-vp9':
+        args += ['-deadline', preset, '-row-mt', '1']
+    else:
+        args += ['-preset', preset]
+
+    if threads is not None:
+        args += ['-threads', str(threads)]
+
+    if gop_size is not None:
+        args += ['-g', str(gop_size)]
+
+    return args
+
+
+def output_args(outputs, threads=None, preset=None, gop_size=None):
+    """ Get the ffmpeg arguments, following the input, that encode one decoded frame stream to one or more movies.
+
+    ffmpeg decodes the input once and encodes it to each output in turn, so several formats cost a single pass over
+    the frames.
+
+    :param outputs: list of (profile, movie name) tuples, the container of each being given by its extension
+    :param threads: number of threads each encoder may use (default None, meaning ffmpeg's own choice)
+    :param preset: overrides the preset of the profile of each output whose codec has such a preset, e.g. 'veryfast'
+                   applies to mp4 outputs only (default None)
+    :param gop_size: number of frames between keyframes (default None, meaning each encoder's own choice)
+    :return: a list of ffmpeg arguments
+
+    :raise Exception: if preset is not a preset of any output's codec
+    """
+    containers = [container_of(movie_name) for _, movie_name in outputs]
+    if preset is not None and not any(preset in PRESETS[CONTAINERS[container]] for container in containers):
+        raise Exception('encode_profiles: Invalid preset: ' + str(preset))
+
+    args = []
+    for (profile, movie_name), container in zip(outputs, containers):
+        output_preset = preset if preset in PRESETS[CONTAINERS[container]] else None
+        args += encoder_args(profile, container, threads=threads, preset=output_preset, gop_size=gop_size) + \
+            ['-y', movie_name]
+    return args
+
+
+if __name__ == '__main__':
+    quit('Pass a profile from encode_profiles.PROFILES to svg_to_webm.svg_to_webm() or png_to_mp4.png_to_mp4()')
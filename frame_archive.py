@@ -0,0 +1,236 @@
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+
+from archiver import extract_archive, find_archive, zstandard
+
+# Name of the indexed frame archive within a simulation directory.  Unlike svg_arch.tar.gz, a zip file has a central
+# index of its members, so a single frame can be read without decompressing the frames before it
+FRAME_ARCHIVE = 'svg_arch.zip'
+
+# Open archives in this process, keyed by path, so that reading many frames does not re-read the index each time.
+# Each worker process of a multiprocessing Pool has its own.
+g_open_archives = {}
+
+
+def has_frame_archive(directory):
+    """ Whether a directory contains an indexed frame archive """
+    return os.path.isfile(os.path.join(directory, FRAME_ARCHIVE))
+
+
+def open_frame_archive(directory):
+    """ Get an open ZipFile for the frame archive in a directory, reusing one already opened by this process
+
+    :param directory: the directory containing FRAME_ARCHIVE
+    :return: an open zipfile.ZipFile
+    """
+    archive_path = os.path.realpath(os.path.join(directory, FRAME_ARCHIVE))
+    stat = os.stat(archive_path)
+
+    # Reopen if the archive has been replaced since it was opened
+    cached = g_open_archives.get(archive_path)
+    if cached is not None and cached[0] == (stat.st_size, stat.st_mtime):
+        return cached[1]
+    if cached is not None:
+        cached[1].close()
+
+    archive = zipfile.ZipFile(archive_path, 'r')
+    g_open_archives[archive_path] = ((stat.st_size, stat.st_mtime), archive)
+    return archive
+
+
+def list_frames(directory):
+    """ List the svg frames in the frame archive of a directory
+
+    :param directory: the directory containing FRAME_ARCHIVE
+    :return: a sorted list of svg file names
+    """
+    return sorted(name for name in open_frame_archive(directory).namelist() if name.endswith('.svg'))
+
+
+def read_frame(directory, file_name):
+    """ Read the contents of a single svg file, from disk if present or otherwise from the frame archive
+
+    :param directory: the directory containing the svg file or FRAME_ARCHIVE
+    :param file_name: name of the svg file
+    :return: the svg contents as bytes
+    """
+    file_path = os.path.join(directory, file_name)
+    if os.path.isfile(file_path):
+        with open(file_path, 'rb') as svg_file:
+            return svg_file.read()
+    return open_frame_archive(directory).read(file_name)
+
+
+def frame_size(directory, file_name):
+    """ The uncompressed size in bytes of a single svg file, on disk if present or otherwise in the frame archive """
+    file_path = os.path.join(directory, file_name)
+    if os.path.isfile(file_path):
+        return os.path.getsize(file_path)
+    return open_frame_archive(directory).getinfo(file_name).file_size
+
+
+def frame_signature(directory, file_name):
+    """ Values that change whenever a single svg file does: its size and modification time on disk if present, or
+    otherwise its size and CRC in the frame archive
+
+    :param directory: the directory containing the svg file or FRAME_ARCHIVE
+    :param file_name: name of the svg file
+    :return: a list of two numbers
+    """
+    file_path = os.path.join(directory, file_name)
+    if os.path.isfile(file_path):
+        stat = os.stat(file_path)
+        return [stat.st_size, stat.st_mtime]
+    info = open_frame_archive(directory).getinfo(file_name)
+    return [info.file_size, info.CRC]
+
+
+def open_frame(directory, file_name):
+    """ Open a single svg file for reading in binary mode, from disk if present or otherwise from the frame archive
+
+    :param directory: the directory containing the svg file or FRAME_ARCHIVE
+    :param file_name: name of the svg file
+    :return: a binary file object, which the caller must close
+    """
+    file_path = os.path.join(directory, file_name)
+    if os.path.isfile(file_path):
+        return open(file_path, 'rb')
+    return open_frame_archive(directory).open(file_name)
+
+
+def frame_path(directory, file_name, scratch_dir):
+    """ Get a path to a single svg file, for renderers that can only read files, writing it to scratch_dir if it is
+    only in the frame archive
+
+    :param directory: the directory containing the svg file or FRAME_ARCHIVE
+    :param file_name: name of the svg file
+    :param scratch_dir: directory in which to write the svg file if necessary
+    :return: tuple of (path to the svg file, whether it is a scratch copy that the caller should remove)
+    """
+    file_path = os.path.join(directory, file_name)
+    if os.path.isfile(file_path):
+        return file_path, False
+
+    handle, scratch_path = tempfile.mkstemp(dir=scratch_dir, suffix='.svg')
+    with os.fdopen(handle, 'wb') as scratch_file:
+        with open_frame_archive(directory).open(file_name) as member:
+            shutil.copyfileobj(member, scratch_file)
+    return scratch_path, True
+
+
+def is_complete_svg(svg_bytes):
+    """ Whether svg contents are complete, judged by the closing tag being present near the end """
+    return b'</svg>' in svg_bytes[-1024:]
+
+
+def create_frame_archive(directory, svg_files, remove_files=True):
+    """ Write svg files to the frame archive of a directory, replacing any existing frame archive
+
+    :param directory: the directory containing the svg files, in which the archive is written
+    :param svg_files: names of the svg files to archive
+    :param remove_files: whether to remove the svg files once the archive is complete (default True)
+    :return: the number of frames archived
+    """
+    temp_path = os.path.join(directory, FRAME_ARCHIVE + '.part')
+    with zipfile.ZipFile(temp_path, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+        for svg_file in sorted(svg_files):
+            archive.write(os.path.join(directory, svg_file), arcname=svg_file)
+    os.rename(temp_path, os.path.join(directory, FRAME_ARCHIVE))
+
+    if remove_files:
+        for svg_file in svg_files:
+            os.remove(os.path.join(directory, svg_file))
+
+    return len(svg_files)
+
+
+def convert_tar_to_frame_archive(directory, remove_tar=False, print_progress=False):
+    """ Convert an existing svg_arch.tar.* archive to a frame archive, streaming members without extracting to disk.
+
+    Only complete svg files (those with a closing tag) are included, so readers of the frame archive need not check.
+
+    :param directory: the directory containing the tar archive, in which the frame archive is written
+    :param remove_tar: whether to remove the tar archive once the frame archive is complete (default False)
+    :param print_progress: whether to print running trace of this function (default False)
+    :return: the number of frames in the frame archive
+
+    :raise Exception: if the directory has no svg tar archive
+    """
+    tar_name = find_archive(directory, 'svg_arch')
+    if tar_name is None:
+        raise Exception('frame_archive: No svg archive found in ' + directory)
+
+    tar_path = os.path.join(directory, tar_name)
+    temp_path = os.path.join(directory, FRAME_ARCHIVE + '.part')
+
+    num_frames = 0
+    num_skipped = 0
+    raw_file = open(tar_path, 'rb')
+    try:
+        if tar_name.endswith('.zst'):
+            if zstandard is None:
+                raise Exception('frame_archive: converting ' + tar_name + ' requires the zstandard package')
+            tar = tarfile.open(fileobj=zstandard.ZstdDecompressor().stream_reader(raw_file), mode='r|')
+        else:
+            tar = tarfile.open(fileobj=raw_file, mode='r|*')
+
+        with zipfile.ZipFile(temp_path, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+            for member in tar:
+                if not (member.isfile() and member.name.endswith('.svg')):
+                    continue
+                svg_bytes = tar.extractfile(member).read()
+                if not is_complete_svg(svg_bytes):
+                    num_skipped += 1
+                    continue
+                archive.writestr(os.path.basename(member.name), svg_bytes)
+                num_frames += 1
+        tar.close()
+    finally:
+        raw_file.close()
+
+    os.rename(temp_path, os.path.join(directory, FRAME_ARCHIVE))
+
+    if remove_tar:
+        os.remove(tar_path)
+
+    if print_progress:
+        print('frame_archive: Converted %s to %s: %s frames, %s incomplete svg files skipped' %
+              (tar_name, FRAME_ARCHIVE, num_frames, num_skipped))
+
+    return num_frames
+
+
+def convert_all_tar_archives(path, remove_tar=False, print_progress=False):
+    """ Convert every svg_arch.tar.* beneath path that does not already have a frame archive
+
+    :param path: the path beneath which to search
+    :param remove_tar: whether to remove each tar archive once its frame archive is complete (default False)
+    :param print_progress: whether to print running trace of this function (default False)
+    :return: a sorted list of the directories converted
+    """
+    converted = []
+    for root, _, file_names in os.walk(path):
+        if FRAME_ARCHIVE not in file_names and find_archive(root, 'svg_arch') is not None:
+            convert_tar_to_frame_archive(root, remove_tar=remove_tar, print_progress=print_progress)
+            converted.append(root)
+    return sorted(converted)
+
+
+def extract_frames(directory):
+    """ Extract every frame, from the frame archive if there is one or otherwise from svg_arch.tar.*
+
+    :param directory: the directory containing the archive
+    :return: a sorted list of the names of the extracted files
+    """
+    if has_frame_archive(directory):
+        with zipfile.ZipFile(os.path.join(directory, FRAME_ARCHIVE), 'r') as archive:
+            archive.extractall(directory)
+            return sorted(archive.namelist())
+    return extract_archive(directory, find_archive(directory, 'svg_arch'))
+
+
+if __name__ == '__main__':
+    quit('Call frame_archive.convert_all_tar_archives()')
@@ -0,0 +1,181 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+# Default location and size cap for cached frames
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'useful_scripts_frames')
+DEFAULT_MAX_BYTES = 4 * 1024 ** 3
+
+# Fraction of max_bytes to which eviction shrinks the cache.  Eviction walks the whole cache directory, so freeing more
+# than is needed means the walk happens only once per this fraction of max_bytes added, rather than for every frame
+EVICTION_LOW_WATER = 0.9
+
+
+class FrameCache(object):
+    """ A persistent cache of rasterised frames, keyed by a hash of everything that determines the frame's pixels.
+
+    Each frame is stored as a png file named by its key. A file's modification time is refreshed whenever it is read,
+    and when the total size exceeds max_bytes the least recently used frames are evicted, down to EVICTION_LOW_WATER of
+    max_bytes.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param cache_dir: directory in which to store cached frames, created if necessary
+        :param max_bytes: the size above which least recently used frames are evicted
+        :raise Exception: if max_bytes is < 1
+        """
+        if max_bytes < 1:
+            raise Exception('frame_cache: Invalid max_bytes: ' + str(max_bytes))
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        self.total_bytes = sum(size for _, size, _ in self.list_entries())
+
+    @staticmethod
+    def key(crop_string, output_size, renderer, svg_path=None, svg_bytes=None):
+        """ Calculate the cache key for a frame
+
+        :param crop_string: the export area passed to the renderer
+        :param output_size: (width, height) of the png in pixels
+        :param renderer: name of the renderer used
+        :param svg_path: path to the svg file, if svg_bytes is not given
+        :param svg_bytes: the contents of the svg file, if svg_path is not given
+        :return: a hex digest identifying the frame
+        """
+        digest = hashlib.sha1()
+        if svg_bytes is not None:
+            digest.update(svg_bytes)
+        else:
+            with open(svg_path, 'rb') as svg_file:
+                for block in iter(lambda: svg_file.read(1024 * 1024), b''):
+                    digest.update(block)
+        digest.update(('|%s|%dx%d|%s' % (crop_string, output_size[0], output_size[1], renderer)).encode())
+        return digest.hexdigest()
+
+    def path(self, key):
+        """ The location of the cached frame with a given key """
+        return os.path.join(self.cache_dir, key[:2], key + '.png')
+
+    def contains(self, key):
+        """ Whether a frame with a given key is cached """
+        return os.path.isfile(self.path(key))
+
+    def read(self, key):
+        """ Read a cached frame, marking it as recently used
+
+        :param key: the frame's key
+        :return: the png contents, or None if the frame is not cached
+        """
+        try:
+            with open(self.path(key), 'rb') as png_file:
+                png_bytes = png_file.read()
+        except (IOError, OSError):
+            return None
+        self.touch(key)
+        return png_bytes
+
+    def copy_to(self, key, dest_path):
+        """ Copy a cached frame to dest_path, marking it as recently used
+
+        :param key: the frame's key
+        :param dest_path: where to write the png
+        :return: whether the frame was cached
+        """
+        try:
+            shutil.copyfile(self.path(key), dest_path)
+        except (IOError, OSError):
+            return False
+        self.touch(key)
+        return True
+
+    def touch(self, key):
+        """ Mark a cached frame as recently used """
+        try:
+            os.utime(self.path(key), None)
+        except OSError:
+            pass
+
+    def add_file(self, key, png_path):
+        """ Add a png file to the cache, evicting least recently used frames if the cache is now too large
+
+        :param key: the frame's key
+        :param png_path: the png file to copy into the cache
+        """
+        with open(png_path, 'rb') as png_file:
+            self.add_bytes(key, png_file.read())
+
+    def add_bytes(self, key, png_bytes):
+        """ Add png contents to the cache, evicting least recently used frames if the cache is now too large
+
+        :param key: the frame's key
+        :param png_bytes: the png contents
+        """
+        entry_path = self.path(key)
+        entry_dir = os.path.dirname(entry_path)
+        if not os.path.isdir(entry_dir):
+            try:
+                os.makedirs(entry_dir)
+            except OSError:
+                # Another process may have created it in the meantime
+                if not os.path.isdir(entry_dir):
+                    raise
+
+        # Write to a temporary file and rename, so concurrent readers never see a partial frame
+        previous_size = os.path.getsize(entry_path) if os.path.isfile(entry_path) else 0
+        handle, temp_path = tempfile.mkstemp(dir=entry_dir, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as temp_file:
+            temp_file.write(png_bytes)
+        os.rename(temp_path, entry_path)
+
+        self.total_bytes += len(png_bytes) - previous_size
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def list_entries(self):
+        """ List every cached frame
+
+        :return: a list of (path, size in bytes, last used time) tuples
+        """
+        entries = []
+        for root, _, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                if file_name.endswith('.png'):
+                    entry_path = os.path.join(root, file_name)
+                    try:
+                        stat = os.stat(entry_path)
+                    except OSError:
+                        continue
+                    entries.append((entry_path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def evict(self):
+        """ Remove least recently used frames until the cache is no larger than EVICTION_LOW_WATER of max_bytes.  The size
+        of the cache is taken afresh from the directory, which other processes may also be adding to.
+        """
+        entries = sorted(self.list_entries(), key=lambda entry: entry[2])
+        self.total_bytes = sum(size for _, size, _ in entries)
+
+        for entry_path, size, _ in entries:
+            if self.total_bytes <= EVICTION_LOW_WATER * self.max_bytes:
+                break
+            try:
+                os.remove(entry_path)
+                self.total_bytes -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        """ Remove every cached frame """
+        for entry_path, _, _ in self.list_entries():
+            os.remove(entry_path)
+        self.total_bytes = 0
+
+
+if __name__ == '__main__':
+    quit('Create a frame_cache.FrameCache() and pass it to svg_to_webm.svg_to_webm()')
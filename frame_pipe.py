@@ -0,0 +1,179 @@
+import collections
+import os
+import subprocess
+import threading
+
+
+def imap_bounded(pool, function, tasks, max_in_flight):
+    """ Apply function to each task in a multiprocessing Pool, yielding results in task order.
+
+    Unlike Pool.imap, at most max_in_flight tasks are submitted whose results have not yet been consumed, so memory
+    use does not grow with the number of tasks when the consumer is slower than the pool.
+
+    :param pool: a multiprocessing Pool or ThreadPool
+    :param function: the function to apply to each task
+    :param tasks: iterable of single arguments to function
+    :param max_in_flight: maximum number of results to hold at once
+    :return: a generator of results, in the same order as tasks
+    """
+    if max_in_flight < 1:
+        raise Exception('frame_pipe: Invalid max_in_flight: ' + str(max_in_flight))
+
+    pending = collections.deque()
+    for task in tasks:
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(function, (task,)))
+
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+
+def read_frame_files(directory, file_names):
+    """ Read a sequence of frame files, for passing to stream_frames_to_ffmpeg()
+
+    :param directory: the directory containing the files
+    :param file_names: the names of the files, in order
+    :return: a generator of the contents of each file as bytes, in order
+    """
+    for file_name in file_names:
+        with open(os.path.join(directory, file_name), 'rb') as frame_file:
+            yield frame_file.read()
+
+
+def pipe_input_args(frame_rate, raw_frame_size=None):
+    """ Get the ffmpeg input arguments for reading a sequence of frames from stdin
+
+    :param frame_rate: the frame rate of the input sequence
+    :param raw_frame_size: (width, height) if frames are raw rgb24 bytes; None if frames are png file contents
+    :return: a list of ffmpeg arguments
+    """
+    if raw_frame_size is None:
+        return ['-r', str(frame_rate), '-f', 'image2pipe', '-c:v', 'png', '-i', '-']
+
+    return ['-r', str(frame_rate), '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+            '-s', '%dx%d' % tuple(raw_frame_size), '-i', '-']
+
+
+def progress_args(progress_callback):
+    """ Get the ffmpeg arguments that report progress on stdout, if there is a progress callback
+
+    :param progress_callback: a function of a dict of progress values, or None
+    :return: a list of ffmpeg arguments, empty if progress_callback is None
+    """
+    if progress_callback is None:
+        return []
+
+    # Parameters:
+    #   -progress pipe:1   Write key=value progress reports to stdout, each ending with a 'progress' key
+    #   -nostats           Don't also print the usual progress line to stderr
+    return ['-progress', 'pipe:1', '-nostats']
+
+
+def read_progress(stream, progress_callback):
+    """ Parse ffmpeg -progress output until it ends, calling progress_callback with each complete report
+
+    :param stream: ffmpeg's stdout, in binary mode
+    :param progress_callback: a function of a dict of progress values, e.g. {'frame': 120, 'fps': 31.5, ...,
+                              'progress': 'continue'}, with numeric values converted to numbers
+    """
+    progress = {}
+    for line in iter(stream.readline, b''):
+        key, _, value = line.decode('utf-8', 'replace').strip().partition('=')
+        if key == '':
+            continue
+        for convert in [int, float]:
+            try:
+                value = convert(value)
+                break
+            except ValueError:
+                pass
+        progress[key] = value
+        if key == 'progress':
+            progress_callback(progress)
+            progress = {}
+
+
+def start_progress_reader(process, progress_callback):
+    """ Read the progress reports of an ffmpeg process in a background thread, if there is a progress callback
+
+    :param process: a subprocess.Popen of ffmpeg, with stdout=PIPE if progress_callback is not None
+    :param progress_callback: a function of a dict of progress values, or None
+    :return: the thread, to be joined once ffmpeg exits, or None
+    """
+    if progress_callback is None:
+        return None
+    thread = threading.Thread(target=read_progress, args=(process.stdout, progress_callback))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def run_ffmpeg(ffmpeg_command, cwd, progress_callback=None):
+    """ Run an ffmpeg command to completion, optionally reporting its progress
+
+    :param ffmpeg_command: the ffmpeg command, as a list starting with 'ffmpeg'
+    :param cwd: the directory in which to run ffmpeg
+    :param progress_callback: a function called with a dict of progress values, e.g. frame and fps, about twice a
+                              second while ffmpeg runs (default None)
+    :return: the ffmpeg return code
+    """
+    ffmpeg_command = ffmpeg_command[:1] + progress_args(progress_callback) + ffmpeg_command[1:]
+    process = subprocess.Popen(ffmpeg_command, cwd=cwd,
+                               stdout=open(os.devnull, 'w') if progress_callback is None else subprocess.PIPE,
+                               stderr=open(os.devnull, 'w'))
+    reader = start_progress_reader(process, progress_callback)
+    process.wait()
+    if reader is not None:
+        reader.join()
+    return process.returncode
+
+
+def stream_frames_to_ffmpeg(frames, frame_rate, output_args, cwd, raw_frame_size=None, progress_callback=None):
+    """ Encode a sequence of frames by writing them, in order, to the stdin of a single ffmpeg process
+
+    :param frames: iterable of bytes, each either a png file's contents or a raw rgb24 frame
+    :param frame_rate: the frame rate of the movie
+    :param output_args: ffmpeg arguments following the input, e.g. codec options and the output file name
+    :param cwd: the directory in which to run ffmpeg
+    :param raw_frame_size: (width, height) if frames are raw rgb24 bytes (default None, meaning png)
+    :param progress_callback: a function called with a dict of progress values, as for run_ffmpeg() (default None)
+    :return: the number of frames written
+
+    :raise Exception: if ffmpeg exits before all frames are written, or exits with an error
+    """
+    ffmpeg_command = ['ffmpeg', '-v', '0'] + progress_args(progress_callback) + \
+        pipe_input_args(frame_rate, raw_frame_size) + output_args
+
+    process = subprocess.Popen(ffmpeg_command, cwd=cwd, stdin=subprocess.PIPE,
+                               stdout=open(os.devnull, 'w') if progress_callback is None else subprocess.PIPE,
+                               stderr=open(os.devnull, 'w'))
+    reader = start_progress_reader(process, progress_callback)
+    num_frames = 0
+    try:
+        for frame in frames:
+            process.stdin.write(frame)
+            num_frames += 1
+        process.stdin.close()
+    except (IOError, OSError):
+        raise Exception('frame_pipe: ffmpeg exited after ' + str(num_frames) + ' frames: ' + ' '.join(ffmpeg_command))
+    finally:
+        # If anything went wrong producing frames, don't leave ffmpeg waiting for more
+        if not process.stdin.closed:
+            process.kill()
+            try:
+                process.stdin.close()
+            except (IOError, OSError):
+                pass
+        process.wait()
+        if reader is not None:
+            reader.join()
+
+    if process.returncode != 0:
+        raise Exception('frame_pipe: ffmpeg returned ' + str(process.returncode) + ': ' + ' '.join(ffmpeg_command))
+
+    return num_frames
+
+
+if __name__ == '__main__':
+    quit('Call frame_pipe.stream_frames_to_ffmpeg()')
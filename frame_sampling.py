@@ -0,0 +1,88 @@
+import math
+
+# Ways of choosing which frames to keep: evenly spaced, or biased towards frames that differ most from their predecessor
+SAMPLING_MODES = ['even', 'keyframe']
+
+
+def num_frames_needed(duration, max_fps):
+    """ The number of frames needed for a movie of a given duration at no more than a given frame rate
+
+    :param duration: the duration of the movie in seconds
+    :param max_fps: the maximum frame rate
+    :return: the number of frames, at least 1
+    """
+    return max(1, int(math.floor(duration * max_fps)))
+
+
+def sample_frames(frame_names, duration, max_fps, mode='even', frame_sizes=None):
+    """ Choose, before any rasterisation, the subset of a sequence of frames needed for a movie of a given duration at
+    no more than max_fps, so that the work done scales with the length of the movie rather than of the simulation.
+
+    The first and last frames are always kept, and the frames kept are in their original order.
+
+    :param frame_names: the full, ordered list of frame file names
+    :param duration: the duration of the movie in seconds
+    :param max_fps: the maximum frame rate of the movie, or None to keep every frame
+    :param mode: one of SAMPLING_MODES: 'even' keeps evenly spaced frames; 'keyframe' divides the sequence into as many
+                 equal windows as frames are needed and keeps, from each, the frame whose file size changes most from
+                 its predecessor's, a cheap proxy for the frame where most happens (default 'even')
+    :param frame_sizes: the size in bytes of each frame file, required for mode 'keyframe' (default None)
+    :return: the list of frame file names to keep
+
+    :raise Exception: if mode is not one of SAMPLING_MODES, or max_fps is not > 0
+    :raise Exception: if mode is 'keyframe' and frame_sizes does not give a size for each frame
+    """
+    if mode not in SAMPLING_MODES:
+        raise Exception('frame_sampling: Invalid mode: ' + str(mode))
+
+    if max_fps is None:
+        return list(frame_names)
+
+    if max_fps <= 0:
+        raise Exception('frame_sampling: Invalid max_fps: ' + str(max_fps))
+
+    num_needed = num_frames_needed(duration, max_fps)
+    num_frames = len(frame_names)
+    if num_frames <= num_needed:
+        return list(frame_names)
+
+    if num_needed == 1:
+        return [frame_names[0]]
+
+    if mode == 'even':
+        indices = [int(round(i * float(num_frames - 1) / (num_needed - 1))) for i in range(num_needed)]
+    else:
+        if frame_sizes is None or len(frame_sizes) != num_frames:
+            raise Exception('frame_sampling: keyframe sampling needs the size of each frame')
+        indices = keyframe_indices(frame_sizes, num_needed)
+
+    return [frame_names[i] for i in indices]
+
+
+def keyframe_indices(frame_sizes, num_needed):
+    """ Choose num_needed frame indices, one from each of num_needed equal windows, preferring within each window the
+    frame whose size changes most from its predecessor's
+
+    :param frame_sizes: the size in bytes of each frame file
+    :param num_needed: the number of frames to keep, at least 2 and less than len(frame_sizes)
+    :return: a sorted list of indices, starting at 0 and ending at the last frame
+    """
+    num_frames = len(frame_sizes)
+    changes = [0] + [abs(frame_sizes[i] - frame_sizes[i - 1]) for i in range(1, num_frames)]
+
+    indices = []
+    for window in range(num_needed):
+        start = int(round(window * float(num_frames) / num_needed))
+        end = int(round((window + 1) * float(num_frames) / num_needed))
+        if window == 0:
+            indices.append(0)
+        elif window == num_needed - 1:
+            indices.append(num_frames - 1)
+        else:
+            # Ties go to the earliest frame in the window
+            indices.append(max(range(start, end), key=lambda i: (changes[i], -i)))
+    return indices
+
+
+if __name__ == '__main__':
+    quit('Pass max_fps to svg_to_webm.svg_to_webm() or png_to_mp4.png_to_mp4()')
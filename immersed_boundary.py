@@ -1,11 +1,34 @@
+import multiprocessing
 import os
 import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import encode_profiles
+import frame_pipe
+import frame_sampling
+import pvd_index
 
 try:
     import paraview.simple as pv
 except ImportError:
     print("Py: ParaView module not imported - is ParaView in the python path?")
 
+# Scratch space for frames in transit, memory-backed where available
+SCRATCH_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# Name of the file, in the frame directory of pvd_to_mp4_parallel(), listing the index of each time step to render
+TIME_STEPS_FILE = 'time_steps.txt'
+
+# Seconds between checks on the pvpython workers of pvd_to_mp4_parallel()
+WORKER_POLL_INTERVAL = 0.1
+
+# Size in pixels of the frames drawn by pvd_to_mp4_matplotlib(), as ParaView renders them for pvd_to_mp4()
+MATPLOTLIB_FRAME_SIZE = (1600, 900)
+
 
 def pvd_to_mp4(sim_dir, path_to_movies, movie_name='movie', representation='Surface', num_regions=0):
 
@@ -16,6 +39,449 @@ def pvd_to_mp4(sim_dir, path_to_movies, movie_name='movie', representation='Surf
     if not (os.path.isdir(sim_dir)):
         raise Exception('pvd_to_mp4: Invalid simulation directory')
 
+    validate_movie_options(path_to_movies, representation, num_regions)
+
+    # sim_id = os.path.basename(os.path.normpath(sim_dir))
+
+    # From the results directory with the numerically latest start time, not the alphabetically last as before
+    pvd_file = find_pvd_file(sim_dir)
+
+    full_movie_path = os.path.join(path_to_movies, movie_name + '_' + representation + '.mp4')
+
+    ##################################
+    # Set up scene with box and data #
+    ##################################
+
+    render_view, results_pvd = set_up_scene(pvd_file, representation, num_regions)
+
+    ##################################
+    # Set up and write the animation #
+    ##################################
+
+    # Get an animation scene, which has parameters we need to change before output
+    animation_scene = pv.GetAnimationScene()
+
+    # Get a list of time step values from the pvd file.  Typically this will look like [t_0, t1, t2, ..., t_end]
+    time_step_info = results_pvd.TimestepValues
+    num_time_steps = len(time_step_info)
+
+    # Set the animation parameters
+    animation_scene.NumberOfFrames = num_time_steps  # If num frames != num time steps, some interpolation will be used
+    animation_scene.StartTime = time_step_info[0]    # Usually t_0, the first entry in time_step_info
+    animation_scene.EndTime = time_step_info[-1]     # Usually t_end, the final entry in time_step_info
+
+    # Write the animation as a series of uncompressed png files, with no magnification
+    pv.WriteAnimation(sim_dir + 'results_' + representation + '.png', Magnification=1, Compression=False)
+
+    # Raise exception if the png files are not generated as expected
+    if not(os.path.isfile(sim_dir + 'results_' + representation + '.0000.png')):
+        raise Exception('pvd_to_mp4: png sequence not exported as expected')
+
+    #######################################
+    # Convert from png to mp4 and tidy up #
+    #######################################
+
+    # Ubuntu 14.04 (trusty) came bundled with avconv instead of ffmpeg, but they're nearly the same software
+    # so we don't have to change the command other than the name of the video converter to use
+    if platform.linux_distribution()[2] == 'trusty':
+        video_converter = 'avconv'
+    else:
+        video_converter = 'ffmpeg'
+
+    # Set how long you want the video to be (in seconds), and set the frame rate accordingly
+    video_duration = 15.0
+    frame_rate = str(num_time_steps / video_duration)
+
+    # Send the system command to run avconv/ffmpeg. Parameters:
+    #   -v 0                        Suppress console output so as not to clutter the terminal
+    #   -r frame_rate               Set the frame rate calculated above
+    #   -f image2                   Set the convert format (image sequence to video)
+    #   -i dir/results.%04d.png     Input expected as dir/results.####.png, the output from WriteAnimation above
+    #   -c:v h264                   Video codec to use is h264
+    #   -crf 0                      Set video quality: 0 best, 51 worst (https://trac.ffmpeg.org/wiki/Encode/H.264)
+    #   -y dir/movie.mp4            Output directory and name
+    os.system(video_converter + ' -v 0 -r ' + frame_rate + ' -f image2 -i ' + sim_dir +
+              'results_' + representation + '.%04d.png -c:v h264 -crf 0 -y ' + full_movie_path)
+
+    validate_movie(full_movie_path)
+
+    # Clean up the png files created by WriteAnimation
+    os.system('rm ' + sim_dir + '*.png')
+
+
+def pvd_to_mp4_batch(sim_dirs, path_to_movies, representation='Surface', num_regions=0, movie_duration=15.0,
+                     profile=encode_profiles.DEFAULT_PROFILE, ffmpeg_threads=None, max_fps=None, sampling='even',
+                     print_progress=False):
+    """ Make a movie of each of several simulation directories in a single ParaView session.
+
+    The scene, with its view, colour maps and glyphs, is set up once.  Each simulation is then rendered by pointing
+    the pvd reader at its results, so ParaView's start-up and pipeline set-up are paid once for the whole batch.  Each
+    frame is rendered to a scratch png in memory-backed storage where available, and piped straight into ffmpeg, so no
+    png sequence is written to the simulation directory.
+
+    Every directory's pvd file is read, and its vtu files checked, before ParaView renders anything, and a directory
+    that fails does not stop the rest of the batch.
+
+    :param sim_dirs: list of simulation directories, each containing a results_from_time_X directory
+    :param path_to_movies: the directory in which to write the movies, each named after the last component of its
+                           simulation directory
+    :param representation: 'Surface' or 'Points' (default 'Surface')
+    :param num_regions: 0, or 9 to colour by node and cell region (default 0)
+    :param movie_duration: required duration in seconds for each movie (default 15.0)
+    :param profile: one of encode_profiles.PROFILES (default encode_profiles.DEFAULT_PROFILE)
+    :param ffmpeg_threads: number of threads ffmpeg may use (default None, meaning ffmpeg's own choice)
+    :param max_fps: if given, render only as many time steps as a movie of movie_duration needs at this frame rate
+                    (default None, meaning every time step)
+    :param sampling: one of frame_sampling.SAMPLING_MODES (default 'even')
+    :param print_progress: whether to print running trace of this function (default False)
+    :return: a list of the paths of the movies made, in the order of sim_dirs
+
+    :raise Exception: if path_to_movies, representation, num_regions or sampling is invalid
+    :raise Exception: if any simulation directory fails, or has the same last component as an earlier one, after the
+                      rest of the batch has been made
+    """
+    validate_movie_options(path_to_movies, representation, num_regions)
+
+    if profile not in encode_profiles.PROFILES:
+        raise Exception('pvd_to_mp4: Invalid profile: ' + str(profile))
+
+    if sampling not in frame_sampling.SAMPLING_MODES:
+        raise Exception('pvd_to_mp4: Invalid sampling: ' + str(sampling))
+
+    # Find and check every pvd file before starting, so that the scene can be set up with the first.  Each movie is
+    # named after the last component of its simulation directory, so directories sharing that name would overwrite
+    # each other's movie: only the first of them is made
+    pvd_files = []
+    failures = []
+    movie_names = {}
+    for sim_dir in sim_dirs:
+        movie_name = os.path.basename(os.path.normpath(sim_dir)) + '_' + representation + '.mp4'
+        if movie_name in movie_names:
+            failures.append(sim_dir + ': ' + movie_name + ' is also the movie of ' + movie_names[movie_name])
+            continue
+        movie_names[movie_name] = sim_dir
+
+        try:
+            pvd_file = find_pvd_file(sim_dir)
+            pvd_files.append((sim_dir, pvd_file, plan_time_steps(pvd_file, movie_duration, max_fps, sampling)))
+        except Exception as e:
+            failures.append(sim_dir + ': ' + str(e))
+
+    movie_paths = []
+    if len(pvd_files) > 0:
+        render_view, results_pvd = set_up_scene(pvd_files[0][1], representation, num_regions)
+        animation_scene = pv.GetAnimationScene()
+        scratch_dir = tempfile.mkdtemp(prefix='pvd_to_mp4_', dir=SCRATCH_DIR)
+
+        try:
+            for idx, (sim_dir, pvd_file, time_step_indices) in enumerate(pvd_files):
+                # ffmpeg runs in path_to_movies, so the movie's path must not be relative to the current directory
+                sim_id = os.path.basename(os.path.normpath(sim_dir))
+                full_movie_path = os.path.join(os.path.abspath(path_to_movies), sim_id + '_' + representation + '.mp4')
+
+                if print_progress:
+                    print('pvd_to_mp4: Rendering ' + str(idx + 1) + ' of ' + str(len(pvd_files)) + ': ' + sim_dir)
+
+                try:
+                    # Swap the data under the existing pipeline; the glyphs and colouring follow the reader
+                    results_pvd.FileName = pvd_file
+                    results_pvd.UpdatePipelineInformation()
+                    animation_scene.UpdateAnimationUsingDataTimeSteps()
+                    time_step_info = [results_pvd.TimestepValues[i] for i in time_step_indices]
+
+                    frame_rate = max(float(len(time_step_info)) / movie_duration, 1.0)
+                    output_args = encode_profiles.output_args([(profile, full_movie_path)], threads=ffmpeg_threads)
+                    frame_pipe.stream_frames_to_ffmpeg(
+                        frames=render_frames(render_view, animation_scene, time_step_info, scratch_dir),
+                        frame_rate=frame_rate, output_args=output_args, cwd=path_to_movies)
+
+                    validate_movie(full_movie_path)
+                    movie_paths.append(full_movie_path)
+                except Exception as e:
+                    # Don't leave a truncated movie behind
+                    if os.path.isfile(full_movie_path):
+                        os.remove(full_movie_path)
+                    failures.append(sim_dir + ': ' + str(e))
+                    if print_progress:
+                        print('\t... failed: ' + str(e))
+        finally:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    if len(failures) > 0:
+        raise Exception('pvd_to_mp4: Failed to make ' + str(len(failures)) + ' of ' + str(len(sim_dirs)) +
+                        ' movies: ' + '; '.join(failures))
+
+    return movie_paths
+
+
+def pvd_to_mp4_parallel(sim_dir, path_to_movies, movie_name='movie', representation='Surface', num_regions=0,
+                        num_workers=None, movie_duration=15.0, profile=encode_profiles.DEFAULT_PROFILE,
+                        ffmpeg_threads=None, pvpython='pvpython', max_fps=None, sampling='even', print_progress=False):
+    """ Make a movie of a simulation by rendering its time steps in several independent pvpython processes at once.
+
+    The time steps to render are planned, and their vtu files checked, from the pvd file alone before any worker
+    starts.  Worker i of n then renders frames i, i + n, i + 2n, ..., so that each worker gets a similar share of the
+    early and late time steps, writing each as %04d.png numbered by its frame index into a frame directory that is
+    removed once the movie has been made.
+
+    :param sim_dir: the simulation directory, containing a results_from_time_X directory
+    :param path_to_movies: the directory in which to write the movie
+    :param movie_name: the movie is named movie_name_representation.mp4 (default 'movie')
+    :param representation: 'Surface' or 'Points' (default 'Surface')
+    :param num_regions: 0, or 9 to colour by node and cell region (default 0)
+    :param num_workers: number of pvpython processes to render with (default None, meaning one per core)
+    :param movie_duration: required duration in seconds for the movie (default 15.0)
+    :param profile: one of encode_profiles.PROFILES (default encode_profiles.DEFAULT_PROFILE)
+    :param ffmpeg_threads: number of threads ffmpeg may use (default None, meaning ffmpeg's own choice)
+    :param pvpython: the pvpython executable with which to run each worker (default 'pvpython')
+    :param max_fps: if given, render only as many time steps as a movie of movie_duration needs at this frame rate
+                    (default None, meaning every time step)
+    :param sampling: one of frame_sampling.SAMPLING_MODES (default 'even')
+    :param print_progress: whether to print running trace of this function (default False)
+    :return: the path of the movie
+
+    :raise Exception: if sim_dir, path_to_movies, representation, num_regions, num_workers or sampling is invalid
+    :raise Exception: if any vtu file is missing or truncated
+    :raise Exception: if any worker fails, or ffmpeg fails to make the movie
+    """
+    if not (os.path.isdir(sim_dir)):
+        raise Exception('pvd_to_mp4: Invalid simulation directory')
+
+    validate_movie_options(path_to_movies, representation, num_regions)
+
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+
+    if num_workers < 1:
+        raise Exception('pvd_to_mp4: Invalid num_workers: ' + str(num_workers))
+
+    if profile not in encode_profiles.PROFILES:
+        raise Exception('pvd_to_mp4: Invalid profile: ' + str(profile))
+
+    if sampling not in frame_sampling.SAMPLING_MODES:
+        raise Exception('pvd_to_mp4: Invalid sampling: ' + str(sampling))
+
+    pvd_file = find_pvd_file(sim_dir)
+    time_step_indices = plan_time_steps(pvd_file, movie_duration, max_fps, sampling)
+    full_movie_path = os.path.join(os.path.abspath(path_to_movies), movie_name + '_' + representation + '.mp4')
+
+    # There is no use for more workers than frames
+    num_workers = min(num_workers, len(time_step_indices))
+
+    # The directory name starts with '.' so that, should it be left behind, it is not swept into res_arch
+    frame_dir = tempfile.mkdtemp(prefix='.frames_', dir=sim_dir)
+    try:
+        with open(os.path.join(frame_dir, TIME_STEPS_FILE), 'w') as time_steps_file:
+            time_steps_file.write(''.join(str(i) + '\n' for i in time_step_indices))
+
+        # Each worker runs this module as a script, rendering its share of the time steps
+        worker_commands = [[pvpython, os.path.abspath(__file__), pvd_file, representation, str(num_regions), frame_dir,
+                            str(worker_index), str(num_workers)] for worker_index in range(num_workers)]
+
+        if print_progress:
+            print('pvd_to_mp4: Rendering ' + pvd_file + ' with ' + str(num_workers) + ' pvpython processes')
+
+        workers = [subprocess.Popen(worker_command, stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+                   for worker_command in worker_commands]
+        try:
+            # Poll every worker, rather than waiting for each in turn, so that a failure is noticed as soon as it
+            # happens, and the other workers are then killed rather than left to render frames that will not be used
+            failures = []
+            running = list(range(num_workers))
+            while len(running) > 0 and len(failures) == 0:
+                time.sleep(WORKER_POLL_INTERVAL)
+                for worker_index in list(running):
+                    if workers[worker_index].poll() is None:
+                        continue
+                    running.remove(worker_index)
+                    if workers[worker_index].returncode != 0:
+                        failures.append('worker ' + str(worker_index) + ' returned ' +
+                                        str(workers[worker_index].returncode))
+                    elif print_progress:
+                        print('\t... worker ' + str(worker_index + 1) + ' of ' + str(num_workers) + ' finished')
+        finally:
+            # Don't leave workers running if anything went wrong
+            for worker in workers:
+                if worker.poll() is None:
+                    worker.kill()
+                    worker.wait()
+
+        if len(failures) > 0:
+            raise Exception('pvd_to_mp4: Failed to render ' + pvd_file + ': ' + '; '.join(failures))
+
+        num_frames = len([name for name in os.listdir(frame_dir) if name.endswith('.png')])
+        if num_frames != len(time_step_indices):
+            raise Exception('pvd_to_mp4: png sequence not exported as expected')
+
+        # Set how long you want the video to be (in seconds), and set the frame rate accordingly
+        frame_rate = max(float(num_frames) / movie_duration, 1.0)
+
+        # Parameters, as for pvd_to_mp4(), reading the png sequence written by the workers
+        ffmpeg_command = ['ffmpeg',
+                          '-v', '0',
+                          '-r', str(frame_rate),
+                          '-f', 'image2',
+                          '-i', '%04d.png'] + \
+            encode_profiles.output_args([(profile, full_movie_path)], threads=ffmpeg_threads)
+
+        if print_progress:
+            print('pvd_to_mp4: Creating mp4 from ' + str(num_frames) + ' frames: ' + ' '.join(ffmpeg_command))
+
+        frame_pipe.run_ffmpeg(ffmpeg_command, cwd=frame_dir)
+    finally:
+        shutil.rmtree(frame_dir, ignore_errors=True)
+
+    validate_movie(full_movie_path)
+
+    return full_movie_path
+
+
+def pvd_to_mp4_matplotlib(sim_dir, path_to_movies, movie_name='movie', representation='Surface', num_regions=0,
+                          movie_duration=15.0, profile=encode_profiles.DEFAULT_PROFILE, ffmpeg_threads=None,
+                          max_fps=None, sampling='even', print_progress=False):
+    """ Make a movie of a simulation without ParaView, reading its vtu files with numpy and drawing them with
+    matplotlib's Agg renderer, as vtu_render does.  The movie matches that of pvd_to_mp4(): the same view of the unit
+    square, drawn as points or glyphs, and coloured by region if num_regions is 9.
+
+    Frames are streamed as raw rgb24 to a single ffmpeg process, so no png is written.
+
+    :param sim_dir: the simulation directory, containing a results_from_time_X directory
+    :param path_to_movies: the directory in which to write the movie
+    :param movie_name: the movie is named movie_name_representation.mp4 (default 'movie')
+    :param representation: 'Surface' or 'Points' (default 'Surface')
+    :param num_regions: 0, or 9 to colour by node and cell region (default 0)
+    :param movie_duration: required duration in seconds for the movie (default 15.0)
+    :param profile: one of encode_profiles.PROFILES (default encode_profiles.DEFAULT_PROFILE)
+    :param ffmpeg_threads: number of threads ffmpeg may use (default None, meaning ffmpeg's own choice)
+    :param max_fps: if given, render only as many time steps as a movie of movie_duration needs at this frame rate
+                    (default None, meaning every time step)
+    :param sampling: one of frame_sampling.SAMPLING_MODES (default 'even')
+    :param print_progress: whether to print running trace of this function (default False)
+    :return: the path of the movie
+
+    :raise Exception: if sim_dir, path_to_movies, representation, num_regions, profile or sampling is invalid
+    :raise Exception: if any vtu file is missing, truncated or cannot be read
+    :raise Exception: if ffmpeg fails to make the movie
+    """
+    if not (os.path.isdir(sim_dir)):
+        raise Exception('pvd_to_mp4: Invalid simulation directory')
+
+    validate_movie_options(path_to_movies, representation, num_regions)
+
+    if profile not in encode_profiles.PROFILES:
+        raise Exception('pvd_to_mp4: Invalid profile: ' + str(profile))
+
+    if sampling not in frame_sampling.SAMPLING_MODES:
+        raise Exception('pvd_to_mp4: Invalid sampling: ' + str(sampling))
+
+    # numpy and matplotlib are only needed by this function, so are imported here
+    import vtu_render
+
+    pvd_file = find_pvd_file(sim_dir)
+    time_step_indices = plan_time_steps(pvd_file, movie_duration, max_fps, sampling)
+    time_steps = pvd_index.read_pvd(pvd_file)
+    full_movie_path = os.path.join(os.path.abspath(path_to_movies), movie_name + '_' + representation + '.mp4')
+
+    # Set how long you want the video to be (in seconds), and set the frame rate accordingly
+    frame_rate = max(float(len(time_step_indices)) / movie_duration, 1.0)
+    output_args = encode_profiles.output_args([(profile, full_movie_path)], threads=ffmpeg_threads)
+
+    if print_progress:
+        print('pvd_to_mp4: Rendering ' + str(len(time_step_indices)) + ' time steps of ' + pvd_file +
+              ' with matplotlib')
+
+    try:
+        frame_pipe.stream_frames_to_ffmpeg(
+            frames=vtu_render.render_frames([time_steps[i] for i in time_step_indices], representation=representation,
+                                            num_regions=num_regions, frame_size=MATPLOTLIB_FRAME_SIZE),
+            frame_rate=frame_rate, output_args=output_args, cwd=path_to_movies, raw_frame_size=MATPLOTLIB_FRAME_SIZE)
+        validate_movie(full_movie_path)
+    except Exception:
+        # Don't leave a truncated movie behind
+        if os.path.isfile(full_movie_path):
+            os.remove(full_movie_path)
+        raise
+
+    return full_movie_path
+
+
+def render_time_steps(pvd_file, representation, num_regions, frame_dir, worker_index=0, num_workers=1,
+                      time_step_indices=None):
+    """ Render every num_workers'th of a list of time steps of a pvd file, starting from worker_index, to png files in
+    frame_dir named %04d.png by position in the list.  This is the work of one worker process of
+    pvd_to_mp4_parallel().
+
+    :param pvd_file: the pvd file to render
+    :param representation: 'Surface' or 'Points'
+    :param num_regions: 0, or 9 to colour by node and cell region
+    :param frame_dir: the directory in which to write the png files
+    :param worker_index: the index of this worker (default 0)
+    :param num_workers: the total number of workers (default 1)
+    :param time_step_indices: indices of the time steps to render (default None, meaning every time step)
+    :return: the number of frames rendered
+    """
+    render_view, results_pvd = set_up_scene(pvd_file, representation, num_regions)
+
+    animation_scene = pv.GetAnimationScene()
+    animation_scene.UpdateAnimationUsingDataTimeSteps()
+
+    time_step_info = list(results_pvd.TimestepValues)
+    if time_step_indices is None:
+        time_step_indices = list(range(len(time_step_info)))
+
+    frame_indices = range(worker_index, len(time_step_indices), num_workers)
+    for idx in frame_indices:
+        animation_scene.AnimationTime = time_step_info[time_step_indices[idx]]
+        pv.SaveScreenshot(os.path.join(frame_dir, str(idx).zfill(4) + '.png'), render_view)
+
+    return len(frame_indices)
+
+
+def plan_time_steps(pvd_file, movie_duration, max_fps=None, sampling='even'):
+    """ Choose the time steps of a pvd file to render, reading only the pvd file, and check their vtu files
+
+    :param pvd_file: the pvd file
+    :param movie_duration: required duration in seconds for the movie
+    :param max_fps: the maximum frame rate of the movie (default None, meaning every time step)
+    :param sampling: one of frame_sampling.SAMPLING_MODES (default 'even')
+    :return: a sorted list of indices into the pvd file's time steps
+
+    :raise Exception: if the pvd file has no time steps, or any vtu file to render is missing or truncated
+    """
+    time_steps = pvd_index.read_pvd(pvd_file)
+    if len(time_steps) == 0:
+        raise Exception('pvd_to_mp4: No time steps found in ' + pvd_file)
+
+    time_step_indices = pvd_index.sample_time_steps(time_steps, movie_duration, max_fps, sampling)
+
+    problems = pvd_index.check_vtu_files([time_steps[i] for i in time_step_indices])
+    if len(problems) > 0:
+        raise Exception('pvd_to_mp4: ' + str(len(problems)) + ' vtu files not usable, e.g. ' + problems[0])
+
+    return time_step_indices
+
+
+def render_frames(render_view, animation_scene, time_step_info, scratch_dir):
+    """ Render the scene at each time step, yielding the png contents of each frame in order
+
+    :param render_view: the render view set up by set_up_scene()
+    :param animation_scene: the ParaView animation scene, whose time sets the time step shown
+    :param time_step_info: the list of time step values to render
+    :param scratch_dir: the directory in which to write each frame before it is read back and deleted
+    :return: a generator of png file contents as bytes, one per time step
+    """
+    png_path = os.path.join(scratch_dir, 'frame.png')
+    for time_step in time_step_info:
+        animation_scene.AnimationTime = time_step
+        pv.SaveScreenshot(png_path, render_view)
+        with open(png_path, 'rb') as png_file:
+            png_bytes = png_file.read()
+        os.remove(png_path)
+        yield png_bytes
+
+
+def validate_movie_options(path_to_movies, representation, num_regions):
+
     if not (os.path.isdir(path_to_movies)):
         raise Exception('pvd_to_mp4: Invalid movie directory')
 
@@ -25,18 +491,26 @@ def pvd_to_mp4(sim_dir, path_to_movies, movie_name='movie', representation='Surf
     if num_regions not in [0, 9]:
         raise Exception('pvd_to_mp4: Currently there is only support for 9 node regions')
 
-    # sim_id = os.path.basename(os.path.normpath(sim_dir))
 
-    possible_data_directories = []
-    for directory in os.listdir(sim_dir):
-        if directory.startswith('results_from_time'):
-            possible_data_directories.append(os.path.join(sim_dir, directory))
+def find_pvd_file(sim_dir):
+    """ Find the pvd file of the simulation, in the results_from_time_X directory with the latest start time X.
 
-    if len(possible_data_directories) == 0:
-        raise Exception('pvd_to_mp4: Could not find a "results_from_time_X" directory')
+    Start times are compared as numbers, so results_from_time_10 is chosen over results_from_time_9, and only
+    directories named results_from_time_ followed by a number are considered.  This differs from choosing the last
+    name in alphabetical order of anything beginning results_from_time, as pvd_to_mp4() once did, which would have
+    chosen results_from_time_9.
+
+    :param sim_dir: the directory containing the simulation output
+    :return: the path of the pvd file
 
-    # The last directory alphabetically will be the one after any initial relaxation simulation
-    data_directory = sorted(possible_data_directories)[-1]
+    :raise Exception: if there is no results_from_time_X directory, or it has no pvd file
+    :raise Exception: if the pvd file is < 1kb
+    """
+    # The directory with the latest start time will be the one after any initial relaxation simulation
+    data_directory = pvd_index.find_results_directory(sim_dir)
+
+    if data_directory is None:
+        raise Exception('pvd_to_mp4: Could not find a "results_from_time_X" directory')
 
     # Get the location of the pvd file
     pvd_file = os.path.join(data_directory, 'results.pvd')
@@ -46,11 +520,10 @@ def pvd_to_mp4(sim_dir, path_to_movies, movie_name='movie', representation='Surf
     if os.path.getsize(pvd_file) < 1024:
         raise Exception('pvd_to_mp4: pvd file exists but is < 1kb. Presumably simulation failed to finish as expected.')
 
-    full_movie_path = os.path.join(path_to_movies, movie_name + '_' + representation + '.mp4')
+    return pvd_file
 
-    ##################################
-    # Set up scene with box and data #
-    ##################################
+
+def set_up_scene(pvd_file, representation, num_regions):
 
     # Get active view. This is the ParaView default view - blue background with cross hairs and orientation axes
     render_view = pv.GetActiveViewOrCreate('RenderView')
@@ -135,54 +608,10 @@ def pvd_to_mp4(sim_dir, path_to_movies, movie_name='movie', representation='Surf
     # This parameter sets the 'zoom' and needs fine-tuning by the aspect ratio
     render_view.CameraParallelScale = 0.5 * 9.0 / 16.0
 
-    ##################################
-    # Set up and write the animation #
-    ##################################
-
-    # Get an animation scene, which has parameters we need to change before output
-    animation_scene = pv.GetAnimationScene()
-
-    # Get a list of time step values from the pvd file.  Typically this will look like [t_0, t1, t2, ..., t_end]
-    time_step_info = results_pvd.TimestepValues
-    num_time_steps = len(time_step_info)
-
-    # Set the animation parameters
-    animation_scene.NumberOfFrames = num_time_steps  # If num frames != num time steps, some interpolation will be used
-    animation_scene.StartTime = time_step_info[0]    # Usually t_0, the first entry in time_step_info
-    animation_scene.EndTime = time_step_info[-1]     # Usually t_end, the final entry in time_step_info
-
-    # Write the animation as a series of uncompressed png files, with no magnification
-    pv.WriteAnimation(sim_dir + 'results_' + representation + '.png', Magnification=1, Compression=False)
-
-    # Raise exception if the png files are not generated as expected
-    if not(os.path.isfile(sim_dir + 'results_' + representation + '.0000.png')):
-        raise Exception('pvd_to_mp4: png sequence not exported as expected')
-
-    #######################################
-    # Convert from png to mp4 and tidy up #
-    #######################################
-
-    # Ubuntu 14.04 (trusty) came bundled with avconv instead of ffmpeg, but they're nearly the same software
-    # so we don't have to change the command other than the name of the video converter to use
-    if platform.linux_distribution()[2] == 'trusty':
-        video_converter = 'avconv'
-    else:
-        video_converter = 'ffmpeg'
+    return render_view, results_pvd
 
-    # Set how long you want the video to be (in seconds), and set the frame rate accordingly
-    video_duration = 15.0
-    frame_rate = str(num_time_steps / video_duration)
 
-    # Send the system command to run avconv/ffmpeg. Parameters:
-    #   -v 0                        Suppress console output so as not to clutter the terminal
-    #   -r frame_rate               Set the frame rate calculated above
-    #   -f image2                   Set the convert format (image sequence to video)
-    #   -i dir/results.%04d.png     Input expected as dir/results.####.png, the output from WriteAnimation above
-    #   -c:v h264                   Video codec to use is h264
-    #   -crf 0                      Set video quality: 0 best, 51 worst (https://trac.ffmpeg.org/wiki/Encode/H.264)
-    #   -y dir/movie.mp4            Output directory and name
-    os.system(video_converter + ' -v 0 -r ' + frame_rate + ' -f image2 -i ' + sim_dir +
-              'results_' + representation + '.%04d.png -c:v h264 -crf 0 -y ' + full_movie_path)
+def validate_movie(full_movie_path):
 
     # Raise exception if the mp4 file is not generated as expected
     if not(os.path.isfile(full_movie_path)):
@@ -193,5 +622,16 @@ def pvd_to_mp4(sim_dir, path_to_movies, movie_name='movie', representation='Surf
     if os.path.getsize(full_movie_path) < 1024:
         raise Exception('pvd_to_mp4: mp4 not generated as expected')
 
-    # Clean up the png files created by WriteAnimation
-    os.system('rm ' + sim_dir + '*.png')
+
+if __name__ == '__main__':
+    # Worker processes of pvd_to_mp4_parallel() run this module as:
+    #   pvpython immersed_boundary.py pvd_file representation num_regions frame_dir worker_index num_workers
+    if len(sys.argv) != 7:
+        quit('Call immersed_boundary.pvd_to_mp4(), pvd_to_mp4_batch() or pvd_to_mp4_parallel() from pvpython')
+
+    with open(os.path.join(sys.argv[4], TIME_STEPS_FILE), 'r') as worker_time_steps_file:
+        worker_time_step_indices = [int(line) for line in worker_time_steps_file if line.strip()]
+
+    render_time_steps(pvd_file=sys.argv[1], representation=sys.argv[2], num_regions=int(sys.argv[3]),
+                      frame_dir=sys.argv[4], worker_index=int(sys.argv[5]), num_workers=int(sys.argv[6]),
+                      time_step_indices=worker_time_step_indices)
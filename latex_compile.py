@@ -0,0 +1,144 @@
+import hashlib
+import os
+import re
+import subprocess
+import time
+
+# Most pdflatex passes to make before giving up on the output converging, e.g. for references that oscillate between
+# pages
+MAX_PASSES = 5
+
+# Extensions of the files, other than the aux file, that pdflatex writes in one pass and reads back in the next
+TRACKED_EXTENSIONS = ['.bbl', '.toc', '.lof', '.lot', '.out']
+
+# Lines of an aux file that are read back by the next pass, or by bibtex, so that the output has converged once they
+# are unchanged by a pass.  Others, e.g. the page count of LaTeX's \gdef\@abspage@last, are written on the first pass
+# whatever the document, and would otherwise always cost a second pass
+AUX_PATTERN = re.compile(br'^\\(?:newlabel|bibcite|@writefile|citation|bibdata|bibstyle|@input)\b.*$', re.MULTILINE)
+
+# Lines of an aux file that bibtex reads
+CITATION_PATTERN = re.compile(br'^\\(?:citation|bibdata|bibstyle)\b.*$', re.MULTILINE)
+
+# Aux files of \include'd files, named in the main aux file
+INPUT_PATTERN = re.compile(br'^\\@input\{(.*)\}', re.MULTILINE)
+
+
+def read_aux(tex_dir, aux_filename, visited=None):
+    """ Read an aux file, with the aux files it names, for the lines that matter to the next pass
+
+    :param tex_dir: the directory containing the aux file
+    :param aux_filename: the aux file
+    :param visited: set of aux files already read, so that none is read twice (default None)
+    :return: a list of the lines matching AUX_PATTERN, empty if there is no aux file
+    """
+    if visited is None:
+        visited = set()
+    if aux_filename in visited:
+        return []
+    visited.add(aux_filename)
+
+    try:
+        with open(os.path.join(tex_dir, aux_filename), 'rb') as aux_file:
+            contents = aux_file.read()
+    except (IOError, OSError):
+        return []
+
+    lines = AUX_PATTERN.findall(contents)
+    for included_aux in INPUT_PATTERN.findall(contents):
+        lines += read_aux(tex_dir, included_aux.decode('utf-8'), visited)
+    return lines
+
+
+def file_hash(path):
+    """ The SHA1 hash of a file's contents, or None if there is no such file """
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+
+def compile_state(tex_dir, job_name):
+    """ The state, carried from one pass to the next, of a document being compiled
+
+    :param tex_dir: the directory in which the document is compiled
+    :param job_name: the name of the document, without extension
+    :return: a tuple of (a list of the hash of the aux lines read back and of each tracked file, the hash of the lines
+             bibtex reads, or None if the document has no bibliography)
+    """
+    aux_lines = read_aux(tex_dir, job_name + '.aux')
+    hashes = [hashlib.sha1(b'\n'.join(aux_lines)).hexdigest()]
+    hashes += [file_hash(os.path.join(tex_dir, job_name + extension)) for extension in TRACKED_EXTENSIONS]
+
+    citation_lines = [line for line in aux_lines if CITATION_PATTERN.match(line)]
+    if not any(line.startswith(b'\\bibdata') for line in citation_lines):
+        return hashes, None
+    return hashes, hashlib.sha1(b'\n'.join(citation_lines)).hexdigest()
+
+
+def compile_latex(tex_dir, tex_filename, latex_options=None, env=None, max_passes=MAX_PASSES, stop_on_error=True,
+                  print_progress=False):
+    """ Compile a latex document with as few pdflatex passes as it needs.  After each pass, bibtex is run only if the
+    citations have changed since it last ran, and no further pass is made once a pass leaves the aux lines read back,
+    and the .bbl, .toc, .lof, .lot and .out files, unchanged.  A document without cross-references takes one pass, one
+    with labels two, and one with a bibliography three, the last two after bibtex.
+
+    pdflatex never waits for input, so it can run unattended, e.g. in a worker.
+
+    :param tex_dir: the directory containing the document, in which pdflatex and bibtex run
+    :param tex_filename: the name of the document
+    :param latex_options: further options for pdflatex, e.g. ['-halt-on-error'] (default None)
+    :param env: the environment for pdflatex and bibtex (default None, meaning that of this process)
+    :param max_passes: the most pdflatex passes to make (default MAX_PASSES)
+    :param stop_on_error: whether to make no further pass after one that fails (default True)
+    :param print_progress: whether to print the time taken by each pass (default False)
+    :return: a dict of the 'return_code' of the last pdflatex pass, whether the output 'converged' within max_passes,
+             and the 'passes': a list of dicts with the 'command', 'seconds' and 'return_code' of each pdflatex and
+             bibtex run, in order
+    """
+    job_name = os.path.splitext(tex_filename)[0]
+
+    # Parameters:
+    #   -interaction=nonstopmode    Never wait for input
+    latex_command = ['pdflatex', '-interaction=nonstopmode'] + (latex_options or []) + [tex_filename]
+    bibtex_command = ['bibtex', job_name]
+
+    passes = []
+
+    def run(command):
+        start = time.time()
+        return_code = subprocess.call(command, cwd=tex_dir, env=env, stdin=open(os.devnull, 'r'),
+                                      stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+        passes.append({'command': command[0], 'seconds': time.time() - start, 'return_code': return_code})
+        if print_progress:
+            num_runs = len([run_pass for run_pass in passes if run_pass['command'] == command[0]])
+            print('latex_compile: %s %s pass %d in %.3fs' % (tex_filename, command[0], num_runs, passes[-1]['seconds']))
+        return return_code
+
+    # A bbl left by an earlier compile may be for other citations, so bibtex always runs once if there are any
+    bibtex_citations = None
+    return_code = None
+    converged = False
+
+    hashes, _ = compile_state(tex_dir, job_name)
+    for _ in range(max_passes):
+        return_code = run(latex_command)
+        if return_code != 0 and stop_on_error:
+            break
+
+        new_hashes, citations = compile_state(tex_dir, job_name)
+        if citations is not None and citations != bibtex_citations:
+            run(bibtex_command)
+            bibtex_citations = citations
+            new_hashes, _ = compile_state(tex_dir, job_name)
+
+        if new_hashes == hashes:
+            converged = True
+            break
+        hashes = new_hashes
+
+    return {'return_code': return_code, 'converged': converged, 'passes': passes}
+
+
+if __name__ == '__main__':
+    quit('Call latex_compile.compile_latex(), as csv_to_latex and latex_time_diff do')
@@ -1,8 +1,27 @@
+import bisect
 import datetime
+import hashlib
+import json
+import multiprocessing
+import multiprocessing.pool
 import os
 import re
+import shutil
 import subprocess
 import sys
+import tempfile
+import time
+
+import latex_compile
+
+# Directory, in the repository's git directory, in which the revision index of each file is cached
+INDEX_DIR = 'latex_time_diff'
+
+# Directory, in INDEX_DIR, in which compiled diffs are cached
+DIFF_CACHE_DIR = 'diffs'
+
+# Incremented whenever the contents of a cached revision index change, so that older indexes are ignored
+INDEX_VERSION = 1
 
 
 def print_usage():
@@ -11,157 +30,367 @@ def print_usage():
     print('Called with either a date in the past or a git SHA1 hash:')
     print('\t' + sys.argv[0] + ' <file_name.tex> YYYY-MM-DD')
     print('\t' + sys.argv[0] + ' <file_name.tex> <40-digit git SHA1 hash>')
+    print('or with several, to generate a diff with each concurrently:')
+    print('\t' + sys.argv[0] + ' <file_name.tex> YYYY-MM-DD <40-digit git SHA1 hash> ...')
 
-# Expecting two additional arguments
-if len(sys.argv) != 3:
-    quit(print_usage())
-
-# Expecting a tex file
-if not sys.argv[1].endswith('.tex'):
-    print("File " + sys.argv[1] + " does not appear to be a .tex file.")
-    quit(print_usage())
-
-# Expecting either date (length 10) or SHA1 hash (length 40)
-if not os.path.isfile(sys.argv[1]):
-    print("File " + sys.argv[1] + " is not a valid file.")
-    quit(print_usage())
-
-# Expecting either date (length 10) or SHA1 hash (length 40)
-if len(sys.argv[2]) not in [10, 40]:
-    quit(print_usage())
-
-# Helper file to dump unnecessary output to
-devnull = open(os.devnull, 'w')
-
-# Check that latexdiff is installed
-try:
-    subprocess.call(['latexdiff'], stdout=devnull, stderr=devnull)
-except OSError as e:
-    quit('latexdiff does not seem to be installed: try sudo apt-get install latexdiff')
-
-# Identify git repo top level directory
-repo_dir = subprocess.check_output(['git', 'rev-parse', '--show-toplevel']).strip()
-if not os.path.isdir(repo_dir):
-    print("Directory " + repo_dir + " is not a valid directory.")
-    quit(print_usage())
-
-if repo_dir not in os.path.abspath(sys.argv[1]):
-    print("Repo " + repo_dir + " does not seem to contain " + sys.argv[1])
-    quit(print_usage())
-
-# Define all necessary files and paths
-rel_to_repo = os.path.abspath(sys.argv[1]).replace(repo_dir, '').replace(sys.argv[1], '').strip('/')
-
-file_tex = sys.argv[1]
-file_old = file_tex.replace('.tex', '.OLD')
-file_dif = file_tex.replace('.tex', '_diff.tex')
-log_file = file_tex.replace(sys.argv[1], 'log')
-
-# For the git part, we work relative to the git repo top level directory
-os.chdir(repo_dir)
-
-# Generate log of revisions to tex file
-print('Generating list of revisions that changed ' + file_tex + '...')
-with open(os.path.join(rel_to_repo, log_file), 'w') as f:
-    subprocess.call(['git', 'log', '--follow', os.path.join(rel_to_repo, file_tex)], stdout=f)
-
-# Read log contents into list
-with open(os.path.join(rel_to_repo, log_file), 'r') as f:
-    log_contents = f.readlines()
-
-# Parse log contents to get list of SHA1 hashes and date strings
-list_of_hashes = []
-list_of_datetimes = []
-for line in log_contents:
-    if line.startswith('commit'):
-        list_of_hashes.append(line.replace('commit', '').strip())
-    if line.startswith('Date:'):
-        date_string = line.replace('Date:', '').strip()[:-5].strip()
-        try:
-            list_of_datetimes.append(datetime.datetime.strptime(date_string, '%a %b %d %H:%M:%S %Y'))
-        except ValueError as v:
-            quit(str(v) + ': Is git representing dates differently?')
-
-# Determine the correct hash
-correct_hash = None
-
-# Validate SHA1 hash input
-if len(sys.argv[2]) == 40:
-    if not re.match('[a-f0-9]{40}', sys.argv[2]):
-        quit('Expected valid 40-character SHA1 hash; instead got ' + sys.argv[2])
-    elif sys.argv[2] not in list_of_hashes:
-        quit('40-character SHA1 hash ' + sys.argv[2] + ' is not in the list of available revisions.')
-    else:
-        correct_hash = sys.argv[2]
-# Validate date input
-else:
-    revision_date = sys.argv[2]
-    if not re.match('\d{4}-\d{2}-\d{2}', revision_date):
-        quit('Expected date in form YYYY-MM-DD; instead got ' + revision_date)
-    else:
-        try:
-            revision_date = datetime.datetime.strptime(revision_date, '%Y-%m-%d')
-        except ValueError as v:
-            quit('Expected date in form YYYY-MM-DD; instead got ' + sys.argv[2] + '. ' + str(v))
+
+def git_output(arguments, repo_dir):
+    """ Run a git command in a repository
+
+    :param arguments: the arguments to git
+    :param repo_dir: the directory in which to run git
+    :return: the output of the command, as text, without surrounding whitespace
+
+    :raise subprocess.CalledProcessError: if git fails
+    """
+    return subprocess.check_output(['git'] + arguments, cwd=repo_dir).decode('utf-8').strip()
+
+
+def read_revisions(repo_dir, rel_path):
+    """ List the revisions that changed a file, following renames, from a single git log call
+
+    :param repo_dir: the top level directory of the repository
+    :param rel_path: path of the file relative to repo_dir
+    :return: a list of [author timestamp, SHA1 hash] pairs, oldest first
+    """
+    # Parameters:
+    #   --follow             Continue listing the history of a file beyond renames
+    #   --format=%H %at      One line per revision: the full hash and the author date, in seconds since the epoch
+    log_lines = git_output(['log', '--follow', '--format=%H %at', '--', rel_path], repo_dir).splitlines()
+
+    revisions = []
+    for line in log_lines:
+        sha1_hash, timestamp = line.split()
+        revisions.append([int(timestamp), sha1_hash])
+
+    # git lists revisions by commit date, which may not be in the order of their author dates
+    revisions.sort(key=lambda revision: revision[0])
+    return revisions
+
+
+def cache_directory(repo_dir):
+    """ The directory, in the repository's git directory, in which revision indexes and diffs are cached """
+    return os.path.join(repo_dir, git_output(['rev-parse', '--git-dir'], repo_dir), INDEX_DIR)
+
+
+def revision_index(repo_dir, rel_path):
+    """ Get the revisions that changed a file, as from read_revisions(), from a cache in the repository's git directory
+    that is rebuilt whenever HEAD has moved since it was written
+
+    :param repo_dir: the top level directory of the repository
+    :param rel_path: path of the file relative to repo_dir
+    :return: a list of [author timestamp, SHA1 hash] pairs, oldest first
+    """
+    head = git_output(['rev-parse', 'HEAD'], repo_dir)
+    index_dir = cache_directory(repo_dir)
+    index_path = os.path.join(index_dir, hashlib.sha1(rel_path.encode('utf-8')).hexdigest() + '.json')
+
+    try:
+        with open(index_path, 'r') as index_file:
+            index = json.load(index_file)
+        if index.get('version') == INDEX_VERSION and index.get('head') == head and index.get('file') == rel_path:
+            return index['revisions']
+    except (IOError, OSError, ValueError, AttributeError, KeyError):
+        pass
+
+    revisions = read_revisions(repo_dir, rel_path)
+
+    # The index only saves work on later runs, so failing to write it is not an error.  Write to a temporary file and
+    # rename, so concurrent runs never see a partial index
+    try:
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        handle, temp_path = tempfile.mkstemp(dir=index_dir, suffix='.tmp')
+        with os.fdopen(handle, 'w') as temp_file:
+            json.dump({'version': INDEX_VERSION, 'head': head, 'file': rel_path, 'revisions': revisions}, temp_file)
+        os.rename(temp_path, index_path)
+    except (IOError, OSError):
+        pass
+
+    return revisions
+
+
+def revision_before(revisions, revision_date):
+    """ Find the latest revision made before a date, by binary search
+
+    :param revisions: a list of [author timestamp, SHA1 hash] pairs, oldest first, as from revision_index()
+    :param revision_date: a datetime, in local time
+    :return: the SHA1 hash of the revision, or None if every revision was made on or after the date
+    """
+    # Every revision at or after the date compares greater than this, whatever its hash
+    i = bisect.bisect_left(revisions, [time.mktime(revision_date.timetuple()), ''])
+    return revisions[i - 1][1] if i > 0 else None
+
+
+def resolve_revision(revisions, revision):
+    """ Find the revision to diff against from a command line argument
+
+    :param revisions: a list of [author timestamp, SHA1 hash] pairs, oldest first, as from revision_index()
+    :param revision: a 40-character SHA1 hash of one of the revisions, or a date in the past in the form YYYY-MM-DD, for
+                     the latest revision before that date
+    :return: the SHA1 hash of the revision
+
+    :raise Exception: if the hash is invalid or not one of the revisions
+    :raise Exception: if the date is invalid or not in the past
+    """
+    # Validate SHA1 hash input
+    if len(revision) == 40:
+        if not re.match('[a-f0-9]{40}', revision):
+            raise Exception('Expected valid 40-character SHA1 hash; instead got ' + revision)
+        elif revision not in set(sha1_hash for _, sha1_hash in revisions):
+            raise Exception('40-character SHA1 hash ' + revision + ' is not in the list of available revisions.')
+        return revision
+
+    # Validate date input
+    if not re.match(r'\d{4}-\d{2}-\d{2}', revision):
+        raise Exception('Expected date in form YYYY-MM-DD; instead got ' + revision)
+    try:
+        revision_date = datetime.datetime.strptime(revision, '%Y-%m-%d')
+    except ValueError as v:
+        raise Exception('Expected date in form YYYY-MM-DD; instead got ' + revision + '. ' + str(v))
 
     if revision_date > datetime.datetime.now():
-        quit('Expected date in the past; instead got ' + str(revision_date))
+        raise Exception('Expected date in the past; instead got ' + str(revision_date))
+
+    correct_hash = revision_before(revisions, revision_date)
+    if correct_hash is None:
+        correct_hash = revisions[0][1]
+        print('Given revision date ' + revision + ' is before first revision: using first hash instead')
+
+    return correct_hash
+
+
+def working_tree_hash(repo_dir, new_contents):
+    """ Hash everything besides the old revision on which a diff depends, since the tex file may include any other file
+    in the repository: the tex file's contents as read, the commit checked out, any changes to tracked files since, and
+    the names and contents of untracked files that are not ignored
+
+    :param repo_dir: the top level directory of the repository
+    :param new_contents: the current contents of the tex file, as bytes
+    :return: a hex digest
+
+    :raise subprocess.CalledProcessError: if git fails
+    """
+    digest = hashlib.sha1(new_contents)
+    for arguments in [['rev-parse', 'HEAD'], ['status', '--porcelain'], ['diff', '--binary', 'HEAD']]:
+        digest.update(subprocess.check_output(['git'] + arguments, cwd=repo_dir))
+
+    untracked = subprocess.check_output(['git', 'ls-files', '-z', '--others', '--exclude-standard'], cwd=repo_dir)
+    for file_name in sorted(untracked.split(b'\0')):
+        file_path = os.path.join(repo_dir.encode(), file_name)
+        if len(file_name) > 0 and os.path.isfile(file_path):
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(block)
+
+    return digest.hexdigest()
+
+
+def compile_diff(repo_dir, rel_path, new_contents, old_hash, cache_dir, print_progress=False, tree_hash=None):
+    """ Generate the pdf diff of a tex file with a previous revision, unless it is already cached.  The old revision is
+    taken from git, diffed with latexdiff and compiled with latex_compile.compile_latex(), in a temporary directory of
+    its own, so that several diffs can be made at once.  The tex file's directory is added to the paths
+    latex and bibtex search, so that files it includes are found.
+
+    Diffs are cached by the old revision's hash and working_tree_hash(), so that a change to any file the document
+    includes, committed or not, makes a new diff.
+
+    :param repo_dir: the top level directory of the repository
+    :param rel_path: path of the tex file relative to repo_dir
+    :param new_contents: the current contents of the tex file, as bytes
+    :param old_hash: the SHA1 hash of the revision to diff against
+    :param cache_dir: the directory in which diffs are cached
+    :param print_progress: whether to print the time taken by each latex pass (default False)
+    :param tree_hash: working_tree_hash() of repo_dir and new_contents, if already known (default None, meaning it is
+                      calculated here)
+    :return: the path of the diff in the cache
+
+    :raise Exception: if git fails to give the old revision
+    :raise Exception: if latexdiff or pdflatex fails, in which case the temporary directory is left for inspection
+    """
+    if tree_hash is None:
+        tree_hash = working_tree_hash(repo_dir, new_contents)
 
-    if revision_date < list_of_datetimes[-1]:
-        correct_hash = list_of_hashes[-1]
-        print('Given revision date is before first revision: using first hash instead')
+    cached_pdf = os.path.join(cache_dir, old_hash + '_' + tree_hash + '.pdf')
+    if os.path.isfile(cached_pdf):
+        return cached_pdf
+
+    tex_dir = os.path.dirname(os.path.join(repo_dir, rel_path))
+    file_tex = os.path.basename(rel_path)
+    file_old = file_tex.replace('.tex', '.OLD')
+    file_dif = file_tex.replace('.tex', '_diff.tex')
+
+    # Let latex and bibtex find anything in the tex file's directory; the trailing separator keeps the default paths
+    env = dict(os.environ)
+    for variable in ['TEXINPUTS', 'BIBINPUTS', 'BSTINPUTS']:
+        env[variable] = tex_dir + os.pathsep + env.get(variable, '')
+
+    work_dir = tempfile.mkdtemp(prefix='.diff_' + old_hash[:7] + '_', dir=cache_dir)
+
+    with open(os.devnull, 'w') as devnull:
+        with open(os.path.join(work_dir, file_tex), 'wb') as f:
+            f.write(new_contents)
+
+        with open(os.path.join(work_dir, file_old), 'w') as f:
+            git_return_code = subprocess.call(['git', 'show', old_hash + ':' + rel_path], cwd=repo_dir, stdout=f,
+                                              stderr=devnull)
+
+        # Nothing has been diffed or compiled yet, so there is nothing to inspect
+        if git_return_code != 0:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            raise Exception('latex_time_diff: Could not get revision ' + old_hash + ' of ' + rel_path)
+
+        with open(os.path.join(work_dir, file_dif), 'w') as f:
+            subprocess.call(['latexdiff', '--packages=cleveref,hyperref', file_old, file_tex], cwd=work_dir, stdout=f,
+                            stderr=devnull)
+
+    # latexdiff output often has errors latex can recover from, so keep compiling through them
+    latex_compile.compile_latex(work_dir, file_dif, env=env, stop_on_error=False, print_progress=print_progress)
+
+    # Check that a valid pdf was created by pdflatex
+    pdf_path = os.path.join(work_dir, file_dif.replace('.tex', '.pdf'))
+    if not os.path.isfile(pdf_path) or os.path.getsize(pdf_path) < 1024:
+        raise Exception('latex_time_diff: pdf of diff with ' + old_hash + ' not created as expected: check latex log '
+                        'file in ' + work_dir)
+
+    os.rename(pdf_path, cached_pdf)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    return cached_pdf
+
+
+def diff_series(repo_dir, rel_path, old_hashes, pdf_paths, num_workers=None, print_progress=False):
+    """ Generate the pdf diffs of a tex file with several previous revisions, concurrently
+
+    :param repo_dir: the top level directory of the repository
+    :param rel_path: path of the tex file relative to repo_dir
+    :param old_hashes: the SHA1 hashes of the revisions to diff against
+    :param pdf_paths: the path to copy each diff to, one per revision
+    :param num_workers: the number of diffs to generate at once (default None, meaning one per core)
+    :param print_progress: whether to print running trace of this function (default False)
+    :return: the number of diffs that had to be generated, rather than being found in the cache
+
+    :raise Exception: if num_workers is < 1
+    :raise Exception: if generating any diff fails
+    """
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+
+    if num_workers < 1:
+        raise Exception('latex_time_diff: Invalid num_workers: ' + str(num_workers))
+
+    cache_dir = os.path.join(cache_directory(repo_dir), DIFF_CACHE_DIR)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    # Read the tex file once, so that every diff is of the same contents as the cache key
+    with open(os.path.join(repo_dir, rel_path), 'rb') as f:
+        new_contents = f.read()
+
+    # Hash the working tree once, alongside reading the tex file, so that every diff is cached under the same state
+    tree_hash = working_tree_hash(repo_dir, new_contents)
+
+    # Diff once with each revision, however many arguments lead to it
+    unique_hashes = sorted(set(old_hashes))
+    num_cached = len([old_hash for old_hash in unique_hashes
+                      if os.path.isfile(os.path.join(cache_dir, old_hash + '_' + tree_hash + '.pdf'))])
+
+    def diff(old_hash):
+        return old_hash, compile_diff(repo_dir, rel_path, new_contents, old_hash, cache_dir, print_progress,
+                                      tree_hash=tree_hash)
+
+    if print_progress:
+        print('Generating ' + str(len(unique_hashes) - num_cached) + ' pdf diffs, ' + str(num_cached) + ' cached, with '
+              + str(min(num_workers, len(unique_hashes))) + ' workers...')
+
+    # Each diff runs in separate processes, so threads suffice to wait on them
+    cached_pdfs = {}
+    pool = multiprocessing.pool.ThreadPool(processes=min(num_workers, len(unique_hashes)))
+    try:
+        for old_hash, cached_pdf in pool.imap_unordered(diff, unique_hashes):
+            cached_pdfs[old_hash] = cached_pdf
+            if print_progress:
+                print('\t... diff with ' + old_hash + ' done')
+    finally:
+        pool.close()
+        pool.join()
+
+    for old_hash, pdf_path in zip(old_hashes, pdf_paths):
+        shutil.copyfile(cached_pdfs[old_hash], pdf_path)
+
+    return len(unique_hashes) - num_cached
+
+
+if __name__ == '__main__':
+
+    # Expecting two or more additional arguments
+    if len(sys.argv) < 3:
+        quit(print_usage())
+
+    # Expecting a tex file
+    if not sys.argv[1].endswith('.tex'):
+        print("File " + sys.argv[1] + " does not appear to be a .tex file.")
+        quit(print_usage())
+
+    # Expecting either date (length 10) or SHA1 hash (length 40)
+    if not os.path.isfile(sys.argv[1]):
+        print("File " + sys.argv[1] + " is not a valid file.")
+        quit(print_usage())
+
+    # Expecting either date (length 10) or SHA1 hash (length 40)
+    if any(len(argument) not in [10, 40] for argument in sys.argv[2:]):
+        quit(print_usage())
+
+    # Helper file to dump unnecessary output to
+    devnull = open(os.devnull, 'w')
+
+    # Check that latexdiff is installed
+    try:
+        subprocess.call(['latexdiff'], stdout=devnull, stderr=devnull)
+    except OSError as e:
+        quit('latexdiff does not seem to be installed: try sudo apt-get install latexdiff')
+
+    # Close devnull
+    devnull.close()
+
+    # Identify git repo top level directory
+    repo_dir = git_output(['rev-parse', '--show-toplevel'], None)
+    if not os.path.isdir(repo_dir):
+        print("Directory " + repo_dir + " is not a valid directory.")
+        quit(print_usage())
+
+    if repo_dir not in os.path.abspath(sys.argv[1]):
+        print("Repo " + repo_dir + " does not seem to contain " + sys.argv[1])
+        quit(print_usage())
+
+    # Define all necessary files and paths
+    rel_to_repo = os.path.abspath(sys.argv[1]).replace(repo_dir, '').replace(sys.argv[1], '').strip('/')
+
+    file_tex = sys.argv[1]
+    file_dif = file_tex.replace('.tex', '_diff.tex')
+
+    # Get the list of revisions to tex file, oldest first
+    print('Finding revisions that changed ' + file_tex + '...')
+    revisions = revision_index(repo_dir, os.path.join(rel_to_repo, file_tex))
+    if len(revisions) == 0:
+        quit('No revisions of ' + file_tex + ' found in git repo.')
+
+    # Determine the correct hash for each revision argument
+    try:
+        old_hashes = [resolve_revision(revisions, argument) for argument in sys.argv[2:]]
+    except Exception as e:
+        quit(str(e))
+
+    # A single diff is named as it always has been; each of a series is labelled with its date or abbreviated hash
+    if len(old_hashes) == 1:
+        pdf_paths = [file_dif.replace('.tex', '.pdf')]
     else:
-        for i, dt in enumerate(list_of_datetimes):
-            if dt < revision_date:
-                correct_hash = list_of_hashes[i]
-                break
-
-# Generate file with determined hash
-print('Getting revision ' + correct_hash + ' from git repo...')
-with open(os.path.join(rel_to_repo, file_old), 'w') as f:
-    subprocess.call(['git', 'show', correct_hash + ':' + os.path.join(rel_to_repo, file_tex)], stdout=f)
-
-# For the latex part, we work relative to the tex file directory
-os.chdir(os.path.join(repo_dir, rel_to_repo))
-
-# Generate diff tex file
-print('Generating latex diff file...')
-with open(file_dif, 'w') as f:
-    subprocess.call(['latexdiff', '--packages=cleveref,hyperref', file_old, file_tex], stdout=f, stderr=devnull)
-
-# If pdf already exists, delete it first
-if os.path.isfile(file_dif.replace('.tex', '.pdf')):
-    subprocess.call(['rm', file_dif.replace('.tex', '.pdf')])
-
-# Find the bib file if it's there
-num_bib_files = 0
-for my_file in os.listdir('.'):
-    if my_file.endswith('.bib'):
-        num_bib_files += 1
-
-# Compile pdf
-print('Generating pdf diff...')
-subprocess.call(['pdflatex', file_dif], stdout=devnull)
-if num_bib_files > 0:
-    subprocess.call(['bibtex', file_dif.replace('.tex', '.aux')], stdout=devnull)
-subprocess.call(['pdflatex', file_dif], stdout=devnull)
-subprocess.call(['pdflatex', file_dif], stdout=devnull)
-
-# Check that a valid pdf was created by pdflatex
-if not os.path.isfile(file_dif.replace('.tex', '.pdf')):
-    quit('pdf of diff not created as expected: check latex log file...')
-if os.path.getsize(file_dif.replace('.tex', '.pdf')) < 1024:
-    quit('pdf of diff not created as expected: check latex log file...')
-
-# Tidy up generated files
-print('Tidying up...')
-subprocess.call(['rm', file_old, file_dif, log_file])
-
-for my_file in os.listdir('.'):
-    if my_file.startswith(file_dif.replace('.tex', '')) and not my_file.endswith('.pdf'):
-        subprocess.call(['rm', my_file])
-
-# Close devnull
-devnull.close()
-
-print('... finished.')
+        pdf_paths = [file_dif.replace('.tex', '_' + (argument if len(argument) == 10 else argument[:7]) + '.pdf')
+                     for argument in sys.argv[2:]]
+
+    try:
+        diff_series(repo_dir, os.path.join(rel_to_repo, file_tex), old_hashes, pdf_paths, print_progress=True)
+    except Exception as e:
+        quit(str(e))
+
+    print('... finished: ' + ', '.join(pdf_paths))
@@ -0,0 +1,391 @@
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import re
+import sys
+import time
+
+from archiver import Archiver
+
+# Name of the file, in each simulation directory, recording the state of its movie job.  It starts with '.' so that the
+# tidy-up stage of the movie functions does not sweep it into res_arch.tar.gz
+STATUS_FILE = '.movie_batch_status.json'
+
+# Movie formats, and the name of the function that makes each
+MOVIE_FORMATS = {'webm': 'svg_to_webm', 'mp4': 'png_to_mp4'}
+
+# The stages of a movie job, in the order each directory passes through them
+STAGES = ['rasterise', 'encode', 'archive']
+
+# Number of directories that may be in progress for each stage running at once, so that one directory's encode or
+# archive stage can run while another's svg files are rasterised, without png sequences piling up on disk
+DIRECTORIES_PER_JOB = 2
+
+# When svg files are rasterised and piped into ffmpeg at once, the fraction of the stage's cores given to ffmpeg
+# threads; the rest go to rasteriser workers, as rasterising is the more expensive
+STREAMING_FFMPEG_FRACTION = 0.25
+
+# Names of the png files the movie functions rasterise svg files to, e.g. 0000.png
+PNG_SEQUENCE = re.compile(r'^\d{4,}\.png$')
+
+
+def make_movies(path, movie_format='webm', cpu_budget=None, num_jobs=None, resume=True, print_progress=False,
+                **movie_kwargs):
+    """ Make a movie in every simulation directory beneath `path`, scheduling the stages of different directories
+    from a shared cpu budget.
+
+    Each directory passes through the STAGES in turn: its svg files are rasterised to a png sequence, the movie is
+    encoded, and the svg and results files are archived.  The cpu budget is shared out so that num_jobs stages run
+    concurrently, each with cpu_budget // num_jobs cores, so that the node is not oversubscribed.  A directory holds
+    cores only while one of its stages runs, and stages further along are started first, so one directory's encode or
+    archive stage overlaps another's rasterising.  Frames streamed from svg into ffmpeg, for mp4 or with stream=True,
+    are rasterised and encoded in a single stage whose cores are split between rasteriser workers and ffmpeg threads.
+
+    Each directory is processed in its own process, and its outcome is recorded in STATUS_FILE within the directory.
+
+    :param path: the path beneath which to search for simulation directories
+    :param movie_format: one of MOVIE_FORMATS: 'webm' uses svg_to_webm, 'mp4' uses png_to_mp4 (streaming from svg if
+                         there are no png files) (default 'webm')
+    :param cpu_budget: the total number of cores to use (default None, meaning all of them)
+    :param num_jobs: the number of stages to run concurrently, with up to DIRECTORIES_PER_JOB times as many directories
+                     in progress (default None, meaning one per 4 cores)
+    :param resume: whether to skip directories whose STATUS_FILE records a completed movie (default True)
+    :param print_progress: whether to print running trace of this function (default False)
+    :param movie_kwargs: any further arguments for svg_to_webm or png_to_mp4, e.g. webm_duration or frame_cache; an
+                         archiver gives the codec, level and background mode of the archive stage
+    :return: a list of status dicts, one per directory, sorted by directory
+
+    :raise Exception: if path is not a valid directory
+    :raise Exception: if movie_format is not one of MOVIE_FORMATS
+    :raise Exception: if cpu_budget or num_jobs is < 1
+    """
+    if not os.path.isdir(path):
+        raise Exception('movie_batch: Invalid directory: ' + path)
+
+    if movie_format not in MOVIE_FORMATS:
+        raise Exception('movie_batch: Invalid movie_format: ' + str(movie_format))
+
+    if cpu_budget is None:
+        cpu_budget = multiprocessing.cpu_count()
+
+    if cpu_budget < 1:
+        raise Exception('movie_batch: Invalid cpu_budget: ' + str(cpu_budget))
+
+    if num_jobs is None:
+        num_jobs = max(1, cpu_budget // 4)
+
+    if num_jobs < 1:
+        raise Exception('movie_batch: Invalid num_jobs: ' + str(num_jobs))
+
+    num_jobs = min(num_jobs, cpu_budget)
+    cores_per_job = cpu_budget // num_jobs
+
+    sim_dirs = sorted(get_set_of_movie_directories(path))
+
+    statuses = {}
+    pending_dirs = []
+    for sim_dir in sim_dirs:
+        status = read_status(sim_dir)
+        if resume and status.get('status') == 'done':
+            status['skipped'] = True
+            statuses[sim_dir] = status
+        else:
+            pending_dirs.append(sim_dir)
+
+    if print_progress:
+        print('movie_batch: %s directories found, %s already done; running %s stages of %s cores each' %
+              (len(sim_dirs), len(sim_dirs) - len(pending_dirs), num_jobs, cores_per_job))
+
+    # Each job's connection, mapped to its directory and process
+    jobs = {}
+
+    def start_job(sim_dir):
+        # Each job gets its own (non-daemonic) process, so that it can create its own pool of rasteriser workers.  It
+        # asks for each of its stages in turn over its connection, and the reply is the number of cores granted
+        connection, job_connection = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=run_movie_job,
+                                          args=(sim_dir, movie_format, movie_kwargs, job_connection))
+        process.start()
+
+        # Only the job now holds its end of the connection, so the job exiting is seen here as the connection closing
+        job_connection.close()
+        jobs[connection] = (sim_dir, process)
+
+    def finish_job(connection):
+        sim_dir, process = jobs.pop(connection)
+        connection.close()
+        process.join()
+
+        status = read_status(sim_dir)
+        if status.get('status') != 'done' and process.exitcode != 0:
+            status['status'] = 'failed'
+            status.setdefault('error', 'job exited with code ' + str(process.exitcode))
+            write_status(sim_dir, status)
+        return sim_dir, status
+
+    waiting_dirs = list(pending_dirs)
+    ready_stages = []
+    running_stages = set()
+    try:
+        while len(waiting_dirs) > 0 or len(jobs) > 0:
+            while len(waiting_dirs) > 0 and len(jobs) < DIRECTORIES_PER_JOB * num_jobs:
+                start_job(waiting_dirs.pop(0))
+
+            # Start the stages furthest along first, so that directories are finished, and their png files removed,
+            # before others are begun.  The sort is stable, so stages at the same point start in the order asked for
+            ready_stages.sort(key=lambda ready_stage: -STAGES.index(ready_stage[1]))
+            while len(ready_stages) > 0 and len(running_stages) < num_jobs:
+                connection, stage = ready_stages.pop(0)
+                if print_progress:
+                    print('\t%s %s with %s cores' % (stage, jobs[connection][0], cores_per_job))
+                connection.send(cores_per_job)
+                running_stages.add(connection)
+
+            for connection in multiprocessing.connection.wait(list(jobs)):
+                # A job asking for its next stage, or exiting, has finished with the cores of its previous stage
+                running_stages.discard(connection)
+                try:
+                    ready_stages.append((connection, connection.recv()))
+                except EOFError:
+                    # A job killed while waiting for cores must not be granted them
+                    ready_stages = [ready_stage for ready_stage in ready_stages if ready_stage[0] is not connection]
+                    sim_dir, status = finish_job(connection)
+                    statuses[sim_dir] = status
+                    if print_progress:
+                        print('\t%s of %s: %s' % (len(statuses) - len(sim_dirs) + len(pending_dirs),
+                                                  len(pending_dirs), format_status(sim_dir, status)))
+    finally:
+        # Don't leave jobs running if the batch is interrupted
+        for connection in list(jobs):
+            jobs[connection][1].terminate()
+            finish_job(connection)
+
+    summary = [dict(statuses[sim_dir], sim_dir=sim_dir) for sim_dir in sorted(statuses)]
+
+    if print_progress:
+        print(format_summary(summary))
+
+    return summary
+
+
+def get_set_of_movie_directories(path):
+    """
+    Determine the set of all directories under `path` containing svg files, an svg or frame archive, or a png sequence
+    as written by the movie functions, starting at 0000.png
+    :param path: the path under which to search
+    :return: a set of directories from which a movie can be made
+    """
+    movie_directories = set()
+
+    for root, _, file_names in os.walk(path):
+        for file_name in file_names:
+            if file_name.endswith('.svg') or file_name.startswith('svg_arch.') or file_name == '0000.png':
+                movie_directories.add(root)
+                break
+
+    return movie_directories
+
+
+def list_png_sequence(sim_dir):
+    """ List the png files in a directory named as the movie functions rasterise svg files to, e.g. 0000.png """
+    return sorted(file_name for file_name in os.listdir(sim_dir) if PNG_SEQUENCE.match(file_name))
+
+
+def stage_kwargs(num_cores, streaming, movie_kwargs):
+    """ The arguments for a movie function running a stage with num_cores cores, unless set in movie_kwargs
+
+    :param num_cores: the number of cores granted to the stage
+    :param streaming: whether svg files are rasterised and piped into ffmpeg at once, which then share the cores
+    :param movie_kwargs: any further arguments for the movie function
+    :return: a dict of arguments
+    """
+    if streaming:
+        ffmpeg_threads = max(1, int(num_cores * STREAMING_FFMPEG_FRACTION))
+        kwargs = {'num_workers': max(1, num_cores - ffmpeg_threads), 'ffmpeg_threads': ffmpeg_threads}
+    else:
+        kwargs = {'num_workers': num_cores, 'ffmpeg_threads': num_cores}
+    kwargs.update(movie_kwargs)
+    return kwargs
+
+
+class DeferredArchiver(object):
+    """ Stands in for an archiver.Archiver in the rasterise and encode stages of a movie job, holding back the
+    archiving tasks submitted to it until the job's archive stage is granted its cores.
+    """
+
+    def __init__(self, codec='gz', level=9, background=False):
+        """
+        :param codec: one of archiver.CODECS, for the archive stage (default 'gz')
+        :param level: compression level for the archive stage (default 9)
+        :param background: whether the archive stage runs its tasks in a background thread (default False)
+        """
+        self.codec = codec
+        self.level = level
+        self.background = background
+        self.tasks = []
+        self.archiver = None
+
+    def submit(self, function, *args, **kwargs):
+        """ Hold back function(*args, **kwargs) until run() """
+        self.tasks.append((function, args, kwargs))
+
+    def archive_files(self, *args, **kwargs):
+        """ Archive files with the archiver of the archive stage; see archiver.Archiver.archive_files() """
+        return self.archiver.archive_files(*args, **kwargs)
+
+    def run(self, num_threads):
+        """ Run the tasks held back, in the order submitted, waiting for them to finish, and stopping any
+        background thread, before returning
+
+        :param num_threads: number of compression threads granted to the archive stage
+        :raise Exception: the first exception raised by any task
+        """
+        # Created here, in the job's process, as background threads do not survive the fork into it
+        self.archiver = Archiver(codec=self.codec, level=self.level, num_threads=num_threads,
+                                 background=self.background)
+        tasks, self.tasks = self.tasks, []
+        for function, args, kwargs in tasks:
+            self.archiver.submit(function, *args, **kwargs)
+        self.archiver.close()
+
+
+def run_movie_job(sim_dir, movie_format, movie_kwargs, connection):
+    """ Make the movie for a single simulation directory, one stage at a time, recording the outcome in its STATUS_FILE
+
+    :param sim_dir: the directory containing the simulation output
+    :param movie_format: one of MOVIE_FORMATS
+    :param movie_kwargs: any further arguments for the movie function
+    :param connection: the job's end of a multiprocessing.Pipe, over which it asks make_movies() for each stage in
+                       turn, receiving the number of cores granted to the stage
+    """
+    previous_status = read_status(sim_dir)
+
+    # A job that was interrupted or failed while rasterising may have left a partial png sequence, and one that was
+    # archiving may have removed part of it, which the movie functions would mistake for a complete one.  If the job
+    # rasterised the sequence itself and the svg files are still available, start again from those.
+    png_files = list_png_sequence(sim_dir)
+    rasterised = previous_status.get('stage') == 'rasterise' or previous_status.get('rasterised', False)
+    if rasterised and previous_status.get('status') in ['running', 'failed'] and \
+            previous_status.get('stage') != 'encode':
+        if any(file_name.endswith('.svg') or file_name.startswith('svg_arch.') for file_name in os.listdir(sim_dir)):
+            for png_file in png_files:
+                os.remove(os.path.join(sim_dir, png_file))
+            png_files = []
+
+    status = {'status': 'running', 'format': movie_format, 'start': time.time(),
+              'rasterised': rasterised and len(png_files) > 0}
+
+    # The movie functions encode any png files they find rather than rasterising, whatever their names
+    has_png_files = any(file_name.endswith('.png') for file_name in os.listdir(sim_dir))
+
+    def begin_stage(stage):
+        status['stage'] = stage
+        write_status(sim_dir, status)
+        connection.send(stage)
+        return connection.recv()
+
+    # Archiving is held back to a stage of its own, with the codec, level and background mode of any archiver given
+    kwargs = dict(movie_kwargs)
+    archiver = kwargs.pop('archiver', None)
+    if archiver is None:
+        archiver = DeferredArchiver(codec='gz', level=9)
+    else:
+        archiver = DeferredArchiver(codec=archiver.codec, level=archiver.level, background=archiver.pool is not None)
+
+    try:
+        if movie_format == 'webm':
+            import svg_to_webm
+            streaming = not has_png_files and kwargs.get('stream', False) and kwargs.get('full_rate_name') is None
+
+            if not has_png_files and not streaming:
+                num_cores = begin_stage('rasterise')
+                svg_to_webm.svg_to_webm(sim_dir=sim_dir, archiver=archiver, rasterise_only=True,
+                                        **stage_kwargs(num_cores, False, kwargs))
+                status['rasterised'] = True
+
+            num_cores = begin_stage('encode')
+            svg_to_webm.svg_to_webm(sim_dir=sim_dir, archiver=archiver, **stage_kwargs(num_cores, streaming, kwargs))
+            movie_name = kwargs.get('webm_name', 'results.webm')
+        else:
+            import png_to_mp4
+            kwargs.setdefault('stream_from_svg', True)
+            streaming = not has_png_files and kwargs['stream_from_svg']
+
+            num_cores = begin_stage('encode')
+            png_to_mp4.png_to_mp4(sim_dir=sim_dir, archiver=archiver, **stage_kwargs(num_cores, streaming, kwargs))
+            movie_name = kwargs.get('mp4_name', 'results.mp4')
+
+        num_cores = begin_stage('archive')
+        archiver.run(num_threads=num_cores)
+    except Exception as e:
+        status.update({'status': 'failed', 'seconds': time.time() - status['start'], 'error': str(e)})
+        write_status(sim_dir, status)
+        # The error is reported in the batch summary, so exit quietly rather than printing a traceback
+        sys.exit(1)
+
+    status.update({'status': 'done', 'seconds': time.time() - status['start'], 'movie': movie_name})
+    write_status(sim_dir, status)
+
+
+def read_status(sim_dir):
+    """ Read the STATUS_FILE of a simulation directory
+
+    :param sim_dir: the directory containing the simulation output
+    :return: the status dict, or an empty dict if there is no valid status file
+    """
+    try:
+        with open(os.path.join(sim_dir, STATUS_FILE), 'r') as status_file:
+            return json.load(status_file)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def write_status(sim_dir, status):
+    """ Write the STATUS_FILE of a simulation directory, replacing it atomically
+
+    :param sim_dir: the directory containing the simulation output
+    :param status: the status dict
+    """
+    temp_path = os.path.join(sim_dir, STATUS_FILE + '.tmp')
+    with open(temp_path, 'w') as status_file:
+        json.dump(status, status_file)
+    os.rename(temp_path, os.path.join(sim_dir, STATUS_FILE))
+
+
+def format_status(sim_dir, status):
+    """ Describe the status of a single directory in one line """
+    description = '%s %s' % (status.get('status', 'unknown'), sim_dir)
+    if status.get('status') == 'failed' and 'stage' in status:
+        description += ' in ' + status['stage']
+    if 'seconds' in status:
+        description += ' (%.1fs)' % status['seconds']
+    if 'error' in status:
+        description += ': ' + status['error']
+    return description
+
+
+def format_summary(summary):
+    """ Describe the outcome of a batch, with one line per directory followed by totals
+
+    :param summary: the list of status dicts returned by make_movies()
+    :return: a multi-line string
+    """
+    lines = ['movie_batch: summary']
+    for status in summary:
+        line = format_status(status['sim_dir'], status)
+        if status.get('skipped'):
+            line += ' [skipped]'
+        lines.append('\t' + line)
+
+    counts = {}
+    for status in summary:
+        counts[status.get('status', 'unknown')] = counts.get(status.get('status', 'unknown'), 0) + 1
+    lines.append('\t' + ', '.join('%s %s' % (counts[key], key) for key in sorted(counts)) +
+                 ', %.1fs total job time' % sum(status.get('seconds', 0.0) for status in summary
+                                               if not status.get('skipped')))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    quit('Call movie_batch.make_movies()')
@@ -0,0 +1,232 @@
+import asyncio
+import collections
+import math
+import subprocess
+import time
+
+# Kinds of probe: an ICMP echo with the ping command, a TCP connection, and a DNS lookup
+PROBE_KINDS = ['icmp', 'tcp', 'dns']
+
+# Consecutive failed probes after which a target is counted as down
+DEFAULT_FAILURES_BEFORE_DOWN = 3
+
+# Echo requests sent by each icmp probe, and the seconds between them; the probe succeeds only if every one is answered
+PING_COUNT = 3
+PING_INTERVAL = 0.2
+
+
+class Target(object):
+    """ A host to probe, and its failure state.
+
+    A target goes down when its last failures_before_down probes have all failed, and comes back up with its first
+    successful probe after that.
+    """
+
+    def __init__(self, kind, host, port=None, failures_before_down=DEFAULT_FAILURES_BEFORE_DOWN):
+        """
+        :param kind: one of PROBE_KINDS
+        :param host: the host name or address to probe
+        :param port: the port to connect to, for a tcp probe (default None)
+        :param failures_before_down: consecutive failed probes after which the target is down (default
+                                     DEFAULT_FAILURES_BEFORE_DOWN)
+        :raise Exception: if kind, port or failures_before_down is invalid
+        """
+        if kind not in PROBE_KINDS:
+            raise Exception('net_probes: Invalid probe kind: ' + str(kind))
+
+        if (kind == 'tcp') != (port is not None):
+            raise Exception('net_probes: A port is needed for, and only for, a tcp probe: ' + str(port))
+
+        if failures_before_down < 1:
+            raise Exception('net_probes: Invalid failures_before_down: ' + str(failures_before_down))
+
+        self.kind = kind
+        self.host = host
+        self.port = port
+        self.name = kind + ':' + host + ('' if port is None else ':' + str(port))
+
+        # Whether each of the most recent probes failed
+        self.recent_failures = collections.deque([False] * failures_before_down, failures_before_down)
+        self.down = False
+        self.down_since = None
+        self.last_outage = None
+        self.num_outages = 0
+        self.downtime = 0.0
+        self.num_probes = 0
+        self.num_failed_probes = 0
+
+    def record(self, success, now):
+        """ Update the failure state with the result of a probe
+
+        :param success: whether the probe succeeded
+        :param now: the time of the result, in seconds since the epoch
+        :return: 'down' or 'up' if the target has just gone down or come back up, else None
+        """
+        self.num_probes += 1
+        self.recent_failures.append(not success)
+
+        if success:
+            if self.down:
+                self.down = False
+                self.last_outage = now - self.down_since
+                self.downtime += self.last_outage
+                return 'up'
+        else:
+            self.num_failed_probes += 1
+            if not self.down and all(self.recent_failures):
+                self.down = True
+                self.down_since = now
+                self.num_outages += 1
+                return 'down'
+
+        return None
+
+    def total_downtime(self, now):
+        """ The time in seconds for which the target has been down, including any outage still going on at now """
+        return self.downtime + (now - self.down_since if self.down else 0.0)
+
+
+def parse_target(spec, failures_before_down=DEFAULT_FAILURES_BEFORE_DOWN):
+    """ Create a Target from a description of the form kind:host, or tcp:host:port
+
+    :param spec: e.g. 'icmp:8.8.8.8', 'dns:example.com' or 'tcp:127.0.0.1:8080'; an IPv6 address may be in brackets
+    :param failures_before_down: as for Target (default DEFAULT_FAILURES_BEFORE_DOWN)
+    :return: the Target
+
+    :raise Exception: if spec is invalid
+    """
+    kind, _, host = spec.partition(':')
+    port = None
+
+    if kind == 'tcp':
+        host, _, port = host.rpartition(':')
+        try:
+            port = int(port)
+        except ValueError:
+            raise Exception('net_probes: Invalid port in ' + spec)
+
+    host = host.strip('[]')
+    if len(host) == 0:
+        raise Exception('net_probes: No host in ' + spec)
+
+    # A name that cannot be encoded for DNS, e.g. with an empty or over-long label, could never be probed
+    try:
+        host.encode('idna')
+    except UnicodeError as e:
+        raise Exception('net_probes: Invalid host in ' + spec + ': ' + str(e))
+
+    return Target(kind, host, port, failures_before_down)
+
+
+async def probe_icmp(host, timeout):
+    """ Whether a host answers every one of PING_COUNT pings, with no packet loss, within timeout seconds """
+    # Parameters:
+    #   -c PING_COUNT       Send this many echo requests
+    #   -i PING_INTERVAL    Seconds between them
+    #   -W n                Wait at most n whole seconds for each reply; the timeout below is the one enforced
+    process = await asyncio.create_subprocess_exec('ping', '-c', str(PING_COUNT), '-i', str(PING_INTERVAL),
+                                                   '-W', str(max(1, int(math.ceil(timeout)))), host,
+                                                   stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        output, _ = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        return False
+
+    # ping succeeds if any reply is received, so check that none was lost
+    return b'received, 0% packet loss' in output
+
+
+async def probe_tcp(host, port, timeout):
+    """ Whether a connection to a port of a host is accepted within timeout seconds """
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True
+
+
+async def probe_dns(host, timeout):
+    """ Whether a host name resolves within timeout seconds """
+    try:
+        await asyncio.wait_for(asyncio.get_running_loop().getaddrinfo(host, None), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    return True
+
+
+async def probe(target, timeout):
+    """ Whether a probe of a target succeeds within timeout seconds.  Failing to start a probe, e.g. with no ping
+    command, or a host the resolver rejects, e.g. one that cannot be encoded for DNS, counts as a failed probe.
+    """
+    try:
+        if target.kind == 'icmp':
+            return await probe_icmp(target.host, timeout)
+        elif target.kind == 'tcp':
+            return await probe_tcp(target.host, target.port, timeout)
+        else:
+            return await probe_dns(target.host, timeout)
+    except (OSError, ValueError):
+        return False
+
+
+async def probe_target(target, start, interval, timeout, end, on_result):
+    """ Probe a target at start, start + interval, start + 2 * interval, ... until end, as for probe_targets() """
+    loop = asyncio.get_running_loop()
+    tick = 0
+
+    while True:
+        success = await probe(target, timeout)
+        transition = target.record(success, time.time())
+        if on_result is not None:
+            on_result(target, success, transition)
+
+        # The next probe is due at the next tick of the fixed schedule, rather than an interval after this probe, so
+        # the schedule does not drift with the time probes take.  Ticks missed by a slow probe are skipped
+        tick = max(tick + 1, int((loop.time() - start) / interval) + 1)
+        if end is not None and start + tick * interval >= end:
+            break
+        await asyncio.sleep(start + tick * interval - loop.time())
+
+
+async def probe_targets(targets, interval=1.0, timeout=None, duration=None, on_result=None):
+    """ Probe many targets concurrently, each on a fixed-rate schedule, updating the failure state of each
+
+    :param targets: list of Targets
+    :param interval: seconds between the start of one round of probes and the next (default 1.0)
+    :param timeout: seconds after which a probe counts as failed (default None, meaning interval)
+    :param duration: seconds after which to start no more probes (default None, meaning probe forever)
+    :param on_result: a function called with the target, whether the probe succeeded, and the target's transition, as
+                      from Target.record(), after each probe (default None)
+
+    :raise Exception: if interval or timeout is not positive
+    """
+    if interval <= 0:
+        raise Exception('net_probes: Invalid interval: ' + str(interval))
+
+    if timeout is None:
+        timeout = interval
+
+    if timeout <= 0:
+        raise Exception('net_probes: Invalid timeout: ' + str(timeout))
+
+    start = asyncio.get_running_loop().time()
+    end = None if duration is None else start + duration
+
+    await asyncio.gather(*[probe_target(target, start, interval, timeout, end, on_result) for target in targets])
+
+
+def run(targets, interval=1.0, timeout=None, duration=None, on_result=None):
+    """ Run probe_targets() in a new event loop, returning when duration has elapsed, or never if it is None """
+    asyncio.run(probe_targets(targets, interval=interval, timeout=timeout, duration=duration, on_result=on_result))
+
+
+if __name__ == '__main__':
+    quit('Run net_uptime.py, or call net_probes.run() with a list of net_probes.Targets')
@@ -1,33 +1,32 @@
 import atexit
 import datetime
-import subprocess
+import sys
+import time
 
-from collections import deque
-from time import sleep
+import net_probes
 
 g_start_time = datetime.datetime.now()
 g_time_format = '%Y-%m-%d %H:%M:%S'
 g_num_failures_before_log = 3
 g_sleep_time = 1.0
-g_failures = deque([False] * g_num_failures_before_log, g_num_failures_before_log)
 g_log_name = '/home/fergus/net_uptime_log'
-g_cumulative_failure_duration = g_start_time - g_start_time
-g_num_failures = 0
-g_currently_in_failure = False
-g_failure_start_time = datetime.datetime.now()
+g_default_targets = ['icmp:8.8.8.8']
+g_targets = []
 
 
 def exit_handler():
     end_time = datetime.datetime.now()
     total_duration = (end_time - g_start_time).seconds
-    failure_duration = g_cumulative_failure_duration.seconds
-    if total_duration > 0:
-        proportion = 100.0 * failure_duration / total_duration
-    else:
-        proportion = 0.0
-    log('%s Ending log after %s with %s failures (%ss, %s%%)\n################################\n' %
-        (end_time.strftime(g_time_format), format_seconds(total_duration), g_num_failures, failure_duration, proportion))
-atexit.register(exit_handler)
+    message = '%s Ending log after %s\n' % (end_time.strftime(g_time_format), format_seconds(total_duration))
+    for target in g_targets:
+        failure_duration = int(target.total_downtime(time.time()))
+        if total_duration > 0:
+            proportion = 100.0 * failure_duration / total_duration
+        else:
+            proportion = 0.0
+        message += '\t%s: %s failures (%ss, %s%%), %s of %s probes failed\n' % \
+            (target.name, target.num_outages, failure_duration, proportion, target.num_failed_probes, target.num_probes)
+    log(message + '################################\n')
 
 
 def format_seconds(seconds):
@@ -47,39 +46,30 @@ def log(message):
         myfile.write(message)
 
 
-def main():
-
-    global g_currently_in_failure
-    global g_failure_start_time
-    global g_num_failures
-    global g_cumulative_failure_duration
+def log_result(target, success, transition):
+    """ Log the start and end of each failure of a target, as reported by net_probes.probe_targets() """
+    now = datetime.datetime.now()
+    if transition == 'down':
+        log('%s Failure start (%s)\n' % (now.strftime(g_time_format), target.name))
+    elif transition == 'up':
+        log('%s Failure end (%s, duration %ss)\n' % (now.strftime(g_time_format), target.name, int(target.last_outage)))
 
-    a = subprocess.Popen(['ping', '-c', '3', '-i', '0.2', '8.8.8.8'], stdout=subprocess.PIPE)
 
-    output, _ = a.communicate()
+def main(target_specs):
+    """ Probe each target every g_sleep_time seconds, logging each failure, until interrupted
 
-    if "received, 0% packet loss" not in output:
-        g_failures.append(True)
-    elif g_currently_in_failure:
-        g_currently_in_failure = False
-        now = datetime.datetime.now()
-        failure_duration = now - g_failure_start_time
-        g_cumulative_failure_duration += failure_duration
-        log('%s Failure end (duration %ss)\n' % (now.strftime(g_time_format), failure_duration.seconds))
-
-    if g_failures.count(False) == 0 and not g_currently_in_failure:
-        g_currently_in_failure = True
-        now = datetime.datetime.now()
-        g_failure_start_time = now
-        g_num_failures += 1
-        log('%s Failure start\n' % now.strftime(g_time_format))
+    :param target_specs: list of targets, as for net_probes.parse_target(), e.g. ['icmp:8.8.8.8', 'tcp:example.com:443']
+    """
+    g_targets.extend(net_probes.parse_target(spec, g_num_failures_before_log) for spec in target_specs)
+    net_probes.run(g_targets, interval=g_sleep_time, on_result=log_result)
 
 
 if __name__ == '__main__':
 
+    atexit.register(exit_handler)
     log('\n################################\n%s Starting log\n' % g_start_time.strftime(g_time_format))
 
-    while True:
-        main()
-        sleep(g_sleep_time)
-
+    try:
+        main(sys.argv[1:] or g_default_targets)
+    except KeyboardInterrupt:
+        pass
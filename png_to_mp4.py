@@ -1,6 +1,15 @@
+import multiprocessing
 import os
 import subprocess
 
+import encode_profiles
+import frame_archive
+import frame_pipe
+import frame_sampling
+import segment_encode
+from archiver import Archiver, extract_archive, find_archive, is_archive
+from run_log import RunLog, files_size
+
 # First, check that ffmpeg is installed
 try:
     subprocess.call(['ffmpeg', '-version'], stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
@@ -8,19 +17,54 @@ except OSError as e:
     raise ImportError('png_to_mp4: ffmpeg does not seem to be installed: ' + str(e))
 
 
-def png_to_mp4(sim_dir, mp4_name='results.mp4', mp4_duration=15.0, print_progress=False):
+def png_to_mp4(sim_dir, mp4_name='results.mp4', mp4_duration=15.0, print_progress=False, stream_from_svg=False,
+               num_workers=None, max_in_flight=None, ffmpeg_threads=None, archiver=None,
+               profile=encode_profiles.DEFAULT_PROFILE, preset=None, extra_outputs=None,
+               segments=None, max_fps=None, sampling='even', full_rate_name=None, run_log=None):
     """ Convert a sequence of png files to a mp4 movie
 
     :param sim_dir: the directory containing the simulation output
     :param mp4_name: file name for the mp4 (default 'results.mp4')
     :param mp4_duration: required duration in seconds for the mp4 (default 15.0)
     :param print_progress: whether to print running trace of this function (default False)
+    :param stream_from_svg: if sim_dir contains no png files, rasterise its svg files (or svg archive) with the
+                            cairosvg library and pipe them straight into ffmpeg, without writing png files (default False)
+    :param num_workers: when streaming, number of svg files to rasterise concurrently (default None, meaning one per core)
+    :param max_in_flight: when streaming, the maximum number of frames rasterised but not yet consumed by ffmpeg
+                          (default None, meaning twice num_workers)
+    :param ffmpeg_threads: number of threads ffmpeg may use (default None, meaning ffmpeg's own choice)
+    :param archiver: an archiver.Archiver to archive the results files with; if it is in background mode, archiving
+                     continues after this function returns (default None, meaning gzip level 9)
+    :param profile: one of encode_profiles.PROFILES, setting the codec options for the mp4 (default
+                    'archival-lossless')
+    :param preset: overrides the encoder preset of each output whose codec has that preset, e.g. 'realtime' for vp9
+                   or 'veryfast' for h264 (default None)
+    :param extra_outputs: list of (profile, movie name) tuples for further movies, e.g. [('web-small', 'small.webm')],
+                          encoded by the same ffmpeg process from the same frames (default None)
+    :param segments: if given, encode a png sequence as this many GOP-aligned segments in concurrent ffmpeg processes,
+                     sharing ffmpeg_threads between them, and join the segments without re-encoding; streamed frames
+                     always go to a single ffmpeg process (default None, meaning a single ffmpeg process)
+    :param max_fps: if given, keep only as many frames as an mp4 of mp4_duration needs at this frame rate, choosing
+                    them before any svg file is rasterised when streaming (default None, meaning every frame)
+    :param sampling: one of frame_sampling.SAMPLING_MODES, how to choose the frames kept when max_fps is given
+                     (default 'even')
+    :param full_rate_name: if given, also make a lossless movie of this name from every png file, for archival use; not
+                           available when streaming (default None)
+    :param run_log: a run_log.RunLog recording the time taken, frames and bytes of each stage, and ffmpeg's encoding
+                    progress; with a log_path, these are written as JSON-lines events (default None, meaning stage
+                    timings are printed if print_progress)
 
     :raise Exception: if sim_dir is not a valid directory
     :raise Exception: if mp4_duration is < 1.0
-    :raise Exception: if no png files found in sim_dir
-    :raise Exception: if ffmpeg does not generate mp4 file
-    :raise Exception: if ffmpeg does not generate valid mp4 file (at least 1kb in size)
+    :raise Exception: if profile, or the profile or extension of any extra output, is not valid
+    :raise Exception: if segments is < 1
+    :raise Exception: if sampling is not one of frame_sampling.SAMPLING_MODES, or the extension of full_rate_name is
+                      not valid
+    :raise Exception: if full_rate_name is given and there are no png files
+    :raise Exception: if no png files found in sim_dir (or, if streaming, no svg files either)
+    :raise Exception: if, when streaming, any svg file fails to rasterise
+    :raise Exception: if ffmpeg does not generate each movie file
+    :raise Exception: if ffmpeg does not generate each movie file validly (at least 1kb in size)
     """
     # Validate and process input
     if not (os.path.isdir(sim_dir)):
@@ -32,77 +76,288 @@ def png_to_mp4(sim_dir, mp4_name='results.mp4', mp4_duration=15.0, print_progres
     if mp4_duration < 1.0:
         raise Exception('png_to_mp4: Invalid mp4_duration: ' + str(mp4_duration))
 
+    outputs = [(profile, mp4_name)] + list(extra_outputs or [])
+    for output_profile, movie_name in outputs:
+        if output_profile not in encode_profiles.PROFILES:
+            raise Exception('png_to_mp4: Invalid profile: ' + str(output_profile))
+        encode_profiles.container_of(movie_name)
+    movie_names = [movie_name for _, movie_name in outputs]
+
+    if segments is not None and segments < 1:
+        raise Exception('png_to_mp4: Invalid segments: ' + str(segments))
+
+    if sampling not in frame_sampling.SAMPLING_MODES:
+        raise Exception('png_to_mp4: Invalid sampling: ' + str(sampling))
+
+    if full_rate_name is not None:
+        encode_profiles.container_of(full_rate_name)
+
     png_files = list_files_of_type(path_name=sim_dir, extension='.png')
 
-    # "New" behaviour is to pre-convert the png files, so they should already exist
-    if len(png_files) == 0:
+    # "New" behaviour is to pre-convert the png files, so they should already exist, unless we are streaming from svg
+    streaming = stream_from_svg and len(png_files) == 0
+    if len(png_files) == 0 and not streaming:
         raise Exception('png_to_mp4: No png files found in ' + sim_dir)
 
-    # Set how long you want the video to be (in seconds), and set the frame rate accordingly, with a minimum of 1.0
-    frame_rate = max(float(len(png_files)) / mp4_duration, 1.0)
-
-    # Send the subprocess call to run ffmpeg. Parameters:
-    #   -v 0               Suppress console output so as not to clutter the terminal
-    #   -r frame_rate      Set the frame rate calculated above
-    #   -f image2          Set the convert format (image sequence to video)
-    #   -i %04d.png        Input expected as dir/results.####.png, the output from WriteAnimation above
-    #   -c:v libx264       Video codec to use is h264
-    #   -crf 0             Set video quality to lossless
-    #   -preset slow       Slow encoding at expense of slightly larger file size
+    if streaming and full_rate_name is not None:
+        raise Exception('png_to_mp4: A full-rate movie needs png files, but none were found in ' + sim_dir)
+
+    # Default to max compression in tar stages
+    if archiver is None:
+        archiver = Archiver(codec='gz', level=9)
+
+    if run_log is None:
+        run_log = RunLog(print_progress=print_progress, prefix='png_to_mp4')
+    run_log.start_run(function='png_to_mp4', sim_dir=sim_dir)
+
+    # Parameters for the ffmpeg output, following the input parameters: the codec options of each output's profile,
+    # optionally limiting the number of threads ffmpeg uses, e.g. to leave cores for other jobs, then
     #   -y name.mp4        Output directory and name
-    ffmpeg_command = ['ffmpeg',
-                      '-v', '0',
-                      '-r', str(frame_rate),
-                      '-f', 'image2',
-                      '-i', '%04d.png',
-                      '-c:v', 'libx264',
-                      '-pix_fmt', 'yuv420p',
-                      '-crf', '0',
-                      '-preset', 'slow',
-                      '-y', mp4_name]
+    output_args = encode_profiles.output_args(outputs, threads=ffmpeg_threads, preset=preset)
 
-    if print_progress:
-        print('png_to_mp4: Creating mp4: ' + ' '.join(ffmpeg_command))
+    if streaming:
+        stream_svg_to_ffmpeg(sim_dir=sim_dir, output_args=output_args, movie_names=movie_names, duration=mp4_duration,
+                             num_workers=num_workers, max_in_flight=max_in_flight, print_progress=print_progress,
+                             archiver=archiver, max_fps=max_fps, sampling=sampling, run_log=run_log)
+    else:
+        with run_log.stage('encode', streamed=False) as counts:
+            sampled_png_files = frame_sampling.sample_frames(
+                frame_names=png_files, duration=mp4_duration, max_fps=max_fps, mode=sampling,
+                frame_sizes=[os.path.getsize(os.path.join(sim_dir, png_file)) for png_file in png_files]
+                if max_fps is not None and sampling == 'keyframe' else None)
+
+            # Set how long you want the video to be (in seconds), and set the frame rate accordingly, with a minimum
+            # of 1.0
+            frame_rate = max(float(len(sampled_png_files)) / mp4_duration, 1.0)
+
+            if len(sampled_png_files) < len(png_files):
+                # Only some of the png files are wanted, so pipe just those into ffmpeg
+                if print_progress:
+                    print('png_to_mp4: Creating mp4 from ' + str(len(sampled_png_files)) + ' of ' +
+                          str(len(png_files)) + ' png files: ' +
+                          ' '.join(['ffmpeg', '-v', '0'] + frame_pipe.pipe_input_args(frame_rate) + output_args))
+
+                frame_pipe.stream_frames_to_ffmpeg(frames=frame_pipe.read_frame_files(sim_dir, sampled_png_files),
+                                                   frame_rate=frame_rate, output_args=output_args, cwd=sim_dir,
+                                                   progress_callback=run_log.ffmpeg_progress(output=mp4_name))
+
+            elif segments is not None and segments > 1:
+                # Share the ffmpeg threads between the concurrent segments
+                segment_threads = None if ffmpeg_threads is None else max(1, ffmpeg_threads // segments)
+                segment_encode.encode_segments(sim_dir=sim_dir, num_frames=len(png_files), frame_rate=frame_rate,
+                                               outputs=outputs, num_segments=segments, threads=segment_threads,
+                                               preset=preset, print_progress=print_progress,
+                                               progress_callback=run_log.ffmpeg_progress(output=mp4_name))
+
+            else:
+                # Send the subprocess call to run ffmpeg. Parameters:
+                #   -v 0               Suppress console output so as not to clutter the terminal
+                #   -r frame_rate      Set the frame rate calculated above
+                #   -f image2          Set the convert format (image sequence to video)
+                #   -i %04d.png        Input expected as dir/results.####.png, the output from WriteAnimation above
+                ffmpeg_command = ['ffmpeg',
+                                  '-v', '0',
+                                  '-r', str(frame_rate),
+                                  '-f', 'image2',
+                                  '-i', '%04d.png'] + output_args
+
+                if print_progress:
+                    print('png_to_mp4: Creating mp4: ' + ' '.join(ffmpeg_command))
 
-    subprocess.call(ffmpeg_command, cwd=sim_dir, stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+                frame_pipe.run_ffmpeg(ffmpeg_command, cwd=sim_dir,
+                                      progress_callback=run_log.ffmpeg_progress(output=mp4_name))
 
-    # Raise exception if the mp4 file is not generated as expected
-    if not os.path.isfile(os.path.join(sim_dir, mp4_name)):
-        raise Exception('png_to_mp4: mp4 not generated as expected')
+            if full_rate_name is not None:
+                segment_encode.encode_full_rate(sim_dir=sim_dir, num_frames=len(png_files), duration=mp4_duration,
+                                                movie_name=full_rate_name, ffmpeg_threads=ffmpeg_threads,
+                                                segments=segments, print_progress=print_progress,
+                                                progress_callback=run_log.ffmpeg_progress(output=full_rate_name),
+                                                prefix='png_to_mp4')
+                movie_names.append(full_rate_name)
+            counts['frames'] = len(sampled_png_files)
+            counts['bytes'] = files_size(sim_dir, movie_names)
 
-    # Raise exception if the mp4 file file is created but is smaller than 1kb - ffmpeg sometimes
-    # generates an empty file even if an error occurs
-    if os.path.getsize(os.path.join(sim_dir, mp4_name)) < 1024:
-        raise Exception('png_to_mp4: mp4 not generated as expected')
+    for movie_name in movie_names:
+        # Raise exception if the movie file is not generated as expected
+        if not os.path.isfile(os.path.join(sim_dir, movie_name)):
+            raise Exception('png_to_mp4: ' + movie_name + ' not generated as expected')
+
+        # Raise exception if the movie file file is created but is smaller than 1kb - ffmpeg sometimes
+        # generates an empty file even if an error occurs
+        if os.path.getsize(os.path.join(sim_dir, movie_name)) < 1024:
+            raise Exception('png_to_mp4: ' + movie_name + ' not generated as expected')
 
     if print_progress:
-        print('\t... finished creating mp4: ' + mp4_name)
+        print('\t... finished creating ' + ', '.join(movie_names))
+
+    archiver.submit(run_log.timed('archive', tidy_results), sim_dir=sim_dir, png_files=png_files,
+                    movie_names=movie_names, archiver=archiver, print_progress=print_progress)
+
+    run_log.end_run(status='done', movies=movie_names)
+
+    # Reset terminal
+    os.system('stty sane')
+
 
+def tidy_results(sim_dir, png_files, movie_names, archiver, print_progress=False):
+    """ Delete png files, and archive vtu, pvd and any other results files, leaving only the movies and archives
+
+    :param sim_dir: the directory containing the simulation output
+    :param png_files: list of names of the png files
+    :param movie_names: list of names of the movie files just made, which are left in place
+    :param archiver: the archiver.Archiver to archive with
+    :param print_progress: whether to print running trace of this function (default False)
+    """
     # Tidy up: Delete all png files
-    subprocess.call(['rm'] + png_files, cwd=sim_dir)
-    if print_progress:
-        print('png_to_mp4: Removed png files')
+    if len(png_files) > 0:
+        subprocess.call(['rm'] + png_files, cwd=sim_dir)
+        if print_progress:
+            print('png_to_mp4: Removed png files')
 
     # Tidy up: compress any vtu and pvd files, if they exist
     vtu_files = list_files_of_type(sim_dir, '.vtu') + list_files_of_type(sim_dir, '.pvd')
     if len(vtu_files) > 0:
-        subprocess.call(['tar', '-zcf', 'vtu_arch.tar.gz', '--remove-files'] + vtu_files, cwd=sim_dir)
+        archiver.archive_files(sim_dir, vtu_files, 'vtu_arch')
         if print_progress:
             print('png_to_mp4: Archived vtu and pvd files')
 
     # Tidy up: compress any other results files, if they exist
     res_files = []
     for res_file in os.listdir(sim_dir):
-        if not (res_file.endswith('.mp4') or res_file.endswith('.tar.gz') or res_file.startswith('.')):
+        if not (res_file.endswith('.mp4') or res_file in movie_names or is_archive(res_file) or
+                res_file == frame_archive.FRAME_ARCHIVE or res_file.startswith('.')):
             res_files.append(res_file)
 
     if len(res_files) > 0:
-        subprocess.call(['tar', '-zcf', 'res_arch.tar.gz', '--remove-files'] + res_files, cwd=sim_dir)
+        archiver.archive_files(sim_dir, res_files, 'res_arch')
         if print_progress:
             print('png_to_mp4: Archived other results files')
 
-    # Reset terminal
-    os.system('stty sane')
+
+def stream_svg_to_ffmpeg(sim_dir, output_args, movie_names, duration, num_workers=None, max_in_flight=None,
+                         print_progress=False, archiver=None, max_fps=None, sampling='even', run_log=None):
+    """ Rasterise the svg files in sim_dir with the cairosvg library, piping the frames in order into ffmpeg.
+
+    Svg files are extracted from an svg archive if necessary, and afterwards are removed, being archived first if
+    they were not already.
+
+    :param sim_dir: the directory containing the simulation output
+    :param output_args: ffmpeg arguments following the input, e.g. codec options and the output file names
+    :param movie_names: names of the movie files ffmpeg writes, removed if anything fails
+    :param duration: required duration in seconds for the movie
+    :param num_workers: number of svg files to rasterise concurrently (default None, meaning one per core)
+    :param max_in_flight: the maximum number of frames rasterised but not yet consumed by ffmpeg (default None,
+                          meaning twice num_workers)
+    :param print_progress: whether to print running trace of this function (default False)
+    :param archiver: the archiver.Archiver to archive svg files with (default None, meaning gzip level 9)
+    :param max_fps: if given, rasterise only as many svg files as a movie of duration needs at this frame rate
+                    (default None, meaning every svg file)
+    :param sampling: one of frame_sampling.SAMPLING_MODES (default 'even')
+    :param run_log: the run_log.RunLog to record each stage in (default None, meaning a new one)
+
+    :raise Exception: if no svg files found in sim_dir
+    :raise Exception: if any svg file fails to rasterise, or ffmpeg fails
+    """
+    # Only needed when streaming, and requires cairosvg
+    import svg_to_png
+
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+
+    if max_in_flight is None:
+        max_in_flight = 2 * num_workers
+
+    if archiver is None:
+        archiver = Archiver(codec='gz', level=9)
+
+    if run_log is None:
+        run_log = RunLog(print_progress=print_progress, prefix='png_to_mp4')
+
+    # Frames are read directly from a frame archive; any other svg archive is extracted
+    with run_log.stage('extract') as counts:
+        svg_archive = find_archive(sim_dir, 'svg_arch')
+        svg_archive_exists = svg_archive is not None or frame_archive.has_frame_archive(sim_dir)
+        if svg_archive is not None and not frame_archive.has_frame_archive(sim_dir):
+            extract_archive(sim_dir, svg_archive)
+            counts['bytes'] = os.path.getsize(os.path.join(sim_dir, svg_archive))
+            if print_progress:
+                print('png_to_mp4: Extracting svg files from archive ' + svg_archive)
+
+    with run_log.stage('validate') as counts:
+        svg_files = svg_to_png.get_sorted_list_of_svg_in_dir(sim_dir)
+        if len(svg_files) == 0:
+            raise Exception('png_to_mp4: No png or svg files found in ' + sim_dir)
+
+        # Choose the frames the movie needs before rasterising any
+        all_svg_files = svg_files
+        svg_files = frame_sampling.sample_frames(
+            frame_names=svg_files, duration=duration, max_fps=max_fps, mode=sampling,
+            frame_sizes=[frame_archive.frame_size(sim_dir, svg_file) for svg_file in svg_files]
+            if max_fps is not None and sampling == 'keyframe' else None)
+        counts['frames'] = len(all_svg_files)
+
+    if print_progress and len(svg_files) < len(all_svg_files):
+        print('png_to_mp4: Sampled ' + str(len(svg_files)) + ' of ' + str(len(all_svg_files)) + ' frames')
+
+    frame_rate = max(float(len(svg_files)) / duration, 1.0)
+
+    if print_progress:
+        print('png_to_mp4: Streaming svg to mp4 using ' + str(num_workers) + ' processes: ' +
+              ' '.join(['ffmpeg', '-v', '0'] + frame_pipe.pipe_input_args(frame_rate) + output_args))
+
+    def frames(pool):
+        svg_paths = [os.path.join(sim_dir, svg_file) for svg_file in svg_files]
+        for idx, (svg_path, png_bytes, error) in enumerate(
+                frame_pipe.imap_bounded(pool, svg_to_png.render_bytes_with_library, svg_paths, max_in_flight)):
+            if png_bytes is None:
+                raise Exception('png_to_mp4: Failed to rasterise ' + svg_path + ': ' + str(error))
+            if print_progress:
+                print('\t' + str(idx + 1) + ' of ' + str(len(svg_paths)))
+            yield png_bytes
+
+    pool = multiprocessing.Pool(processes=num_workers, initializer=svg_to_png.init_library_worker)
+    try:
+        # Rasterising and encoding overlap, so are timed as one stage
+        with run_log.stage('encode', streamed=True) as counts:
+            frame_pipe.stream_frames_to_ffmpeg(frames=frames(pool), frame_rate=frame_rate, output_args=output_args,
+                                               cwd=sim_dir,
+                                               progress_callback=run_log.ffmpeg_progress(output=movie_names[0]))
+            counts['frames'] = len(svg_files)
+            counts['bytes'] = files_size(sim_dir, movie_names)
+    except Exception:
+        # Don't leave truncated movies behind
+        for movie_name in movie_names:
+            if os.path.isfile(os.path.join(sim_dir, movie_name)):
+                os.remove(os.path.join(sim_dir, movie_name))
+        raise
+    finally:
+        pool.terminate()
+        pool.join()
+
+    archiver.submit(run_log.timed('archive', tidy_svg_files), sim_dir=sim_dir, svg_files=all_svg_files,
+                    svg_archive_exists=svg_archive_exists, archiver=archiver, print_progress=print_progress)
+
+
+def tidy_svg_files(sim_dir, svg_files, svg_archive_exists, archiver, print_progress=False):
+    """ Remove svg files, adding them to an archive if they are not already archived
+
+    :param sim_dir: the directory containing the svg files
+    :param svg_files: list of names of the svg files
+    :param svg_archive_exists: whether the svg files came from an existing svg archive
+    :param archiver: the archiver.Archiver to archive with
+    :param print_progress: whether to print running trace of this function (default False)
+    """
+    if svg_archive_exists:
+        # Frames read directly from a frame archive were never extracted, so there may be nothing to remove
+        extracted_files = [svg_file for svg_file in svg_files if os.path.isfile(os.path.join(sim_dir, svg_file))]
+        if len(extracted_files) > 0:
+            subprocess.call(['rm'] + extracted_files, cwd=sim_dir)
+            if print_progress:
+                print('png_to_mp4: Removed svg files')
+    else:
+        archive_name = archiver.archive_files(sim_dir, svg_files, 'svg_arch')
+        if print_progress:
+            print('png_to_mp4: Archived svg files to ' + archive_name)
 
 
 def list_files_of_type(path_name, extension):
@@ -0,0 +1,116 @@
+import os
+import re
+import xml.etree.ElementTree as ElementTree
+
+import frame_sampling
+
+# Bytes read from the end of a vtu file when checking it is complete
+VTU_TAIL_BYTES = 1024
+
+RESULTS_DIRECTORY_PATTERN = re.compile(r'^results_from_time_([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)$')
+
+
+def find_results_directory(sim_dir):
+    """ Find the results_from_time_X directory of a simulation to make a movie from: the one with the latest start time,
+    which is the one after any initial relaxation simulation
+
+    :param sim_dir: the simulation directory
+    :return: the path of the results directory, or None if there is none
+    """
+    results_dirs = []
+    for directory in os.listdir(sim_dir):
+        match = RESULTS_DIRECTORY_PATTERN.match(directory)
+        if match is not None and os.path.isdir(os.path.join(sim_dir, directory)):
+            results_dirs.append((float(match.group(1)), directory))
+
+    if len(results_dirs) == 0:
+        return None
+
+    # Compare start times as numbers, so that e.g. results_from_time_10 comes after results_from_time_9
+    return os.path.join(sim_dir, max(results_dirs)[1])
+
+
+def read_pvd(pvd_file, allow_truncated=False):
+    """ List the time steps of a pvd file, and the vtu files of each, parsing the pvd as a stream without loading any
+    vtu file or starting ParaView.
+
+    :param pvd_file: path to the pvd file
+    :param allow_truncated: whether to return the time steps read before the end of a pvd file that is cut short, e.g.
+                            by a simulation that did not finish (default False)
+    :return: a list of (time step, list of absolute paths of its vtu files) tuples, sorted by time step, with a single
+             entry per time step as ParaView's PVDReader has
+
+    :raise Exception: if the pvd file is not valid xml, unless allow_truncated
+    :raise Exception: if any DataSet has a missing or non-numeric timestep, or no file
+    """
+    pvd_dir = os.path.dirname(os.path.abspath(pvd_file))
+    files_by_time_step = {}
+
+    try:
+        for _, element in ElementTree.iterparse(pvd_file, events=('end',)):
+            if element.tag == 'DataSet':
+                try:
+                    time_step = float(element.get('timestep'))
+                except (TypeError, ValueError):
+                    raise Exception('pvd_index: Invalid timestep in ' + pvd_file + ': ' + str(element.get('timestep')))
+                if not element.get('file'):
+                    raise Exception('pvd_index: DataSet with no file in ' + pvd_file)
+                files_by_time_step.setdefault(time_step, []).append(os.path.join(pvd_dir, element.get('file')))
+
+            # Only the attributes are needed, so don't keep the parsed tree
+            element.clear()
+    except ElementTree.ParseError as e:
+        if not allow_truncated:
+            raise Exception('pvd_index: Invalid pvd file ' + pvd_file + ': ' + str(e))
+
+    return sorted(files_by_time_step.items())
+
+
+def is_complete_vtu(vtu_path):
+    """ Whether a vtu file is complete, judged by its closing tag being present near its end, reading only its tail """
+    try:
+        size = os.path.getsize(vtu_path)
+    except OSError:
+        return False
+
+    with open(vtu_path, 'rb') as vtu_file:
+        vtu_file.seek(max(0, size - VTU_TAIL_BYTES))
+        return b'</VTKFile>' in vtu_file.read()
+
+
+def check_vtu_files(time_steps):
+    """ Check that the vtu files of each time step exist and are complete
+
+    :param time_steps: a list of (time step, list of vtu paths) tuples, as from read_pvd()
+    :return: a list of descriptions of each missing or truncated vtu file, empty if there are none
+    """
+    problems = []
+    for _, vtu_paths in time_steps:
+        for vtu_path in vtu_paths:
+            if not os.path.isfile(vtu_path):
+                problems.append(vtu_path + ' is missing')
+            elif not is_complete_vtu(vtu_path):
+                problems.append(vtu_path + ' is truncated')
+    return problems
+
+
+def sample_time_steps(time_steps, duration, max_fps=None, mode='even'):
+    """ Choose the time steps needed for a movie of a given duration at no more than max_fps, as for
+    frame_sampling.sample_frames(), using the total size of each time step's vtu files for mode 'keyframe'
+
+    :param time_steps: a list of (time step, list of vtu paths) tuples, as from read_pvd()
+    :param duration: the duration of the movie in seconds
+    :param max_fps: the maximum frame rate of the movie (default None, meaning every time step)
+    :param mode: one of frame_sampling.SAMPLING_MODES (default 'even')
+    :return: a sorted list of indices into time_steps
+    """
+    frame_sizes = None
+    if max_fps is not None and mode == 'keyframe':
+        frame_sizes = [sum(os.path.getsize(vtu_path) for vtu_path in vtu_paths if os.path.isfile(vtu_path))
+                       for _, vtu_paths in time_steps]
+    return frame_sampling.sample_frames(frame_names=list(range(len(time_steps))), duration=duration, max_fps=max_fps,
+                                        mode=mode, frame_sizes=frame_sizes)
+
+
+if __name__ == '__main__':
+    quit('Call pvd_index.read_pvd() on a results.pvd file')
@@ -0,0 +1,160 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+# Pipeline stages timed by the movie functions
+STAGES = ['extract', 'validate', 'rasterise', 'encode', 'archive']
+
+
+class RunLog(object):
+    """ Instrumentation for a run of the movie pipeline: per-stage timers with frame and byte counts, ffmpeg progress,
+    and optionally a JSON-lines event log.
+
+    Each event is one JSON object on its own line, with at least 'time' (seconds since the epoch), 'run' (an id for
+    the run) and 'event' keys.  The log file is opened for each event and appended to with a single write, so several
+    processes may share one log file, e.g. the jobs of movie_batch.make_movies().
+    """
+
+    def __init__(self, log_path=None, print_progress=False, prefix='run_log'):
+        """
+        :param log_path: file to append JSON-lines events to (default None, meaning events are not written)
+        :param print_progress: whether to print a line as each stage finishes (default False)
+        :param prefix: start of each printed line, e.g. the name of the calling function (default 'run_log')
+        """
+        self.log_path = log_path
+        self.print_progress = print_progress
+        self.prefix = prefix
+        self.run_id = None
+        self.context = {}
+        self.stages = {}
+        self.run_start = time.time()
+        self.lock = threading.Lock()
+
+    def start_run(self, **context):
+        """ Start a new run, whose id and context (e.g. sim_dir) are added to every subsequent event
+
+        :param context: fields to add to every event of the run
+        """
+        with self.lock:
+            self.run_start = time.time()
+            self.run_id = '%s-%d-%06d' % (time.strftime('%Y%m%dT%H%M%S'), os.getpid(),
+                                          int(self.run_start * 1e6) % 1000000)
+            self.context = context
+            self.stages = {}
+        self.event('run_start')
+
+    def end_run(self, **fields):
+        """ Record the end of a run, with the totals of each stage
+
+        :param fields: further fields for the event, e.g. status
+        :return: a dict of each stage's totals
+        """
+        with self.lock:
+            stages = dict((name, dict(totals)) for name, totals in self.stages.items())
+        self.event('run_end', seconds=time.time() - self.run_start, stages=stages, **fields)
+        return stages
+
+    def event(self, kind, **fields):
+        """ Record an event
+
+        :param kind: the type of event, e.g. 'stage_end'
+        :param fields: fields of the event, which must be serialisable as JSON
+        """
+        if self.log_path is None:
+            return
+
+        record = {'time': time.time(), 'run': self.run_id, 'event': kind}
+        record.update(self.context)
+        record.update(fields)
+        line = json.dumps(record, sort_keys=True) + '\n'
+
+        with self.lock:
+            with open(self.log_path, 'a') as log_file:
+                log_file.write(line)
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        """ Time a stage of the pipeline, as a context manager.  The context value is a dict in which the stage may
+        record 'frames' and 'bytes', from which throughput is calculated when the stage ends.
+
+        :param name: the stage, e.g. one of STAGES
+        :param fields: further fields for the stage's events
+        """
+        self.event('stage_start', stage=name, **fields)
+        counts = {'frames': 0, 'bytes': 0}
+        start = time.time()
+        status = 'failed'
+        try:
+            yield counts
+            status = 'done'
+        finally:
+            self.record_stage(name, time.time() - start, counts, status, fields)
+
+    def record_stage(self, name, seconds, counts, status, fields):
+        """ Add a finished stage to the totals, and record it """
+        with self.lock:
+            totals = self.stages.setdefault(name, {'seconds': 0.0, 'frames': 0, 'bytes': 0})
+            totals['seconds'] += seconds
+            totals['frames'] += counts['frames']
+            totals['bytes'] += counts['bytes']
+
+        stage_fields = dict(fields, stage=name, seconds=seconds, frames=counts['frames'], bytes=counts['bytes'],
+                            status=status)
+        if counts['frames'] > 0 and seconds > 0:
+            stage_fields['frames_per_second'] = counts['frames'] / seconds
+        self.event('stage_end', **stage_fields)
+
+        if self.print_progress:
+            print('%s: %s %s in %s' % (self.prefix, name, status, format_counts(seconds, counts)))
+
+    def timed(self, name, function):
+        """ Wrap a function so that each call is timed as a stage, e.g. for an archiving task run in the background
+
+        :param name: the stage
+        :param function: the function to wrap
+        :return: the wrapped function
+        """
+        def timed_function(*args, **kwargs):
+            with self.stage(name):
+                return function(*args, **kwargs)
+        return timed_function
+
+    def ffmpeg_progress(self, **fields):
+        """ Get a callback for frame_pipe.run_ffmpeg() that records each ffmpeg progress report as an event
+
+        :param fields: further fields for the events, e.g. the segment
+        :return: a function of a dict of ffmpeg progress values
+        """
+        def record_progress(progress):
+            progress_fields = dict(fields)
+            for key in ['frame', 'fps', 'total_size', 'out_time_ms', 'speed', 'progress', 'segment']:
+                if key in progress:
+                    progress_fields[key] = progress[key]
+            self.event('encode_progress', **progress_fields)
+            if self.print_progress and progress.get('progress') == 'continue':
+                print('%s: encoding frame %s at %s fps' % (self.prefix, progress.get('frame'), progress.get('fps')))
+        return record_progress
+
+
+def format_counts(seconds, counts):
+    """ Describe a stage's time, frame and byte counts in a human-readable string """
+    description = '%.3fs' % seconds
+    if counts['frames'] > 0:
+        description += ', %d frames' % counts['frames']
+        if seconds > 0:
+            description += ' (%.1f frames/s)' % (counts['frames'] / seconds)
+    if counts['bytes'] > 0:
+        description += ', %d bytes' % counts['bytes']
+    return description
+
+
+def files_size(directory, file_names):
+    """ The total size in bytes of those of file_names that exist in directory """
+    return sum(os.path.getsize(os.path.join(directory, file_name)) for file_name in file_names
+               if os.path.isfile(os.path.join(directory, file_name)))
+
+
+if __name__ == '__main__':
+    quit('Create a run_log.RunLog() and pass it to svg_to_webm.svg_to_webm() or png_to_mp4.png_to_mp4()')
@@ -0,0 +1,198 @@
+import math
+import multiprocessing.pool
+import os
+import shutil
+import subprocess
+import tempfile
+
+import encode_profiles
+import frame_pipe
+
+# Number of frames between keyframes in a segmented encode.  Segments are a whole number of GOPs long, so the keyframes
+# of the joined movie fall exactly where a single encode with the same GOP size would put them
+DEFAULT_GOP_SIZE = 60
+
+
+def plan_segments(num_frames, num_segments, gop_size=DEFAULT_GOP_SIZE):
+    """ Split a sequence of frames into roughly equal, GOP-aligned segments
+
+    :param num_frames: the number of frames in the sequence
+    :param num_segments: the number of segments wanted; fewer are used if the sequence is too short
+    :param gop_size: every segment but the last is a multiple of this many frames long
+    :return: a list of (first frame index, number of frames) tuples, in order
+    """
+    segment_length = int(math.ceil(float(num_frames) / num_segments))
+    segment_length = int(math.ceil(float(segment_length) / gop_size)) * gop_size
+    return [(start, min(segment_length, num_frames - start)) for start in range(0, num_frames, segment_length)]
+
+
+def encode_segments(sim_dir, num_frames, frame_rate, outputs, num_segments, threads=None, preset=None,
+                    gop_size=DEFAULT_GOP_SIZE, print_progress=False, progress_callback=None):
+    """ Encode the %04d.png sequence in sim_dir as several segments in concurrent ffmpeg processes, then join the
+    segments of each movie with ffmpeg's concat demuxer, without re-encoding.
+
+    Every segment is encoded at the same frame rate, so the joined movie has the same duration as a single encode.
+
+    :param sim_dir: the directory containing the png files, in which the movies are written
+    :param num_frames: the number of png files
+    :param frame_rate: the frame rate of the movies
+    :param outputs: list of (profile, movie name) tuples, as for encode_profiles.output_args()
+    :param num_segments: the number of segments to encode concurrently
+    :param threads: number of threads each segment's encoders may use (default None, meaning ffmpeg's own choice)
+    :param preset: overrides the encoder preset, as for encode_profiles.output_args() (default None)
+    :param gop_size: number of frames between keyframes (default DEFAULT_GOP_SIZE)
+    :param print_progress: whether to print running trace of this function (default False)
+    :param progress_callback: a function called with each segment's ffmpeg progress reports, as for
+                              frame_pipe.run_ffmpeg(), with a 'segment' key added (default None)
+    :return: the number of segments encoded
+
+    :raise Exception: if num_segments or gop_size is < 1
+    :raise Exception: if ffmpeg fails to encode any segment, or to join the segments
+    """
+    if num_segments < 1:
+        raise Exception('segment_encode: Invalid num_segments: ' + str(num_segments))
+
+    if gop_size < 1:
+        raise Exception('segment_encode: Invalid gop_size: ' + str(gop_size))
+
+    segments = plan_segments(num_frames, num_segments, gop_size)
+
+    # The directory name starts with '.' so that, should it be left behind, it is not swept into res_arch
+    segment_dir = tempfile.mkdtemp(prefix='.segments_', dir=sim_dir)
+
+    def segment_name(output_index, segment_index, movie_name):
+        return os.path.join(segment_dir, '%d_%04d.%s' % (output_index, segment_index,
+                                                         encode_profiles.container_of(movie_name)))
+
+    def encode(segment_index):
+        start, count = segments[segment_index]
+        segment_outputs = [(profile, segment_name(output_index, segment_index, movie_name))
+                           for output_index, (profile, movie_name) in enumerate(outputs)]
+
+        # Parameters, as for a single encode, plus:
+        #   -start_number n    Index of the first png of this segment
+        #   -frames:v count    Number of frames in this segment
+        ffmpeg_command = ['ffmpeg',
+                          '-v', '0',
+                          '-r', str(frame_rate),
+                          '-f', 'image2',
+                          '-start_number', str(start),
+                          '-i', '%04d.png',
+                          '-frames:v', str(count)] + \
+            encode_profiles.output_args(segment_outputs, threads=threads, preset=preset, gop_size=gop_size)
+
+        def segment_progress(progress):
+            progress_callback(dict(progress, segment=segment_index))
+
+        return_code = frame_pipe.run_ffmpeg(ffmpeg_command, cwd=sim_dir,
+                                            progress_callback=None if progress_callback is None else segment_progress)
+        if return_code != 0:
+            raise Exception('segment_encode: ffmpeg returned ' + str(return_code) + ': ' + ' '.join(ffmpeg_command))
+
+        return segment_index
+
+    try:
+        if print_progress:
+            print('segment_encode: Encoding ' + str(num_frames) + ' frames as ' + str(len(segments)) +
+                  ' concurrent segments of up to ' + str(segments[0][1]) + ' frames')
+
+        # Each segment is a separate ffmpeg process, so threads suffice to wait on them
+        pool = multiprocessing.pool.ThreadPool(processes=len(segments))
+        try:
+            for num_done, segment_index in enumerate(pool.imap_unordered(encode, range(len(segments)))):
+                if print_progress:
+                    print('\t' + str(num_done + 1) + ' of ' + str(len(segments)) + ' segments encoded')
+        finally:
+            pool.close()
+            pool.join()
+
+        for output_index, (_, movie_name) in enumerate(outputs):
+            join_segments(sim_dir=sim_dir, segment_names=[segment_name(output_index, segment_index, movie_name)
+                                                          for segment_index in range(len(segments))],
+                          movie_name=movie_name)
+            if print_progress:
+                print('\t... joined segments into ' + movie_name)
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors=True)
+
+    return len(segments)
+
+
+def join_segments(sim_dir, segment_names, movie_name):
+    """ Join movie segments, in order, into a single movie with ffmpeg's concat demuxer, copying rather than
+    re-encoding the video stream
+
+    :param sim_dir: the directory in which to write the movie
+    :param segment_names: absolute paths of the segments, in order
+    :param movie_name: file name for the movie
+
+    :raise Exception: if ffmpeg fails
+    """
+    list_path = os.path.join(os.path.dirname(segment_names[0]), movie_name + '.txt')
+    with open(list_path, 'w') as list_file:
+        for segment_name in segment_names:
+            list_file.write("file '" + segment_name.replace("'", "'\\''") + "'\n")
+
+    # Parameters:
+    #   -f concat          Read the list of segments with the concat demuxer
+    #   -safe 0            Allow absolute paths in the list
+    #   -c copy            Copy the encoded segments without re-encoding
+    ffmpeg_command = ['ffmpeg',
+                      '-v', '0',
+                      '-f', 'concat',
+                      '-safe', '0',
+                      '-i', list_path,
+                      '-c', 'copy']
+
+    # Keep the mp4 index at the start of the file, so it can be played while downloading
+    if encode_profiles.container_of(movie_name) == 'mp4':
+        ffmpeg_command += ['-movflags', '+faststart']
+
+    ffmpeg_command += ['-y', movie_name]
+
+    return_code = subprocess.call(ffmpeg_command, cwd=sim_dir, stdout=open(os.devnull, 'w'),
+                                  stderr=open(os.devnull, 'w'))
+    if return_code != 0:
+        raise Exception('segment_encode: ffmpeg returned ' + str(return_code) + ': ' + ' '.join(ffmpeg_command))
+
+
+def encode_full_rate(sim_dir, num_frames, duration, movie_name, ffmpeg_threads=None, segments=None,
+                     print_progress=False, progress_callback=None, prefix='segment_encode'):
+    """ Encode every png file in sim_dir into a lossless movie, for archival use
+
+    :param sim_dir: the directory containing the png sequence
+    :param num_frames: the number of png files
+    :param duration: required duration in seconds for the movie
+    :param movie_name: file name for the movie
+    :param ffmpeg_threads: number of threads ffmpeg may use (default None, meaning ffmpeg's own choice)
+    :param segments: if given, encode as this many concurrent segments (default None)
+    :param print_progress: whether to print running trace of this function (default False)
+    :param progress_callback: a function called with ffmpeg's progress reports, as for frame_pipe.run_ffmpeg()
+                              (default None)
+    :param prefix: the name with which to start the trace printed, e.g. that of the calling script (default
+                   'segment_encode')
+    """
+    frame_rate = max(float(num_frames) / duration, 1.0)
+    outputs = [(encode_profiles.DEFAULT_PROFILE, movie_name)]
+
+    if segments is not None and segments > 1:
+        segment_threads = None if ffmpeg_threads is None else max(1, ffmpeg_threads // segments)
+        encode_segments(sim_dir=sim_dir, num_frames=num_frames, frame_rate=frame_rate, outputs=outputs,
+                        num_segments=segments, threads=segment_threads, print_progress=print_progress,
+                        progress_callback=progress_callback)
+        return
+
+    ffmpeg_command = ['ffmpeg',
+                      '-v', '0',
+                      '-r', str(frame_rate),
+                      '-f', 'image2',
+                      '-i', '%04d.png'] + encode_profiles.output_args(outputs, threads=ffmpeg_threads)
+
+    if print_progress:
+        print(prefix + ': Creating full-rate movie: ' + ' '.join(ffmpeg_command))
+
+    frame_pipe.run_ffmpeg(ffmpeg_command, cwd=sim_dir, progress_callback=progress_callback)
+
+
+if __name__ == '__main__':
+    quit('Pass segments to svg_to_webm.svg_to_webm() or png_to_mp4.png_to_mp4()')
@@ -0,0 +1,177 @@
+import json
+import os
+import re
+import tempfile
+import xml.parsers.expat
+
+import frame_archive
+
+# Name of the sidecar in a simulation directory recording the dimensions of each svg file.  It starts with '.' so that
+# it is left in place when the other results files are archived
+METADATA_FILE = '.svg_metadata.json'
+
+# Incremented whenever the entries recorded in METADATA_FILE change, so that older sidecars are ignored
+METADATA_VERSION = 1
+
+# Bytes read at a time while looking for the root element, which is normally within the first few hundred bytes
+HEADER_CHUNK_BYTES = 4096
+
+# Size in px of one of each length unit, at the 96 dpi used by inkscape
+UNITS = {'': 1.0, 'px': 1.0, 'pt': 96.0 / 72.0, 'pc': 16.0, 'mm': 96.0 / 25.4, 'cm': 96.0 / 2.54, 'in': 96.0}
+
+LENGTH_PATTERN = re.compile(r'^\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*(px|pt|pc|mm|cm|in)?\s*$')
+
+
+def parse_svg_header(svg_file):
+    """ Read the dimensions of an svg from the attributes of its root element.  The svg is parsed as a stream, and only
+    as far as the end of the root element's start tag, so the cost does not depend on the size of the file, and the
+    start tag may span any number of lines.
+
+    :param svg_file: a binary file object positioned at the start of the svg
+    :return: a dict with the 'width' and 'height' in px, and the 'view_box' as a list of 4 floats or None
+
+    :raise Exception: if no root svg element is found
+    :raise Exception: if the width or height is neither given as an absolute length nor implied by the viewBox
+    """
+    root = {}
+
+    def start_element(name, attributes):
+        if 'name' not in root:
+            root['name'] = name
+            root['attributes'] = attributes
+
+    parser = xml.parsers.expat.ParserCreate()
+    parser.StartElementHandler = start_element
+
+    while 'name' not in root:
+        chunk = svg_file.read(HEADER_CHUNK_BYTES)
+        try:
+            parser.Parse(chunk, len(chunk) == 0)
+        except xml.parsers.expat.ExpatError as error:
+            # Anything malformed after the root element's start tag is of no concern here
+            if 'name' not in root:
+                raise Exception('svg_metadata: Invalid svg header: ' + str(error))
+        if len(chunk) == 0:
+            break
+
+    if root.get('name', '').split(':')[-1] != 'svg':
+        raise Exception('svg_metadata: No root svg element found')
+
+    attributes = root['attributes']
+    view_box = parse_view_box(attributes.get('viewBox'))
+
+    # A missing or relative width or height is that of the viewBox
+    width = parse_length(attributes.get('width'))
+    height = parse_length(attributes.get('height'))
+    if width is None and view_box is not None:
+        width = view_box[2]
+    if height is None and view_box is not None:
+        height = view_box[3]
+
+    if width is None or height is None or width <= 0 or height <= 0:
+        raise Exception('svg_metadata: Could not determine svg dimensions from ' + str(dict(attributes)))
+
+    return {'width': width, 'height': height, 'view_box': view_box}
+
+
+def parse_length(length):
+    """ Convert an svg length attribute to px
+
+    :param length: the attribute value, e.g. '800px' or '210mm', or None
+    :return: the length in px, or None if it is missing or relative, e.g. a percentage
+    """
+    if length is None:
+        return None
+    match = LENGTH_PATTERN.match(length)
+    if match is None:
+        return None
+    return float(match.group(1)) * UNITS[match.group(2) or '']
+
+
+def parse_view_box(view_box):
+    """ Convert an svg viewBox attribute to a list of floats
+
+    :param view_box: the attribute value, e.g. '0 0 800 600', or None
+    :return: a list of [min x, min y, width, height], or None if it is missing or invalid
+    """
+    if view_box is None:
+        return None
+    try:
+        values = [float(value) for value in re.split(r'[\s,]+', view_box.strip())]
+    except ValueError:
+        return None
+    if len(values) != 4 or values[2] <= 0 or values[3] <= 0:
+        return None
+    return values
+
+
+def load_metadata(directory):
+    """ Read the metadata sidecar of a directory
+
+    :param directory: the directory containing METADATA_FILE
+    :return: a dict mapping svg file names to their recorded entries, empty if there is no usable sidecar
+    """
+    try:
+        with open(os.path.join(directory, METADATA_FILE), 'r') as metadata_file:
+            metadata = json.load(metadata_file)
+    except (IOError, OSError, ValueError):
+        return {}
+
+    if not isinstance(metadata, dict) or metadata.get('version') != METADATA_VERSION:
+        return {}
+    return metadata.get('frames', {})
+
+
+def save_metadata(directory, frames):
+    """ Write the metadata sidecar of a directory.  The sidecar only saves work on later runs, so failing to write it,
+    e.g. in a read-only directory, is not an error.
+
+    :param directory: the directory in which to write METADATA_FILE
+    :param frames: a dict mapping svg file names to their entries
+    """
+    # Write to a temporary file and rename, so concurrent readers never see a partial sidecar
+    try:
+        handle, temp_path = tempfile.mkstemp(dir=directory, prefix=METADATA_FILE, suffix='.tmp')
+        with os.fdopen(handle, 'w') as temp_file:
+            json.dump({'version': METADATA_VERSION, 'frames': frames}, temp_file, sort_keys=True)
+        os.rename(temp_path, os.path.join(directory, METADATA_FILE))
+    except (IOError, OSError):
+        pass
+
+
+def frame_dimensions(directory, svg_files):
+    """ Get the dimensions of each of a list of svg files, on disk or in the frame archive.  Only the headers of files
+    not recorded in the metadata sidecar, or changed since they were, are parsed, and the sidecar is then updated.
+
+    :param directory: the directory containing the svg files or frame archive
+    :param svg_files: list of names of the svg files
+    :return: a list of dicts as from parse_svg_header(), one per svg file
+
+    :raise Exception: if the dimensions of any svg file cannot be determined
+    """
+    frames = load_metadata(directory)
+    dimensions = []
+    changed = False
+
+    for svg_file in svg_files:
+        signature = frame_archive.frame_signature(directory, svg_file)
+        entry = frames.get(svg_file)
+        if entry is None or entry.get('signature') != signature:
+            with frame_archive.open_frame(directory, svg_file) as svg_stream:
+                try:
+                    entry = parse_svg_header(svg_stream)
+                except Exception as error:
+                    raise Exception(str(error) + ' in ' + os.path.join(directory, svg_file))
+            entry['signature'] = signature
+            frames[svg_file] = entry
+            changed = True
+        dimensions.append(entry)
+
+    if changed:
+        save_metadata(directory, frames)
+
+    return dimensions
+
+
+if __name__ == '__main__':
+    quit('Call svg_metadata.frame_dimensions() on a simulation directory, or run svg_to_webm.svg_to_webm()')
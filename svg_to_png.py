@@ -1,41 +1,106 @@
 import multiprocessing
+import multiprocessing.pool
 import os
 import subprocess
+import threading
+
+import frame_archive
+from archiver import Archiver, find_archive
 
 try:
     subprocess.call(['cairosvg', '--version'], stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
 except OSError as e:
     raise ImportError('svg_to_png: cairosvg does not seem to be installed: ' + str(e))
 
+# Available conversion engines: a `cairosvg` command per file, or the cairosvg library imported once per worker
+ENGINES = ['command', 'library']
+
+# The cairosvg module, imported by init_library_worker() in each worker process of the 'library' engine
+g_cairosvg = None
+
+# Whether each svg file checked in this process was complete, keyed by path, with the (size, mtime) it was checked at
+g_svg_validity = {}
+g_svg_validity_lock = threading.Lock()
 
-def svg_to_png(path):
+# Number of bytes at the end of an svg file in which to look for the closing tag
+SVG_TAIL_BYTES = 1024
+
+
+def svg_to_png(path, engine='command', chunk_size=32, archiver=None):
     """
     Given `path`, convert every svg file beneath it to a png, using `cairosvg`, in such a way as to consecutively
     name each png within each directory
     :param path: the path beneath which to search for svg files
+    :param engine: one of ENGINES: 'command' runs the cairosvg executable for each file, 'library' renders in-process
+                   in a pool of workers that each import cairosvg once (default 'command')
+    :param chunk_size: number of files sent to a 'library' worker at a time (default 32)
+    :param archiver: an archiver.Archiver to archive the svg files with (default None, meaning gzip level 9)
     """
-
-    # Get a unique list of directories containing svg files
-    svg_dirs = get_set_of_svg_directories(path)
-
-    # Get the list of commands
-    command_list = get_list_of_commands(svg_dirs)
-
-    print('svg_to_png: converting %s svg files using %s processes' % (len(command_list), multiprocessing.cpu_count()))
-
-    # Execute the processes
-    pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
-    pool.map_async(execute_command, command_list).get(86400)
+    if engine not in ENGINES:
+        quit('Py: %s is not a valid engine: expected one of %s' % (engine, ENGINES))
+
+    # Get a unique list of directories containing svg files.  The library engine reads frames straight out of a frame
+    # archive, so only the command engine needs those extracted
+    svg_dirs = get_set_of_svg_directories(path, extract_frame_archives=(engine != 'library'))
+
+    if engine == 'library':
+        conversion_list = get_list_of_conversions(svg_dirs)
+
+        print('svg_to_png: converting %s svg files in-process using %s processes' %
+              (len(conversion_list), multiprocessing.cpu_count()))
+
+        # Files are small and numerous, so dispatch them in chunks and take results in whatever order they finish
+        pool = multiprocessing.Pool(processes=multiprocessing.cpu_count(), initializer=init_library_worker)
+        failures = []
+        try:
+            for svg_name, error in pool.imap_unordered(render_with_library, conversion_list, chunksize=chunk_size):
+                if error is not None:
+                    failures.append('%s (%s)' % (svg_name, error))
+        finally:
+            pool.close()
+            pool.join()
+
+        # Archiving removes the svg files, so stop before then if any of them has no png
+        if len(failures) > 0:
+            for failure in sorted(failures):
+                print('svg_to_png: failed to convert %s' % failure)
+            quit('Py: %s of %s svg files failed to convert: not archiving svg files' %
+                 (len(failures), len(conversion_list)))
+
+    else:
+        # Get the list of commands
+        command_list = get_list_of_commands(svg_dirs)
+
+        print('svg_to_png: converting %s svg files using %s processes' %
+              (len(command_list), multiprocessing.cpu_count()))
+
+        # Execute the processes
+        pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
+        try:
+            return_codes = pool.map_async(execute_command, command_list).get(86400)
+        finally:
+            pool.close()
+            pool.join()
+
+        # As for the library engine, keep the svg files of any that failed
+        failures = [command for command, return_code in zip(command_list, return_codes) if return_code != 0]
+        if len(failures) > 0:
+            for failure in failures:
+                print('svg_to_png: failed: %s' % failure)
+            quit('Py: %s of %s svg files failed to convert: not archiving svg files' %
+                 (len(failures), len(command_list)))
 
     # Archive the svg files in each directory
-    archive_svg_files(svg_dirs)
+    archive_svg_files(svg_dirs, archiver)
 
 
-def get_set_of_svg_directories(path):
+def get_set_of_svg_directories(path, extract_frame_archives=True):
     """
     Determine the set of all directories under `path` containing svg files, or archives which will be extracted
     :param path: the path under which to search
-    :return: a set of paths under `path` each of which contains at least one svg file
+    :param extract_frame_archives: whether to extract frame archives (svg_arch.zip) too, rather than leaving their
+                                   frames to be read directly from the archive (default True)
+    :return: a set of paths under `path` each of which contains at least one svg file, or a frame archive
     """
     if not os.path.isdir(path):
         quit('Py: %s is not a valid directory' % path)
@@ -48,13 +113,19 @@ def get_set_of_svg_directories(path):
         for file_name in file_names:
             if file_name.endswith('.svg'):
                 svg_directories.add(root)
-            elif file_name == 'svg_arch.tar.gz':
+            elif file_name == frame_archive.FRAME_ARCHIVE and not extract_frame_archives:
+                svg_directories.add(root)
+            elif (file_name.startswith('svg_arch.tar.') or file_name == frame_archive.FRAME_ARCHIVE) and \
+                    root not in archives:
                 archives.append(root)
 
     # Extract any archives in-place
     for archive in archives:
-        subprocess.call(['tar', '-zxf', 'svg_arch.tar.gz', '--overwrite'], cwd=archive)
-        svg_directories.add(archive)
+        if frame_archive.has_frame_archive(archive) and not extract_frame_archives:
+            continue
+        if frame_archive.has_frame_archive(archive) or find_archive(archive, 'svg_arch') is not None:
+            frame_archive.extract_frames(archive)
+            svg_directories.add(archive)
 
     return svg_directories
 
@@ -65,23 +136,34 @@ def get_list_of_commands(svg_dirs):
     :param svg_dirs: the list of directories containing svg files
     :return: a list of commands
     """
-    command_list = []
+    return ['cairosvg %s -o %s' % conversion for conversion in get_list_of_conversions(svg_dirs)]
+
+
+def get_list_of_conversions(svg_dirs):
+    """
+    Get a list of (svg path, png path) pairs, naming the pngs consecutively from 0 within each directory
+    :param svg_dirs: the list of directories containing svg files
+    :return: a list of (svg path, png path) tuples
+    """
+    conversion_list = []
+    svg_files_by_dir = scan_svg_directories(svg_dirs)
 
     # Each directory must be processed separately so that PNGs can be sequentially named from 0
-    for svg_dir in svg_dirs:
-        svg_files = get_sorted_list_of_svg_in_dir(svg_dir)
+    for svg_dir in sorted(svg_dirs):
+        svg_files = svg_files_by_dir[svg_dir]
 
         for idx, file_name in enumerate(svg_files):
             svg_name = os.path.join(svg_dir, file_name)
             png_name = os.path.join(svg_dir, str(idx).zfill(4) + '.png')
-            command_list.append('cairosvg %s -o %s' % (svg_name, png_name))
+            conversion_list.append((svg_name, png_name))
 
-    return command_list
+    return conversion_list
 
 
 def get_sorted_list_of_svg_in_dir(svg_dir):
     """
-    Calculated an alphabetically-sorted list of svg files in a given directory
+    Calculated an alphabetically-sorted list of svg files in a given directory, or in its frame archive if it has one
+    and the svg files have not been extracted
     :param svg_dir: the directory in which to look for svg files
     :return: a sorted list of svg files
     """
@@ -90,34 +172,136 @@ def get_sorted_list_of_svg_in_dir(svg_dir):
 
     list_of_files = os.listdir(svg_dir)
 
+    # Frames in a frame archive were checked for completeness when it was written
+    if frame_archive.FRAME_ARCHIVE in list_of_files and not any(name.endswith('.svg') for name in list_of_files):
+        return frame_archive.list_frames(svg_dir)
+
     list_of_svg = []
     for file_name in list_of_files:
-        if file_name.endswith('.svg'):
-            # Verify the svg file is valid by finding the closing xml tag
-            with open(os.path.join(svg_dir, file_name), 'r') as svg_file:
-                if '</svg>' in svg_file.read():
-                    list_of_svg.append(file_name)
+        if file_name.endswith('.svg') and is_complete_svg_file(os.path.join(svg_dir, file_name)):
+            list_of_svg.append(file_name)
 
     return sorted(list_of_svg)
 
 
+def is_complete_svg_file(svg_path):
+    """
+    Verify an svg file is valid by finding the closing xml tag near its end, reading only the tail of the file.  The
+    result is remembered for as long as the file's size and modification time are unchanged.
+    :param svg_path: path to the svg file
+    :return: whether the svg file is complete
+    """
+    try:
+        stat = os.stat(svg_path)
+    except OSError:
+        return False
+    signature = (stat.st_size, stat.st_mtime)
+
+    with g_svg_validity_lock:
+        cached = g_svg_validity.get(svg_path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    with open(svg_path, 'rb') as svg_file:
+        svg_file.seek(max(0, stat.st_size - SVG_TAIL_BYTES))
+        is_complete = frame_archive.is_complete_svg(svg_file.read())
+
+    with g_svg_validity_lock:
+        g_svg_validity[svg_path] = (signature, is_complete)
+    return is_complete
+
+
+def scan_svg_directories(svg_dirs, num_threads=None):
+    """
+    List the valid svg files in several directories concurrently
+    :param svg_dirs: the list of directories containing svg files
+    :param num_threads: number of directories to scan at once (default None, meaning one per core)
+    :return: a dict mapping each directory to its sorted list of svg files
+    """
+    svg_dirs = sorted(svg_dirs)
+    if len(svg_dirs) < 2:
+        return {svg_dir: get_sorted_list_of_svg_in_dir(svg_dir) for svg_dir in svg_dirs}
+
+    if num_threads is None:
+        num_threads = multiprocessing.cpu_count()
+
+    # Scanning is dominated by waiting on the file system, so threads suffice
+    pool = multiprocessing.pool.ThreadPool(processes=min(num_threads, len(svg_dirs)))
+    try:
+        return dict(zip(svg_dirs, pool.map(get_sorted_list_of_svg_in_dir, svg_dirs)))
+    finally:
+        pool.close()
+        pool.join()
+
+
 def execute_command(cmd):
     """ Helper function to execute a single command in a multiprocessing Pool """
     return subprocess.call(cmd, shell=True)
 
 
-def archive_svg_files(svg_dirs):
+def init_library_worker():
+    """ Initializer for each multiprocessing Pool worker of the 'library' engine: import cairosvg once """
+    global g_cairosvg
+    import cairosvg
+    g_cairosvg = cairosvg
+
+
+def render_with_library(conversion):
+    """
+    Helper function to render a single svg to png with the cairosvg library in a multiprocessing Pool
+    :param conversion: tuple of (svg path, png path), where the svg may be in its directory's frame archive
+    :return: tuple of (svg path, None on success or a description of the error)
+    """
+    svg_name, png_name = conversion
+    try:
+        svg_bytes = frame_archive.read_frame(os.path.dirname(svg_name), os.path.basename(svg_name))
+        g_cairosvg.svg2png(bytestring=svg_bytes, write_to=png_name)
+    except Exception as e:
+        return svg_name, str(e)
+    return svg_name, None
+
+
+def render_bytes_with_library(svg_name):
+    """
+    Helper function to render a single svg to png contents with the cairosvg library in a multiprocessing Pool
+    :param svg_name: path to the svg file, which may be in its directory's frame archive
+    :return: tuple of (svg path, png contents or None on failure, None on success or a description of the error)
+    """
+    try:
+        svg_bytes = frame_archive.read_frame(os.path.dirname(svg_name), os.path.basename(svg_name))
+        return svg_name, g_cairosvg.svg2png(bytestring=svg_bytes), None
+    except Exception as e:
+        return svg_name, None, str(e)
+
+
+def archive_svg_files(svg_dirs, archiver=None):
     """
     Archive svg files within each svg directory
     :param svg_dirs: the list of directories containing svg files
+    :param archiver: an archiver.Archiver to archive with; in background mode, each directory is archived while the
+                     next is listed, and this function waits for all to finish (default None, meaning gzip level 9)
     """
 
     # Max compression
-    os.environ['GZIP'] = '-9'
+    if archiver is None:
+        archiver = Archiver(codec='gz', level=9)
+
+    # Files checked while building the conversions are not read again here, unless they have changed since
+    svg_files_by_dir = scan_svg_directories(svg_dirs)
+
+    for svg_dir in sorted(svg_dirs):
+        svg_files = [svg_file for svg_file in svg_files_by_dir[svg_dir]
+                     if os.path.isfile(os.path.join(svg_dir, svg_file))]
+        if len(svg_files) == 0:
+            continue
+
+        # Keep the frame archive format of a directory that already has one
+        if frame_archive.has_frame_archive(svg_dir):
+            archiver.submit(frame_archive.create_frame_archive, svg_dir, svg_files)
+        else:
+            archiver.submit(archiver.archive_files, svg_dir, svg_files, 'svg_arch')
 
-    for svg_dir in svg_dirs:
-        svg_files = get_sorted_list_of_svg_in_dir(svg_dir)
-        subprocess.call(['tar', '-zcf', 'svg_arch.tar.gz', '--remove-files'] + svg_files, cwd=svg_dir)
+    archiver.wait()
 
 
 if __name__ == '__main__':
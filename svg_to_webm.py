@@ -1,6 +1,30 @@
+import multiprocessing
+import multiprocessing.pool
 import os
-import re
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+import encode_profiles
+import frame_archive
+import frame_pipe
+import frame_sampling
+import segment_encode
+import svg_metadata
+from archiver import Archiver, extract_archive, find_archive, is_archive
+from run_log import RunLog, files_size
 
 # First, check that inkscape and ffmpeg are installed
 try:
@@ -13,7 +37,18 @@ except OSError as e:
     raise ImportError('svg_to_webm: inkscape does not seem to be installed: ' + str(e))
 
 
-def svg_to_webm(sim_dir, webm_name='results.webm', webm_aspect_ratio=1.0, webm_duration=15.0, print_progress=False):
+# Scratch space for frames in transit, memory-backed where available
+SCRATCH_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# Available methods of converting svg to png: a fresh inkscape process per frame, or long-lived inkscape shells
+RENDERERS = ['inkscape', 'inkscape-shell']
+
+
+def svg_to_webm(sim_dir, webm_name='results.webm', webm_aspect_ratio=1.0, webm_duration=15.0, print_progress=False,
+                num_workers=None, renderer='inkscape', stream=False, max_in_flight=None, frame_cache=None,
+                ffmpeg_threads=None, archiver=None, profile=encode_profiles.DEFAULT_PROFILE, preset=None,
+                extra_outputs=None, segments=None, max_fps=None, sampling='even', full_rate_name=None, run_log=None,
+                rasterise_only=False):
     """ Convert a sequence of svg files to a webm movie via a sequence of png files
 
     :param sim_dir: the directory containing the simulation output
@@ -21,14 +56,55 @@ def svg_to_webm(sim_dir, webm_name='results.webm', webm_aspect_ratio=1.0, webm_d
     :param webm_aspect_ratio: required aspect ratio for the webm (default 1.0)
     :param webm_duration: required duration in seconds for the webm (default 15.0)
     :param print_progress: whether to print running trace of this function (default False)
+    :param num_workers: number of svg files to convert concurrently (default None, meaning one per core)
+    :param renderer: one of RENDERERS: 'inkscape' launches a process per frame, 'inkscape-shell' streams frames to
+                     num_workers long-lived inkscape shells (default 'inkscape')
+    :param stream: whether to pipe rasterised frames straight into ffmpeg rather than writing a png sequence to
+                   sim_dir; only applies if sim_dir does not already contain png files (default False)
+    :param max_in_flight: when streaming, the maximum number of frames rasterised but not yet consumed by ffmpeg
+                          (default None, meaning twice num_workers)
+    :param frame_cache: a frame_cache.FrameCache from which to take frames whose svg content, crop and renderer are
+                        unchanged since they were last rasterised, and to which new frames are added (default None)
+    :param ffmpeg_threads: number of threads ffmpeg may use (default None, meaning ffmpeg's own choice)
+    :param archiver: an archiver.Archiver to archive the svg and results files with; if it is in background mode,
+                     archiving continues after this function returns (default None, meaning gzip level 9)
+    :param profile: one of encode_profiles.PROFILES, setting the codec options for the webm (default
+                    'archival-lossless')
+    :param preset: overrides the encoder preset of each output whose codec has that preset, e.g. 'realtime' for vp9
+                   or 'veryfast' for h264 (default None)
+    :param extra_outputs: list of (profile, movie name) tuples for further movies, e.g. [('web-small', 'small.mp4')],
+                          encoded by the same ffmpeg process from the same frames (default None)
+    :param segments: if given, encode a png sequence as this many GOP-aligned segments in concurrent ffmpeg processes,
+                     sharing ffmpeg_threads between them, and join the segments without re-encoding; streamed frames
+                     always go to a single ffmpeg process (default None, meaning a single ffmpeg process)
+    :param max_fps: if given, keep only as many frames as a webm of webm_duration needs at this frame rate, choosing
+                    them before any svg file is rasterised (default None, meaning every frame)
+    :param sampling: one of frame_sampling.SAMPLING_MODES, how to choose the frames kept when max_fps is given
+                     (default 'even')
+    :param full_rate_name: if given, also make a lossless movie of this name from every frame, for archival use; every
+                           svg file is then rasterised, to a png sequence rather than streamed (default None)
+    :param run_log: a run_log.RunLog recording the time taken, frames and bytes of each stage, and ffmpeg's encoding
+                    progress; with a log_path, these are written as JSON-lines events (default None, meaning stage
+                    timings are printed if print_progress)
+    :param rasterise_only: whether to stop once the svg files are rasterised to a png sequence, leaving the movies to a
+                           later call, which finds the png files, so that the stages can be scheduled separately; the
+                           svg files are still passed to the archiver (default False)
     :return: nothing
 
     :raise Exception: if sim_dir is not a valid directory
     :raise Exception: if webm_aspect_ratio is < 1.0
     :raise Exception: if webm_duration is < 1.0
+    :raise Exception: if num_workers is < 1
+    :raise Exception: if renderer is not one of RENDERERS
+    :raise Exception: if max_in_flight is < 1
+    :raise Exception: if profile, or the profile or extension of any extra output, is not valid
+    :raise Exception: if segments is < 1
+    :raise Exception: if sampling is not one of frame_sampling.SAMPLING_MODES, or the extension of full_rate_name is
+                      not valid
     :raise Exception: if no svg files found in sim_dir
-    :raise Exception: if ffmpeg does not generate webm file
-    :raise Exception: if ffmpeg does not generate valid webm file (at least 1kb in size)
+    :raise Exception: if any svg file fails to convert to png
+    :raise Exception: if ffmpeg does not generate each movie file
+    :raise Exception: if ffmpeg does not generate each movie file validly (at least 1kb in size)
     """
     # Validate and process input
     if not (os.path.isdir(sim_dir)):
@@ -43,124 +119,298 @@ def svg_to_webm(sim_dir, webm_name='results.webm', webm_aspect_ratio=1.0, webm_d
     if webm_duration < 1.0:
         raise Exception('svg_to_webm: Invalid webm_duration: ' + str(webm_duration))
 
-    # Set GZIP environment variable to give max compression in tar stages
-    os.environ['GZIP'] = '-9'
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+
+    if num_workers < 1:
+        raise Exception('svg_to_webm: Invalid num_workers: ' + str(num_workers))
+
+    if renderer not in RENDERERS:
+        raise Exception('svg_to_webm: Invalid renderer: ' + str(renderer))
+
+    if max_in_flight is None:
+        max_in_flight = 2 * num_workers
+
+    if max_in_flight < 1:
+        raise Exception('svg_to_webm: Invalid max_in_flight: ' + str(max_in_flight))
+
+    outputs = [(profile, webm_name)] + list(extra_outputs or [])
+    for output_profile, movie_name in outputs:
+        if output_profile not in encode_profiles.PROFILES:
+            raise Exception('svg_to_webm: Invalid profile: ' + str(output_profile))
+        encode_profiles.container_of(movie_name)
+    movie_names = [movie_name for _, movie_name in outputs]
+
+    if segments is not None and segments < 1:
+        raise Exception('svg_to_webm: Invalid segments: ' + str(segments))
+
+    if sampling not in frame_sampling.SAMPLING_MODES:
+        raise Exception('svg_to_webm: Invalid sampling: ' + str(sampling))
+
+    if full_rate_name is not None:
+        encode_profiles.container_of(full_rate_name)
+
+    # Default to max compression in tar stages
+    if archiver is None:
+        archiver = Archiver(codec='gz', level=9)
+
+    if run_log is None:
+        run_log = RunLog(print_progress=print_progress, prefix='svg_to_webm')
+    run_log.start_run(function='svg_to_webm', sim_dir=sim_dir)
 
     png_files = list_files_of_type(path_name=sim_dir, extension='.png')
 
     # "New" behaviour is to pre-convert the png files, so they may already exist.  Only convert them if necessary
+    # A full-rate movie needs every frame as well as the sampled ones, so is made from a png sequence
+    streaming = stream and len(png_files) == 0 and full_rate_name is None and not rasterise_only
     if len(png_files) == 0:
 
-        # Check whether an svg archive exists.  If it does, extract it.  Then, list all svg files in the directory
-        svg_archive_exists = 'svg_arch.tar.gz' in os.listdir(sim_dir)
+        with run_log.stage('extract') as counts:
+            # Check whether an svg archive exists.  An indexed frame archive is read from directly; any other archive
+            # is extracted.  Then, list all svg files in the directory
+            svg_archive = find_archive(sim_dir, 'svg_arch')
+            svg_archive_exists = svg_archive is not None or frame_archive.has_frame_archive(sim_dir)
+
+            if frame_archive.has_frame_archive(sim_dir):
+                svg_files = frame_archive.list_frames(sim_dir)
+                if print_progress:
+                    print('svg_to_webm: Reading svg files directly from archive ' + frame_archive.FRAME_ARCHIVE)
+            else:
+                if svg_archive_exists:
+                    extract_archive(sim_dir, svg_archive)
+                    if print_progress:
+                        print('svg_to_webm: Extracting svg files from archive ' + svg_archive)
+
+                svg_files = list_files_of_type(path_name=sim_dir, extension='.svg')
+
+            # If there aren't any svg files at this point, something has gone wrong
+            if len(svg_files) == 0:
+                raise Exception('svg_to_webm: No svg files found in ' + sim_dir)
+            counts['frames'] = len(svg_files)
+
+        with run_log.stage('validate') as counts:
+            # Choose the frames the webm needs before rasterising any, unless every frame is needed for a full-rate
+            # movie
+            all_svg_files = svg_files
+            if full_rate_name is None:
+                svg_files = frame_sampling.sample_frames(
+                    frame_names=svg_files, duration=webm_duration, max_fps=max_fps, mode=sampling,
+                    frame_sizes=[frame_archive.frame_size(sim_dir, svg_file) for svg_file in svg_files]
+                    if max_fps is not None and sampling == 'keyframe' else None)
+                if print_progress and len(svg_files) < len(all_svg_files):
+                    print('svg_to_webm: Sampled ' + str(len(svg_files)) + ' of ' + str(len(all_svg_files)) + ' frames')
+
+            # Calculate the information necessary to convert and crop each svg to png, from the dimensions recorded
+            # in the metadata sidecar, or parsed from the header of any svg file not yet recorded there
+            file_infos = calculate_frame_infos(sim_dir=sim_dir, svg_files=svg_files, aspect_ratio=webm_aspect_ratio)
 
-        if svg_archive_exists:
-            subprocess.call(['tar', '-zxf', 'svg_arch.tar.gz', '--overwrite'], cwd=sim_dir)
             if print_progress:
-                print('svg_to_webm: Extracting svg files from archive svg_arch.tar.gz')
-
-        svg_files = list_files_of_type(path_name=sim_dir, extension='.svg')
-
-        # If there aren't any svg files at this point, something has gone wrong
-        if len(svg_files) == 0:
-            raise Exception('svg_to_webm: No svg files found in ' + sim_dir)
+                num_crops = len(set(file_info['crop_string'] for file_info in file_infos))
+                print('svg_to_webm: Calculated file information: ' + str(file_infos[0]) +
+                      ('' if num_crops == 1 else ' (and ' + str(num_crops - 1) + ' other crop areas)'))
+            counts['frames'] = len(svg_files)
+
+    # When streaming, the svg files are rasterised while ffmpeg runs, so there are no png files to count
+    if not streaming:
+        if len(png_files) == 0:
+
+            with run_log.stage('rasterise', renderer=renderer) as counts:
+                # Convert each svg to png
+                if print_progress:
+                    print('svg_to_webm: Converting svg to png using ' + str(num_workers) + ' ' + renderer +
+                          ' processes...')
+                failed_frames, frame_times = convert_svg_files(path_to_files=sim_dir, svg_files=svg_files,
+                                                               file_infos=file_infos, num_workers=num_workers,
+                                                               print_progress=print_progress, renderer=renderer,
+                                                               frame_cache=frame_cache)
+
+                # Don't leave a partial png sequence behind: it would be mistaken for a complete one on the next run
+                if len(failed_frames) > 0:
+                    subprocess.call(['rm', '-f'] + list_files_of_type(path_name=sim_dir, extension='.png'),
+                                    cwd=sim_dir)
+                    raise Exception('svg_to_webm: Failed to convert svg to png: ' + '; '.join(failed_frames))
+
+                if print_progress:
+                    print('\t... finished converting svg to png: ' + summarise_frame_times(frame_times))
+                counts['frames'] = len(svg_files) - len(failed_frames)
+                counts['bytes'] = files_size(sim_dir, list_files_of_type(path_name=sim_dir, extension='.png'))
+
+            archiver.submit(run_log.timed('archive', tidy_svg_files), sim_dir=sim_dir, svg_files=all_svg_files,
+                            svg_archive_exists=svg_archive_exists, archiver=archiver, print_progress=print_progress)
+
+            png_files = list_files_of_type(path_name=sim_dir, extension='.png')
+
+        if rasterise_only:
+            run_log.end_run(status='rasterised', frames=len(png_files))
+            return
+
+        # Existing png files, or those rasterised for a full-rate movie, may still be more than the webm needs
+        sampled_png_files = frame_sampling.sample_frames(
+            frame_names=png_files, duration=webm_duration, max_fps=max_fps, mode=sampling,
+            frame_sizes=[os.path.getsize(os.path.join(sim_dir, png_file)) for png_file in png_files]
+            if max_fps is not None and sampling == 'keyframe' else None)
+        num_frames = len(sampled_png_files)
+    else:
+        num_frames = len(svg_files)
 
-        # Use the first svg file to calculate information necessary to convert and crop the svg to png
-        file_info = calculate_image_info(svg_file_path=os.path.join(sim_dir, svg_files[0]),
-                                         aspect_ratio=webm_aspect_ratio)
+    # Set how long you want the video to be (in seconds), and set the frame rate accordingly, with a minimum of 1.0
+    frame_rate = max(float(num_frames) / webm_duration, 1.0)
 
-        if print_progress:
-            print('svg_to_webm: Calculated file information: ' + str(file_info))
+    # Parameters for the ffmpeg output, following the input parameters: the codec options of each output's profile,
+    # optionally limiting the number of threads ffmpeg uses, e.g. to leave cores for other jobs, then
+    #   -y name.webm       Output directory and name
+    output_args = encode_profiles.output_args(outputs, threads=ffmpeg_threads, preset=preset)
 
-        # Convert each svg to png
-        if print_progress:
-            print('svg_to_webm: Converting svg to png...')
-        for idx, svg_file in enumerate(svg_files):
-            svg_to_png(path_to_files=sim_dir, file_name=svg_file, file_info=file_info, index=idx)
+    with run_log.stage('encode', streamed=streaming) as counts:
+        if streaming:
             if print_progress:
-                print('\t' + str(idx + 1) + ' of ' + str(len(svg_files)))
-        if print_progress:
-            print('\t... finished converting svg to png.')
-
-        # Tidy up: Remove svg files, adding them to an archive if they are not already archived
-        if svg_archive_exists:
-            subprocess.call(['rm'] + svg_files, cwd=sim_dir)
+                print('svg_to_webm: Streaming svg to webm using ' + str(num_workers) + ' ' + renderer +
+                      ' processes: ' + ' '.join(['ffmpeg', '-v', '0'] + frame_pipe.pipe_input_args(frame_rate) +
+                                                output_args))
+
+            try:
+                frame_pipe.stream_frames_to_ffmpeg(
+                    frames=iterate_png_frames(path_to_files=sim_dir, svg_files=svg_files, file_infos=file_infos,
+                                              num_workers=num_workers, renderer=renderer, max_in_flight=max_in_flight,
+                                              print_progress=print_progress, frame_cache=frame_cache),
+                    frame_rate=frame_rate, output_args=output_args, cwd=sim_dir,
+                    progress_callback=run_log.ffmpeg_progress(output=webm_name))
+            except Exception:
+                # Don't leave truncated movies behind
+                for movie_name in movie_names:
+                    if os.path.isfile(os.path.join(sim_dir, movie_name)):
+                        os.remove(os.path.join(sim_dir, movie_name))
+                raise
+
+        elif num_frames < len(png_files):
+            # Only some of the png files are wanted, so pipe just those into ffmpeg
             if print_progress:
-                print('svg_to_webm: Removed svg files')
+                print('svg_to_webm: Creating webm from ' + str(num_frames) + ' of ' + str(len(png_files)) +
+                      ' png files: ' + ' '.join(['ffmpeg', '-v', '0'] + frame_pipe.pipe_input_args(frame_rate) +
+                                                output_args))
+
+            frame_pipe.stream_frames_to_ffmpeg(frames=frame_pipe.read_frame_files(sim_dir, sampled_png_files),
+                                               frame_rate=frame_rate, output_args=output_args, cwd=sim_dir,
+                                               progress_callback=run_log.ffmpeg_progress(output=webm_name))
+
+        elif segments is not None and segments > 1:
+            # Share the ffmpeg threads between the concurrent segments
+            segment_threads = None if ffmpeg_threads is None else max(1, ffmpeg_threads // segments)
+            segment_encode.encode_segments(sim_dir=sim_dir, num_frames=num_frames, frame_rate=frame_rate,
+                                           outputs=outputs, num_segments=segments, threads=segment_threads,
+                                           preset=preset, print_progress=print_progress,
+                                           progress_callback=run_log.ffmpeg_progress(output=webm_name))
+
         else:
-            subprocess.call(['tar', '-zcf', 'svg_arch.tar.gz', '--remove-files'] + svg_files, cwd=sim_dir)
+            # Send the subprocess call to run ffmpeg. Parameters:
+            #   -v 0               Suppress console output so as not to clutter the terminal
+            #   -r frame_rate      Set the frame rate calculated above
+            #   -f image2          Set the convert format (image sequence to video)
+            #   -i %04d.png        Input expected as dir/results.####.png, the output from WriteAnimation above
+            ffmpeg_command = ['ffmpeg',
+                              '-v', '0',
+                              '-r', str(frame_rate),
+                              '-f', 'image2',
+                              '-i', '%04d.png'] + output_args
+
             if print_progress:
-                print('svg_to_webm: Archived svg files to svg_arch.tar.gz')
+                print('svg_to_webm: Creating webm: ' + ' '.join(ffmpeg_command))
+
+            frame_pipe.run_ffmpeg(ffmpeg_command, cwd=sim_dir,
+                                  progress_callback=run_log.ffmpeg_progress(output=webm_name))
+
+        if full_rate_name is not None:
+            segment_encode.encode_full_rate(sim_dir=sim_dir, num_frames=len(png_files), duration=webm_duration,
+                                            movie_name=full_rate_name, ffmpeg_threads=ffmpeg_threads,
+                                            segments=segments, print_progress=print_progress,
+                                            progress_callback=run_log.ffmpeg_progress(output=full_rate_name),
+                                            prefix='svg_to_webm')
+            movie_names.append(full_rate_name)
+        counts['frames'] = num_frames
+        counts['bytes'] = files_size(sim_dir, movie_names)
+
+    if streaming:
+        archiver.submit(run_log.timed('archive', tidy_svg_files), sim_dir=sim_dir, svg_files=all_svg_files,
+                        svg_archive_exists=svg_archive_exists, archiver=archiver, print_progress=print_progress)
+
+    for movie_name in movie_names:
+        # Raise exception if the movie file is not generated as expected
+        if not os.path.isfile(os.path.join(sim_dir, movie_name)):
+            raise Exception('svg_to_webm: ' + movie_name + ' not generated as expected')
+
+        # Raise exception if the movie file file is created but is smaller than 1kb - ffmpeg sometimes
+        # generates an empty file even if an error occurs
+        if os.path.getsize(os.path.join(sim_dir, movie_name)) < 1024:
+            raise Exception('svg_to_webm: ' + movie_name + ' not generated as expected')
 
-        png_files = list_files_of_type(path_name=sim_dir, extension='.png')
+    if print_progress:
+        print('\t... finished creating ' + ', '.join(movie_names))
 
-    # Set how long you want the video to be (in seconds), and set the frame rate accordingly, with a minimum of 1.0
-    frame_rate = max(float(len(png_files)) / webm_duration, 1.0)
-
-    # Send the subprocess call to run ffmpeg. Parameters:
-    #   -v 0               Suppress console output so as not to clutter the terminal
-    #   -r frame_rate      Set the frame rate calculated above
-    #   -f image2          Set the convert format (image sequence to video)
-    #   -i %04d.png        Input expected as dir/results.####.png, the output from WriteAnimation above
-    #   -c:v libvpx-vp9    Video codec to use is vp9
-    #   -tile-columns 6    Encode in 6 columns to enable decoding using multiple threads
-    #   -frame-parallel 1  Allow decoding using multiple threads
-    #   -lossless', '1'    Set video quality to lossless
-    #   -y name.webm       Output directory and name
-    ffmpeg_command = ['ffmpeg',
-                      '-v', '0',
-                      '-r', str(frame_rate),
-                      '-f', 'image2',
-                      '-i', '%04d.png',
-                      '-c:v', 'libvpx-vp9',
-                      '-tile-columns', '6',
-                      '-frame-parallel', '1',
-                      '-lossless', '1',
-                      '-y', webm_name]
+    archiver.submit(run_log.timed('archive', tidy_results), sim_dir=sim_dir, png_files=png_files,
+                    movie_names=movie_names, archiver=archiver, print_progress=print_progress)
 
-    if print_progress:
-        print('svg_to_webm: Creating webm: ' + ' '.join(ffmpeg_command))
+    run_log.end_run(status='done', movies=movie_names)
 
-    subprocess.call(ffmpeg_command, cwd=sim_dir, stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+    # Reset terminal
+    os.system('stty sane')
 
-    # Raise exception if the webm file is not generated as expected
-    if not os.path.isfile(os.path.join(sim_dir, webm_name)):
-        raise Exception('svg_to_webm: webm not generated as expected')
 
-    # Raise exception if the webm file file is created but is smaller than 1kb - ffmpeg sometimes
-    # generates an empty file even if an error occurs
-    if os.path.getsize(os.path.join(sim_dir, webm_name)) < 1024:
-        raise Exception('svg_to_webm: webm not generated as expected')
+def tidy_svg_files(sim_dir, svg_files, svg_archive_exists, archiver, print_progress=False):
+    """ Remove svg files, adding them to an archive if they are not already archived
+
+    :param sim_dir: the directory containing the svg files
+    :param svg_files: list of names of the svg files
+    :param svg_archive_exists: whether the svg files came from an existing svg archive
+    :param archiver: the archiver.Archiver to archive with
+    :param print_progress: whether to print running trace of this function (default False)
+    """
+    if svg_archive_exists:
+        # Frames read directly from a frame archive were never extracted, so there may be nothing to remove
+        extracted_files = [svg_file for svg_file in svg_files if os.path.isfile(os.path.join(sim_dir, svg_file))]
+        if len(extracted_files) > 0:
+            subprocess.call(['rm'] + extracted_files, cwd=sim_dir)
+            if print_progress:
+                print('svg_to_webm: Removed svg files')
+    else:
+        archive_name = archiver.archive_files(sim_dir, svg_files, 'svg_arch')
+        if print_progress:
+            print('svg_to_webm: Archived svg files to ' + archive_name)
 
-    if print_progress:
-        print('\t... finished creating webm: ' + webm_name)
 
+def tidy_results(sim_dir, png_files, movie_names, archiver, print_progress=False):
+    """ Delete png files, and archive vtu, pvd and any other results files, leaving only the movies and archives
+
+    :param sim_dir: the directory containing the simulation output
+    :param png_files: list of names of the png files
+    :param movie_names: list of names of the movie files just made, which are left in place
+    :param archiver: the archiver.Archiver to archive with
+    :param print_progress: whether to print running trace of this function (default False)
+    """
     # Tidy up: Delete all png files
-    subprocess.call(['rm'] + png_files, cwd=sim_dir)
-    if print_progress:
-        print('svg_to_webm: Removed png files')
+    if len(png_files) > 0:
+        subprocess.call(['rm'] + png_files, cwd=sim_dir)
+        if print_progress:
+            print('svg_to_webm: Removed png files')
 
     # Tidy up: compress any vtu and pvd files, if they exist
     vtu_files = list_files_of_type(sim_dir, '.vtu') + list_files_of_type(sim_dir, '.pvd')
     if len(vtu_files) > 0:
-        subprocess.call(['tar', '-zcf', 'vtu_arch.tar.gz', '--remove-files'] + vtu_files, cwd=sim_dir)
+        archiver.archive_files(sim_dir, vtu_files, 'vtu_arch')
         if print_progress:
             print('svg_to_webm: Archived vtu and pvd files')
 
     # Tidy up: compress any other results files, if they exist
     res_files = []
     for res_file in os.listdir(sim_dir):
-        if not (res_file.endswith('.webm') or res_file.endswith('.tar.gz') or res_file.startswith('.')):
+        if not (res_file.endswith('.webm') or res_file in movie_names or is_archive(res_file) or
+                res_file == frame_archive.FRAME_ARCHIVE or res_file.startswith('.')):
             res_files.append(res_file)
 
     if len(res_files) > 0:
-        subprocess.call(['tar', '-zcf', 'res_arch.tar.gz', '--remove-files'] + res_files, cwd=sim_dir)
+        archiver.archive_files(sim_dir, res_files, 'res_arch')
         if print_progress:
             print('svg_to_webm: Archived other results files')
 
-    # Reset terminal
-    os.system('stty sane')
-
 
 def list_files_of_type(path_name, extension):
     """ Return a sorted list of files in a directory, with a specific extension
@@ -182,60 +432,464 @@ def list_files_of_type(path_name, extension):
 def calculate_image_info(svg_file_path, aspect_ratio):
     """ Interrogate svg file, extract dimensions, calculate values necessary for export to png
 
-    :param svg_file_path: location of the svg file to process
+    :param svg_file_path: location of the svg file to process, which may be in the frame archive rather than on disk
     :param aspect_ratio: the required aspect ratio for exported png images
     :return: a dict containing calculated values for the image sizes
 
     Exceptions:
-    :raise if anything other than 1 regex match is found on the first line of the svg file
-    :raise if anything other than 2 dimension floats are extracted from the regex match
+    :raise if the svg dimensions cannot be determined from the root element of the svg file
     """
-    # First get the dimensions of the svg file. We use a regex pattern to look for the height and width attributes
-    regex_pattern = 'width="(\d*\.?\d*)px" height="(\d*\.?\d*)px".*?'
-    dimension_strings = re.findall(regex_pattern, open(svg_file_path).readline())
+    dimensions = svg_metadata.frame_dimensions(os.path.dirname(svg_file_path), [os.path.basename(svg_file_path)])[0]
+    return image_info(dimensions=dimensions, output_dimensions=dimensions, aspect_ratio=aspect_ratio)
 
-    if len(dimension_strings) != 1:
-        raise Exception('svg_to_webm: Did not successfully extract svg dimensions from ' + svg_file_path)
 
-    # Convert the dimension string to two floats, and validate
-    dimensions = [float(s) for s in dimension_strings[0]]
-    if len(dimensions) != 2:
-        raise Exception('svg_to_webm: Did not successfully extract svg dimensions from ' + svg_file_path)
+def calculate_frame_infos(sim_dir, svg_files, aspect_ratio):
+    """ Calculate the values necessary for export to png of every svg file.  Each frame is cropped to its own area,
+    and exported at the png size of the first frame, so that frames of differing sizes still make a movie of one size.
 
+    :param sim_dir: the directory containing the svg files or frame archive
+    :param svg_files: list of names of the svg files
+    :param aspect_ratio: the required aspect ratio for exported png images
+    :return: a list of dicts as from calculate_image_info(), one per svg file
+
+    Exceptions:
+    :raise if the dimensions of any svg file cannot be determined
+    """
+    dimensions = svg_metadata.frame_dimensions(sim_dir, svg_files)
+    return [image_info(dimensions=frame_dimensions, output_dimensions=dimensions[0], aspect_ratio=aspect_ratio)
+            for frame_dimensions in dimensions]
+
+
+def image_info(dimensions, output_dimensions, aspect_ratio):
+    """ Calculate values necessary for export to png from svg dimensions
+
+    :param dimensions: dict of the svg 'width' and 'height', as from svg_metadata.parse_svg_header()
+    :param output_dimensions: dict of the 'width' and 'height' of the svg whose crop area sets the png size
+    :param aspect_ratio: the required aspect ratio for exported png images
+    :return: a dict containing calculated values for the image sizes
+    """
     # Generate the file info dict
-    file_info = {'svg_width': dimensions[0],
-                 'svg_height': dimensions[1],
-                 'png_width': int(dimensions[0]),
-                 'png_height': int(dimensions[0] / aspect_ratio),
-                 'png_y_offset': int(0.5 * (dimensions[1] - dimensions[1] / aspect_ratio))}
+    file_info = {'svg_width': dimensions['width'],
+                 'svg_height': dimensions['height'],
+                 'png_width': int(output_dimensions['width']),
+                 'png_height': int(output_dimensions['width'] / aspect_ratio),
+                 'png_y_offset': int(0.5 * (dimensions['height'] - dimensions['height'] / aspect_ratio))}
 
     # Add the crop_string in a format to be passed to inkscape
     file_info['crop_string'] = '{0}:{1}:{2}:{3}'.format(str(0),
                                                         str(file_info['png_y_offset']),
-                                                        str(file_info['png_width']),
-                                                        str(file_info['png_y_offset'] + file_info['png_height']))
+                                                        str(int(dimensions['width'])),
+                                                        str(file_info['png_y_offset'] +
+                                                            int(dimensions['width'] / aspect_ratio)))
 
     return file_info
 
 
+def convert_svg_files(path_to_files, svg_files, file_infos, num_workers=None, print_progress=False,
+                      renderer='inkscape', frame_cache=None):
+    """ Convert a sequence of svg files to png using a pool of inkscape processes.
+
+    The png for svg_files[i] is always named %04d.png with index i, regardless of the order in which conversions finish.
+
+    :param path_to_files: the directory containing the svg files
+    :param svg_files: sorted list of names of the svg files to convert
+    :param file_infos: list of dicts generated by calculate_frame_infos() containing the crop-string of each svg file
+    :param num_workers: number of concurrent conversions (default None, meaning one per core)
+    :param print_progress: whether to print running trace of this function (default False)
+    :param renderer: one of RENDERERS (default 'inkscape')
+    :param frame_cache: a frame_cache.FrameCache to take unchanged frames from and add new frames to (default None)
+    :return: tuple of (a list, ordered by frame index, describing each svg file that failed to convert, and a list of
+             the time in seconds taken to convert each frame, or None for a frame taken from frame_cache)
+    """
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+
+    tasks = [(path_to_files, svg_file, file_infos[idx], idx) for idx, svg_file in enumerate(svg_files)]
+
+    failures = []
+    frame_times = [None] * len(tasks)
+    progress = {'num_done': 0}
+    progress_lock = threading.Lock()
+
+    # Only rasterise frames that are not already cached
+    cache_keys = calculate_cache_keys(path_to_files, svg_files, file_infos, renderer, frame_cache)
+    if frame_cache is not None:
+        tasks = [task for task in tasks
+                 if not frame_cache.copy_to(cache_keys[task[3]], os.path.join(path_to_files, str(task[3]).zfill(4) +
+                                                                              '.png'))]
+        progress['num_done'] = len(svg_files) - len(tasks)
+        if print_progress:
+            print('\t' + str(progress['num_done']) + ' of ' + str(len(svg_files)) + ' frames taken from cache')
+
+    recorded = set()
+
+    def record_result(idx, return_code, seconds):
+        png_name = str(idx).zfill(4) + '.png'
+        frame_times[idx] = seconds
+        with progress_lock:
+            recorded.add(idx)
+            if return_code != 0 or not os.path.isfile(os.path.join(path_to_files, png_name)):
+                failures.append((idx, svg_files[idx] + ' -> ' + png_name +
+                                 ' (' + renderer + ' returned ' + str(return_code) + ')'))
+            elif frame_cache is not None:
+                frame_cache.add_file(cache_keys[idx], os.path.join(path_to_files, png_name))
+            progress['num_done'] += 1
+            if print_progress:
+                print('\t' + str(progress['num_done']) + ' of ' + str(len(svg_files)) + ' (%.3fs)' % seconds)
+
+    if renderer == 'inkscape-shell':
+        convert_svg_files_with_shells(tasks=tasks, num_shells=num_workers, record_result=record_result)
+
+    # No need for the overhead of a pool if only one process is requested
+    elif num_workers == 1:
+        for task in tasks:
+            record_result(*svg_to_png_task(task))
+    else:
+        pool = multiprocessing.Pool(processes=num_workers)
+        try:
+            for result in pool.imap_unordered(svg_to_png_task, tasks):
+                record_result(*result)
+        finally:
+            pool.close()
+            pool.join()
+
+    # A frame with no result, e.g. from a worker thread that died, has no png, and a gap in the png sequence would
+    # truncate the movie
+    for task in tasks:
+        if task[3] not in recorded:
+            failures.append((task[3], svg_files[task[3]] + ' -> ' + str(task[3]).zfill(4) + '.png (no result from ' +
+                             renderer + ')'))
+
+    return [description for _, description in sorted(failures)], frame_times
+
+
+def calculate_cache_keys(path_to_files, svg_files, file_infos, renderer, frame_cache):
+    """ Calculate the frame cache key of each svg file
+
+    :param path_to_files: the directory containing the svg files
+    :param svg_files: list of names of the svg files
+    :param file_infos: list of dicts generated by calculate_frame_infos() containing the crop-string and png size
+    :param renderer: one of RENDERERS
+    :param frame_cache: a frame_cache.FrameCache, or None
+    :return: a list of keys, one per svg file, or a list of None if frame_cache is None
+    """
+    if frame_cache is None:
+        return [None] * len(svg_files)
+
+    return [frame_cache.key(svg_bytes=frame_archive.read_frame(path_to_files, svg_file),
+                            crop_string=file_info['crop_string'],
+                            output_size=(file_info['png_width'], file_info['png_height']), renderer=renderer)
+            for svg_file, file_info in zip(svg_files, file_infos)]
+
+
+def convert_svg_files_with_shells(tasks, num_shells, record_result):
+    """ Convert svg files to png by streaming export commands to long-lived inkscape shells.
+
+    Each shell is driven by its own thread, which takes tasks from a shared queue until none remain, so a slow frame
+    in one shell does not hold up the others.
+
+    :param tasks: list of (path_to_files, file_name, file_info, index) tuples, as passed to svg_to_png()
+    :param num_shells: number of inkscape shells to run concurrently
+    :param record_result: function called with (index, return code, seconds) as each frame completes
+    """
+    task_queue = queue.Queue()
+    for task in tasks:
+        task_queue.put(task)
+
+    def drive_shell():
+        shell = None
+        try:
+            while True:
+                try:
+                    path_to_files, file_name, file_info, index = task_queue.get_nowait()
+                except queue.Empty:
+                    return
+                start = time.time()
+                svg_path, is_scratch = None, False
+                return_code = 1
+                try:
+                    svg_path, is_scratch = frame_archive.frame_path(path_to_files, file_name, SCRATCH_DIR)
+                    if shell is None:
+                        shell = InkscapeShell(cwd=path_to_files)
+                    shell.export_png(file_name=svg_path, png_name=str(index).zfill(4) + '.png',
+                                     crop_string=file_info['crop_string'],
+                                     png_size=(file_info['png_width'], file_info['png_height']))
+                    return_code = 0
+                except Exception:
+                    # The frame could not be read, or the shell has died: report this frame as failed, and start a
+                    # fresh shell for the next one
+                    if shell is not None:
+                        shell.close()
+                    shell = None
+                finally:
+                    try:
+                        if is_scratch:
+                            os.remove(svg_path)
+                    finally:
+                        record_result(index, return_code, time.time() - start)
+        finally:
+            if shell is not None:
+                shell.close()
+
+    threads = [threading.Thread(target=drive_shell) for _ in range(min(num_shells, len(tasks)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+class InkscapeShell(object):
+    """ A long-lived inkscape process in shell mode, avoiding inkscape's start-up cost for each frame exported.
+
+    Inkscape reads one set of command line arguments per line on stdin, and prints a '>' prompt at the start of a line
+    when it is ready for the next.
+    """
+
+    def __init__(self, cwd):
+        """
+        :param cwd: the directory relative to which file names are given
+        :raise Exception: if inkscape does not reach its prompt
+        """
+        self.process = subprocess.Popen(['inkscape', '--shell'], cwd=cwd, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+        self.wait_for_prompt()
+
+    def wait_for_prompt(self):
+        """ Read inkscape output until the prompt is reached
+
+        :raise Exception: if inkscape exits before reaching the prompt
+        """
+        previous = b'\n'
+        while True:
+            char = self.process.stdout.read(1)
+            if char == b'':
+                raise Exception('svg_to_webm: inkscape shell exited unexpectedly')
+            if char == b'>' and previous == b'\n':
+                return
+            previous = char
+
+    def export_png(self, file_name, png_name, crop_string, png_size=None):
+        """ Export an svg file to png, cropped to crop_string, and wait for inkscape to finish
+
+        :param file_name: name of the svg file to convert
+        :param png_name: name of the png file to write
+        :param crop_string: export area in the format x0:y0:x1:y1
+        :param png_size: (width, height) of the png in pixels (default None, meaning the size of the export area)
+        :raise Exception: if inkscape exits before finishing the export
+        """
+        command = [quote(file_name), '--export-png=' + quote(png_name), '--export-area=' + crop_string]
+        if png_size is not None:
+            command += ['--export-width=' + str(png_size[0]), '--export-height=' + str(png_size[1])]
+        command = ' '.join(command)
+        self.process.stdin.write((command + '\n').encode())
+        self.process.stdin.flush()
+        self.wait_for_prompt()
+
+    def close(self):
+        """ Ask inkscape to quit, killing it if it does not """
+        try:
+            self.process.stdin.write(b'quit\n')
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        for _ in range(50):
+            if self.process.poll() is not None:
+                return
+            time.sleep(0.1)
+        self.process.kill()
+        self.process.wait()
+
+
+def iterate_png_frames(path_to_files, svg_files, file_infos, num_workers, renderer, max_in_flight,
+                       print_progress=False, frame_cache=None):
+    """ Rasterise a sequence of svg files concurrently, yielding the png contents of each in order.
+
+    Each frame is exported to a scratch file in memory-backed storage where available (/dev/shm), read back and
+    deleted immediately, so no png sequence accumulates in path_to_files.
+
+    :param path_to_files: the directory containing the svg files
+    :param svg_files: sorted list of names of the svg files to convert
+    :param file_infos: list of dicts generated by calculate_frame_infos() containing the crop-string of each svg file
+    :param num_workers: number of concurrent conversions
+    :param renderer: one of RENDERERS
+    :param max_in_flight: maximum number of frames rasterised but not yet consumed
+    :param print_progress: whether to print running trace of this function (default False)
+    :param frame_cache: a frame_cache.FrameCache to take unchanged frames from and add new frames to (default None)
+    :return: a generator of png file contents as bytes, one per svg file, in order
+
+    :raise Exception: if any svg file fails to convert, after which no further frames are yielded
+    """
+    scratch_dir = tempfile.mkdtemp(prefix='svg_to_webm_', dir=SCRATCH_DIR)
+    tasks = [(path_to_files, svg_file, file_infos[idx], scratch_dir, idx) for idx, svg_file in enumerate(svg_files)]
+
+    # Only rasterise frames that are not already cached
+    cache_keys = calculate_cache_keys(path_to_files, svg_files, file_infos, renderer, frame_cache)
+    all_tasks = tasks
+    if frame_cache is not None:
+        tasks = [task for task in tasks if not frame_cache.contains(cache_keys[task[4]])]
+        if print_progress:
+            print('\t' + str(len(svg_files) - len(tasks)) + ' of ' + str(len(svg_files)) + ' frames cached')
+
+    shells = []
+    if renderer == 'inkscape-shell':
+        # Each thread of the pool lazily starts, and then reuses, its own inkscape shell
+        thread_data = threading.local()
+
+        def render_with_shell(task):
+            task_path, file_name, task_info, task_dir, index = task
+            png_path = os.path.join(task_dir, str(index).zfill(4) + '.png')
+            svg_path, is_scratch = frame_archive.frame_path(task_path, file_name, task_dir)
+            try:
+                if getattr(thread_data, 'shell', None) is None:
+                    thread_data.shell = InkscapeShell(cwd=task_path)
+                    shells.append(thread_data.shell)
+                thread_data.shell.export_png(file_name=svg_path, png_name=png_path,
+                                             crop_string=task_info['crop_string'],
+                                             png_size=(task_info['png_width'], task_info['png_height']))
+                return_code = 0
+            except Exception:
+                thread_data.shell = None
+                return_code = 1
+            finally:
+                if is_scratch:
+                    os.remove(svg_path)
+            return read_and_remove_png(index=index, png_path=png_path, return_code=return_code)
+
+        pool = multiprocessing.pool.ThreadPool(processes=num_workers)
+        function = render_with_shell
+    else:
+        pool = multiprocessing.Pool(processes=num_workers)
+        function = svg_to_png_bytes_task
+
+    try:
+        rendered = frame_pipe.imap_bounded(pool, function, tasks, max_in_flight)
+        uncached_indices = set(task[4] for task in tasks)
+        for index in range(len(svg_files)):
+            if index in uncached_indices:
+                # Uncached frames are rendered in order, so the next rendered frame is this one
+                rendered_index, png_bytes, return_code = next(rendered)
+            else:
+                png_bytes = frame_cache.read(cache_keys[index])
+                if png_bytes is None:
+                    # Evicted by another process since the cache was checked: render it here instead
+                    rendered_index, png_bytes, return_code = function(all_tasks[index])
+                else:
+                    rendered_index = None
+            if rendered_index is not None:
+                if png_bytes is None:
+                    raise Exception('svg_to_webm: Failed to convert svg to png: ' + svg_files[rendered_index] +
+                                    ' (' + renderer + ' returned ' + str(return_code) + ')')
+                if frame_cache is not None:
+                    frame_cache.add_bytes(cache_keys[rendered_index], png_bytes)
+            if print_progress:
+                print('\t' + str(index + 1) + ' of ' + str(len(svg_files)))
+            yield png_bytes
+    finally:
+        pool.terminate()
+        pool.join()
+        for shell in shells:
+            shell.close()
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def svg_to_png_bytes_task(task):
+    """ Helper function to convert a single svg to png contents in a multiprocessing Pool
+
+    :param task: tuple of (path_to_files, file_name, file_info, scratch_dir, index)
+    :return: tuple of (index, png contents or None on failure, inkscape return code)
+    """
+    path_to_files, file_name, file_info, scratch_dir, index = task
+    png_path = os.path.join(scratch_dir, str(index).zfill(4) + '.png')
+    svg_path, is_scratch = frame_archive.frame_path(path_to_files, file_name, scratch_dir)
+    try:
+        return_code = subprocess.call(['inkscape', '-z',
+                                       '-e', png_path,
+                                       '-a', file_info['crop_string'],
+                                       '-w', str(file_info['png_width']),
+                                       '-h', str(file_info['png_height']),
+                                       svg_path], cwd=path_to_files,
+                                      stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+    finally:
+        if is_scratch:
+            os.remove(svg_path)
+    return read_and_remove_png(index=index, png_path=png_path, return_code=return_code)
+
+
+def read_and_remove_png(index, png_path, return_code):
+    """ Read the contents of a scratch png file and then delete it
+
+    :param index: the frame index of the png
+    :param png_path: path to the png file
+    :param return_code: the return code of the process that wrote the png
+    :return: tuple of (index, png contents or None if the png was not written, return_code)
+    """
+    if return_code != 0 or not os.path.isfile(png_path):
+        return index, None, return_code
+    with open(png_path, 'rb') as png_file:
+        png_bytes = png_file.read()
+    os.remove(png_path)
+    return index, png_bytes, return_code
+
+
+def svg_to_png_task(task):
+    """ Helper function to execute a single svg_to_png() in a multiprocessing Pool
+
+    :param task: tuple of (path_to_files, file_name, file_info, index), as passed to svg_to_png()
+    :return: tuple of (index, inkscape return code, seconds taken)
+    """
+    path_to_files, file_name, file_info, index = task
+    start = time.time()
+    return_code = svg_to_png(path_to_files=path_to_files, file_name=file_name, file_info=file_info, index=index)
+    return index, return_code, time.time() - start
+
+
+def summarise_frame_times(frame_times):
+    """ Summarise per-frame conversion times in a human-readable string.  Frames taken from the frame cache are counted
+    separately, so that they do not bring down the mean time of the frames converted.
+
+    :param frame_times: list of the time in seconds taken to convert each frame, or None for a cached frame
+    :return: a string with the total, mean and maximum time per frame converted, and the number of frames cached
+    """
+    converted_times = [seconds for seconds in frame_times if seconds is not None]
+    num_cached = len(frame_times) - len(converted_times)
+    cached = '' if num_cached == 0 else ', %d cached' % num_cached
+
+    if len(converted_times) == 0:
+        return 'no frames converted' + cached
+    return '%d converted, %.3fs mean, %.3fs max, %.3fs total' % (
+        len(converted_times), sum(converted_times) / len(converted_times), max(converted_times),
+        sum(converted_times)) + cached
+
+
 def svg_to_png(path_to_files, file_name, file_info, index):
     """ Convert an svg file to png using inkscape.
 
     :param path_to_files: the directory containing the svg file
-    :param file_name: name of the svg file to convert
+    :param file_name: name of the svg file to convert, which may be in the frame archive rather than on disk
     :param file_info: dict generated by calculate_image_info() containing the crop-string
     :param index: index to uniquely identify the output file in sequence
-    :return: nothing
+    :return: the return code of the inkscape process
     """
+    svg_path, is_scratch = frame_archive.frame_path(path_to_files, file_name, SCRATCH_DIR)
+
     # Parameters:
     #   inkscape -z        Run inkscape without X server (use from command line)
     #   -e <name>.png      Export to png. File name is the index parameter, zero-padded
     #   -a <crop_string>   Change the export area to the pre-calculated crop-string
+    #   -w, -h             Scale the export area to the png size, which is the same for every frame of a movie
     #   filename           Name of the svg file to process
-    subprocess.call(['inkscape', '-z',
-                     '-e', str(index).zfill(4) + '.png',
-                     '-a', file_info['crop_string'],
-                     file_name], cwd=path_to_files, stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+    try:
+        return subprocess.call(['inkscape', '-z',
+                                '-e', str(index).zfill(4) + '.png',
+                                '-a', file_info['crop_string'],
+                                '-w', str(file_info['png_width']),
+                                '-h', str(file_info['png_height']),
+                                svg_path], cwd=path_to_files,
+                               stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+    finally:
+        if is_scratch:
+            os.remove(svg_path)
+
 
 if __name__ == '__main__':
     quit('Call svg_to_webm.svg_to_webm()')
@@ -0,0 +1,113 @@
+import csv
+import io
+import os
+import random
+import shutil
+import tempfile
+
+import csv_to_latex
+
+HEADER = ['Timestamp', 'Name', 'Email', 'Dept', 'Amount requested', 'Summary', 'Why', 'Notes']
+
+ROWS = [['2020-01-01', 'Person 0', 'p0@example.com', 'D', '0.5', 'One line', 'Why', 'Notes'],
+        ['2020-01-02', 'Person 1', 'p1@example.com', 'D', '10', 'Line one\nline two, "quoted"', 'Why\r\nnot', ''],
+        ['2020-01-03', 'Pérson 2', 'p2@example.com', 'D', '20', 'é ü £ ' * 100, 'multi\n\nparagraph', 'x'],
+        ['2020-01-04', 'Person 3', 'p3@example.com', 'D', '30', '', '', '']]
+
+
+def write_csv(csv_filename, rows):
+    with io.open(csv_filename, 'w', encoding='utf-8', newline='') as csv_file:
+        csv.writer(csv_file).writerows(rows)
+
+
+def test_index_csv():
+    """ Each row, including those with quoted line breaks and multi-byte characters, is read back from its offset """
+    csv_dir = tempfile.mkdtemp()
+    try:
+        csv_filename = os.path.join(csv_dir, 'responses.csv')
+        write_csv(csv_filename, [HEADER] + ROWS)
+
+        header, offsets = csv_to_latex.index_csv(csv_filename)
+        assert header == HEADER
+        assert len(offsets) == len(ROWS)
+
+        # Read the rows back out of order, as the shuffled order does
+        with open(csv_filename, 'rb') as csv_file:
+            for row_index in [3, 1, 2, 0, 1]:
+                assert csv_to_latex.read_row(csv_file, offsets[row_index]) == ROWS[row_index]
+
+        write_csv(csv_filename, [HEADER])
+        assert csv_to_latex.index_csv(csv_filename) == (HEADER, [])
+
+        write_csv(csv_filename, [])
+        try:
+            csv_to_latex.index_csv(csv_filename)
+        except Exception:
+            pass
+        else:
+            raise AssertionError('Expected an exception for a csv file with no header')
+    finally:
+        shutil.rmtree(csv_dir)
+
+
+def test_shuffled_order():
+    """ The order is that of shuffling the rows themselves after seeding the random module, as the script once did """
+    for num_rows in [0, 1, 2, 10, 257]:
+        rows = list(range(num_rows))
+        random.seed(csv_to_latex.SHUFFLE_SEED)
+        random.shuffle(rows)
+        assert csv_to_latex.shuffled_order(num_rows) == rows
+
+    assert csv_to_latex.shuffled_order(50, seed=1) == csv_to_latex.shuffled_order(50, seed=1)
+    assert csv_to_latex.shuffled_order(50, seed=1) != csv_to_latex.shuffled_order(50, seed=2)
+
+
+def test_iterate_responses():
+    csv_dir = tempfile.mkdtemp()
+    try:
+        csv_filename = os.path.join(csv_dir, 'responses.csv')
+        write_csv(csv_filename, [HEADER] + ROWS)
+
+        responses = list(csv_to_latex.iterate_responses(csv_filename, seed=3))
+        assert [header for header, _ in responses] == [HEADER] * len(ROWS)
+        assert [row for _, row in responses] == [ROWS[i] for i in csv_to_latex.shuffled_order(len(ROWS), seed=3)]
+    finally:
+        shutil.rmtree(csv_dir)
+
+
+def test_fragments():
+    """ A fragment's latex, and so its cache key, depends only on its row, not on its number or how many rows there are,
+    so that new responses leave every cached fragment in use """
+    fragments = [csv_to_latex.format_fragment(HEADER, row, anonymous) for row in ROWS for anonymous in [True, False]]
+    assert len(set(csv_to_latex.fragment_key(fragment) for fragment in fragments)) == len(fragments)
+    assert csv_to_latex.format_fragment(HEADER, ROWS[1], True) == fragments[2]
+    assert all('\\section*{\\numberslot:' in fragment for fragment in fragments)
+
+    log_dir = tempfile.mkdtemp()
+    try:
+        log_path = os.path.join(log_dir, 'responses.log')
+        with open(log_path, 'w') as log_file:
+            log_file.write('This is pdfTeX\nnumber position: 4736286,49003493\n')
+        assert csv_to_latex.read_number_position(log_path) == [4736286, 49003493]
+
+        with open(log_path, 'w') as log_file:
+            log_file.write('This is pdfTeX\n')
+        try:
+            csv_to_latex.read_number_position(log_path)
+        except Exception:
+            pass
+        else:
+            raise AssertionError('Expected an exception for a log with no number position')
+    finally:
+        shutil.rmtree(log_dir)
+
+    assert csv_to_latex.number_command(100, [4736286, 49003493]).startswith('\\setlength{\\unitlength}{1sp}'
+                                                                           '\\put(4736286,49003493)')
+
+
+if __name__ == '__main__':
+    test_index_csv()
+    test_shuffled_order()
+    test_iterate_responses()
+    test_fragments()
+    print('test_csv_to_latex: All tests passed')
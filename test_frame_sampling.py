@@ -0,0 +1,51 @@
+import frame_sampling
+
+
+def test_num_frames_needed():
+    assert frame_sampling.num_frames_needed(duration=12.0, max_fps=30.0) == 360
+    assert frame_sampling.num_frames_needed(duration=1.0, max_fps=2.5) == 2
+    assert frame_sampling.num_frames_needed(duration=0.1, max_fps=1.0) == 1
+
+
+def test_sample_even():
+    """ Evenly spaced frames are kept, in order, with the first and last, and short sequences are kept whole """
+    frame_names = ['%04d.png' % i for i in range(101)]
+
+    assert frame_sampling.sample_frames(frame_names, duration=10.0, max_fps=None) == frame_names
+    assert frame_sampling.sample_frames(frame_names, duration=10.0, max_fps=20.0) == frame_names
+
+    sampled = frame_sampling.sample_frames(frame_names, duration=10.0, max_fps=1.1)
+    assert sampled == ['%04d.png' % i for i in range(0, 101, 10)], sampled
+
+    assert frame_sampling.sample_frames(frame_names, duration=0.5, max_fps=1.0) == ['0000.png']
+
+
+def test_sample_keyframe():
+    """ Each window keeps its frame whose size changes most, the earliest on a tie, with the first and last frames """
+    frame_names = ['%04d.png' % i for i in range(12)]
+    frame_sizes = [100, 100, 100, 100, 100, 400, 400, 400, 400, 350, 400, 400]
+
+    sampled = frame_sampling.sample_frames(frame_names, duration=4.0, max_fps=1.0, mode='keyframe',
+                                           frame_sizes=frame_sizes)
+    assert sampled == ['0000.png', '0005.png', '0006.png', '0011.png'], sampled
+
+    assert frame_sampling.keyframe_indices([10] * 9, 3) == [0, 3, 8]
+
+
+def test_sample_invalid():
+    frame_names = ['%04d.png' % i for i in range(10)]
+    for kwargs in [{'max_fps': 1.0, 'mode': 'random'}, {'max_fps': 0.0}, {'max_fps': 1.0, 'mode': 'keyframe'},
+                   {'max_fps': 1.0, 'mode': 'keyframe', 'frame_sizes': [1, 2]}]:
+        try:
+            frame_sampling.sample_frames(frame_names, duration=2.0, **kwargs)
+        except Exception:
+            continue
+        raise AssertionError('Expected an exception for ' + str(kwargs))
+
+
+if __name__ == '__main__':
+    test_num_frames_needed()
+    test_sample_even()
+    test_sample_keyframe()
+    test_sample_invalid()
+    print('test_frame_sampling: All tests passed')
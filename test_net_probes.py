@@ -0,0 +1,114 @@
+import asyncio
+import socket
+
+import net_probes
+
+
+def test_record():
+    """ A target goes down on its third consecutive failure, and comes back up on its next success """
+    target = net_probes.Target('tcp', '127.0.0.1', 80, failures_before_down=3)
+
+    transitions = [target.record(success, now) for now, success in
+                   enumerate([False, False, True, False, False, False, False, True, True, False])]
+
+    assert transitions == [None, None, None, None, None, 'down', None, 'up', None, None], transitions
+    assert not target.down
+    assert target.num_outages == 1
+    assert target.num_probes == 10
+    assert target.num_failed_probes == 7
+    assert target.last_outage == 2
+    assert target.total_downtime(10) == 2
+
+    # An outage still going on counts towards the total downtime
+    target.record(False, 10)
+    target.record(False, 11)
+    assert target.down and target.down_since == 11
+    assert target.total_downtime(15) == 6
+
+
+def test_parse_target():
+    target = net_probes.parse_target('tcp:[::1]:8080')
+    assert (target.kind, target.host, target.port, target.name) == ('tcp', '::1', 8080, 'tcp:::1:8080')
+
+    for spec in ['tcp:127.0.0.1', 'udp:127.0.0.1', 'dns:', 'tcp:127.0.0.1:http', 'dns:a..example.com',
+                 'icmp:' + 'a' * 64 + '.example.com']:
+        try:
+            net_probes.parse_target(spec)
+        except Exception:
+            continue
+        raise AssertionError('Expected an exception for ' + spec)
+
+
+def test_probe_invalid_host():
+    """ A host the resolver rejects fails the probe, rather than stopping every other target's probes """
+    for target in [net_probes.Target('dns', 'a..example.com'), net_probes.Target('tcp', 'a' * 64 + '.example.com', 80)]:
+        assert asyncio.run(net_probes.probe(target, timeout=1.0)) is False, target.name
+
+
+def listen(port=0):
+    """ A listening TCP socket on loopback """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', port))
+    listener.listen(16)
+    return listener
+
+
+def test_probe_targets():
+    """ Probe a loopback listener that is stopped and restarted, and a port that refuses connections """
+    interval = 0.125
+    duration = 2.5
+
+    listener = listen()
+    port = listener.getsockname()[1]
+
+    # A port that was free a moment ago refuses connections
+    refusing = listen()
+    refused_port = refusing.getsockname()[1]
+    refusing.close()
+
+    flapping = net_probes.Target('tcp', '127.0.0.1', port, failures_before_down=3)
+    refused = net_probes.Target('tcp', '127.0.0.1', refused_port, failures_before_down=3)
+    transitions = []
+    state = {'listener': listener}
+
+    # The listener is stopped after the flapping target's 5th probe and restarted after its 12th, so its probes 6 to
+    # 12 fail, whatever their timing
+    def on_result(target, success, transition):
+        if transition is not None:
+            transitions.append((target.name, target.num_probes, transition))
+        if target is flapping and target.num_probes == 5:
+            state['listener'].close()
+        elif target is flapping and target.num_probes == 12:
+            state['listener'] = listen(port)
+
+    try:
+        net_probes.run([flapping, refused], interval=interval, timeout=interval, duration=duration,
+                       on_result=on_result)
+    finally:
+        state['listener'].close()
+
+    # Each target is probed once a tick, for duration / interval ticks
+    num_ticks = int(duration / interval)
+    assert flapping.num_probes == num_ticks, flapping.num_probes
+    assert refused.num_probes == num_ticks, refused.num_probes
+
+    assert transitions == [(refused.name, 3, 'down'), (flapping.name, 8, 'down'), (flapping.name, 13, 'up')], \
+        transitions
+
+    assert not flapping.down
+    assert flapping.num_outages == 1
+    assert flapping.num_failed_probes == 7
+    assert 0 < flapping.last_outage < duration
+
+    assert refused.down
+    assert refused.num_outages == 1
+    assert refused.num_failed_probes == num_ticks
+
+
+if __name__ == '__main__':
+    test_record()
+    test_parse_target()
+    test_probe_invalid_host()
+    test_probe_targets()
+    print('test_net_probes: All tests passed')
@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+
+import pvd_index
+
+PVD_HEAD = '<?xml version="1.0"?>\n<VTKFile type="Collection" version="0.1">\n<Collection>\n'
+
+PVD_TAIL = '</Collection>\n</VTKFile>\n'
+
+
+def write_file(path, contents):
+    with open(path, 'w') as f:
+        f.write(contents)
+
+
+def data_set(time_step, file_name, part=0):
+    return '<DataSet timestep="%s" group="" part="%d" file="%s"/>\n' % (time_step, part, file_name)
+
+
+def test_find_results_directory():
+    """ The results directory with the latest start time is found, comparing start times as numbers """
+    sim_dir = tempfile.mkdtemp()
+    try:
+        assert pvd_index.find_results_directory(sim_dir) is None
+
+        for name in ['results_from_time_0', 'results_from_time_9', 'results_from_time_10', 'results_from_time_2.5']:
+            os.mkdir(os.path.join(sim_dir, name))
+
+        # Neither a file nor a directory of another name is a results directory
+        write_file(os.path.join(sim_dir, 'results_from_time_100'), '')
+        os.mkdir(os.path.join(sim_dir, 'results_from_time_20_old'))
+
+        assert pvd_index.find_results_directory(sim_dir) == os.path.join(sim_dir, 'results_from_time_10')
+    finally:
+        shutil.rmtree(sim_dir)
+
+
+def test_read_pvd():
+    """ Time steps are sorted numerically, with the vtu files of every part of a time step together """
+    pvd_dir = tempfile.mkdtemp()
+    try:
+        pvd_file = os.path.join(pvd_dir, 'results.pvd')
+        write_file(pvd_file, PVD_HEAD + data_set(10, 'results_10.vtu') + data_set(2, 'results_2.vtu') +
+                   data_set(2, 'nodes_2.vtu', part=1) + data_set('1e-1', 'results_0.1.vtu') + PVD_TAIL)
+
+        assert pvd_index.read_pvd(pvd_file) == [
+            (0.1, [os.path.join(pvd_dir, 'results_0.1.vtu')]),
+            (2.0, [os.path.join(pvd_dir, 'results_2.vtu'), os.path.join(pvd_dir, 'nodes_2.vtu')]),
+            (10.0, [os.path.join(pvd_dir, 'results_10.vtu')])]
+
+        write_file(pvd_file, PVD_HEAD + data_set('x', 'results_x.vtu') + PVD_TAIL)
+        try:
+            pvd_index.read_pvd(pvd_file)
+        except Exception:
+            pass
+        else:
+            raise AssertionError('Expected an exception for a non-numeric timestep')
+    finally:
+        shutil.rmtree(pvd_dir)
+
+
+def test_read_truncated_pvd():
+    """ A pvd file cut short is an error, unless allowed, when the time steps before the cut are returned """
+    pvd_dir = tempfile.mkdtemp()
+    try:
+        pvd_file = os.path.join(pvd_dir, 'results.pvd')
+        write_file(pvd_file, PVD_HEAD + data_set(0, 'results_0.vtu') + data_set(1, 'results_1.vtu') + '<DataSet time')
+
+        try:
+            pvd_index.read_pvd(pvd_file)
+        except Exception:
+            pass
+        else:
+            raise AssertionError('Expected an exception for a truncated pvd file')
+
+        assert pvd_index.read_pvd(pvd_file, allow_truncated=True) == [
+            (0.0, [os.path.join(pvd_dir, 'results_0.vtu')]), (1.0, [os.path.join(pvd_dir, 'results_1.vtu')])]
+    finally:
+        shutil.rmtree(pvd_dir)
+
+
+def test_check_vtu_files():
+    """ Missing vtu files, and those without a closing tag at their end, are reported """
+    vtu_dir = tempfile.mkdtemp()
+    try:
+        complete = os.path.join(vtu_dir, 'complete.vtu')
+        long_complete = os.path.join(vtu_dir, 'long_complete.vtu')
+        truncated = os.path.join(vtu_dir, 'truncated.vtu')
+        missing = os.path.join(vtu_dir, 'missing.vtu')
+
+        write_file(complete, '<VTKFile>\n</VTKFile>\n')
+        write_file(long_complete, '<VTKFile>\n' + 'x' * (10 * pvd_index.VTU_TAIL_BYTES) + '\n</VTKFile>\n')
+        write_file(truncated, '<VTKFile>\n' + 'x' * (10 * pvd_index.VTU_TAIL_BYTES))
+
+        assert pvd_index.check_vtu_files([(0.0, [complete, long_complete]), (1.0, [truncated]), (2.0, [missing])]) == \
+            [truncated + ' is truncated', missing + ' is missing']
+        assert pvd_index.check_vtu_files([(0.0, [complete])]) == []
+    finally:
+        shutil.rmtree(vtu_dir)
+
+
+def test_sample_time_steps():
+    """ Every time step is kept with no maximum frame rate, and evenly spaced ones, always with the last, with one """
+    time_steps = [(float(i), []) for i in range(100)]
+
+    assert pvd_index.sample_time_steps(time_steps, duration=10.0) == list(range(100))
+
+    sampled = pvd_index.sample_time_steps(time_steps, duration=10.0, max_fps=2.0)
+    assert len(sampled) == 20, sampled
+    assert sampled[0] == 0 and sampled[-1] == 99
+    assert sampled == sorted(set(sampled))
+
+
+if __name__ == '__main__':
+    test_find_results_directory()
+    test_read_pvd()
+    test_read_truncated_pvd()
+    test_check_vtu_files()
+    test_sample_time_steps()
+    print('test_pvd_index: All tests passed')
@@ -0,0 +1,30 @@
+import segment_encode
+
+
+def check_segments(segments, num_frames, gop_size):
+    """ Segments cover every frame once, in order, and all but the last are a whole number of GOPs long """
+    assert segments[0][0] == 0
+    for (start, length), (next_start, _) in zip(segments, segments[1:]):
+        assert next_start == start + length
+        assert length % gop_size == 0
+    assert segments[-1][0] + segments[-1][1] == num_frames
+
+
+def test_plan_segments():
+    assert segment_encode.plan_segments(1000, 4, gop_size=60) == [(0, 300), (300, 300), (600, 300), (900, 100)]
+    assert segment_encode.plan_segments(240, 4, gop_size=60) == [(0, 60), (60, 60), (120, 60), (180, 60)]
+
+    # A sequence too short for every segment to be a GOP long is split into fewer segments
+    assert segment_encode.plan_segments(100, 4, gop_size=60) == [(0, 60), (60, 40)]
+    assert segment_encode.plan_segments(30, 4, gop_size=60) == [(0, 30)]
+
+    for num_frames in [1, 59, 60, 61, 599, 12345]:
+        for num_segments in [1, 2, 3, 8]:
+            segments = segment_encode.plan_segments(num_frames, num_segments, gop_size=60)
+            assert len(segments) <= num_segments
+            check_segments(segments, num_frames, gop_size=60)
+
+
+if __name__ == '__main__':
+    test_plan_segments()
+    print('test_segment_encode: All tests passed')
@@ -0,0 +1,80 @@
+import io
+import os
+import shutil
+import tempfile
+
+import svg_metadata
+
+
+def parse(svg_text):
+    return svg_metadata.parse_svg_header(io.BytesIO(svg_text.encode('utf-8')))
+
+
+def test_parse_svg_header():
+    """ The root element's start tag may span several lines, and absolute lengths are converted to px """
+    header = parse('<?xml version="1.0" encoding="UTF-8"?>\n<!-- Created by Chaste -->\n<svg\n'
+                   '   xmlns="http://www.w3.org/2000/svg"\n   width="72pt"\n   height="25.4mm"\n'
+                   '   viewBox="0 0 96 96">\n<rect width="1" height="1"/>\n</svg>\n')
+    assert abs(header['width'] - 96.0) < 1e-9 and abs(header['height'] - 96.0) < 1e-9, header
+    assert header['view_box'] == [0.0, 0.0, 96.0, 96.0]
+
+    # A namespaced root element is an svg element
+    header = parse('<svg:svg xmlns:svg="http://www.w3.org/2000/svg" width="800" height="600px"/>')
+    assert (header['width'], header['height'], header['view_box']) == (800.0, 600.0, None)
+
+
+def test_parse_view_box_fallback():
+    """ A missing or relative width or height is that of the viewBox """
+    header = parse('<svg xmlns="http://www.w3.org/2000/svg" width="100%" viewBox="0,0,1600,900"></svg>')
+    assert (header['width'], header['height']) == (1600.0, 900.0)
+
+    for svg_text in ['<svg width="100%" height="100%"></svg>', '<svg width="10" viewBox="0 0 0 5"></svg>']:
+        try:
+            parse(svg_text)
+        except Exception:
+            continue
+        raise AssertionError('Expected an exception for ' + svg_text)
+
+
+def test_parse_header_only():
+    """ Only the start of a large svg is read, and anything malformed after the root element's start tag is ignored """
+    svg_file = io.BytesIO(b'<svg width="10" height="20">\n' + b'<g>' * 10 ** 6 + b'<unclosed')
+    assert parse('<svg width="10" height="20"><g></svg>')['height'] == 20.0
+    assert svg_metadata.parse_svg_header(svg_file)['width'] == 10.0
+    assert svg_file.tell() <= svg_metadata.HEADER_CHUNK_BYTES
+
+    for svg_text in ['<html width="10" height="10"></html>', '', '<svg width="10" height="10"']:
+        try:
+            parse(svg_text)
+        except Exception:
+            continue
+        raise AssertionError('Expected an exception for ' + repr(svg_text))
+
+
+def test_frame_dimensions():
+    """ Frames of different sizes are measured, and a frame changed since the sidecar was written is measured again """
+    sim_dir = tempfile.mkdtemp()
+    try:
+        for name, width in [('results_0.svg', 800), ('results_1.svg', 1000)]:
+            with open(os.path.join(sim_dir, name), 'w') as f:
+                f.write('<svg width="%d" height="600"></svg>' % width)
+
+        dimensions = svg_metadata.frame_dimensions(sim_dir, ['results_0.svg', 'results_1.svg'])
+        assert [frame['width'] for frame in dimensions] == [800.0, 1000.0]
+        assert set(svg_metadata.load_metadata(sim_dir)) == set(['results_0.svg', 'results_1.svg'])
+
+        with open(os.path.join(sim_dir, 'results_1.svg'), 'w') as f:
+            f.write('<svg width="1200" height="675"></svg>')
+
+        dimensions = svg_metadata.frame_dimensions(sim_dir, ['results_0.svg', 'results_1.svg'])
+        assert [(frame['width'], frame['height']) for frame in dimensions] == [(800.0, 600.0), (1200.0, 675.0)]
+    finally:
+        shutil.rmtree(sim_dir)
+
+
+if __name__ == '__main__':
+    test_parse_svg_header()
+    test_parse_view_box_fallback()
+    test_parse_header_only()
+    test_frame_dimensions()
+    print('test_svg_metadata: All tests passed')
@@ -0,0 +1,155 @@
+import base64
+import os
+import shutil
+import tempfile
+import zlib
+
+import numpy as np
+
+import vtu_render
+
+# A square of two triangles, with a point and a cell data array
+POINTS = np.array([[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [1.0, 1.0, 0.0], [0.0, 1.0, 0.0]])
+ARRAYS = [('PointData', 'region', np.array([0, 1, 2, 8], dtype='<i4'), 1),
+          ('CellData', 'cell_region', np.array([-1, 2], dtype='<i4'), 1),
+          ('Points', 'Points', POINTS.astype('<f8'), 3),
+          ('Cells', 'connectivity', np.array([0, 1, 2, 0, 2, 3], dtype='<i8'), 1),
+          ('Cells', 'offsets', np.array([3, 6], dtype='<i8'), 1),
+          ('Cells', 'types', np.array([5, 5], dtype='u1'), 1)]
+
+VTK_NAMES = {'<i4': 'Int32', '<i8': 'Int64', '<f8': 'Float64', '|u1': 'UInt8'}
+
+# Uncompressed bytes per zlib block, small so that every compressed array has several blocks
+BLOCK_BYTES = 8
+
+
+def binary_block(values, header_type, compressed):
+    """ The header and data of a binary DataArray, as vtk writes them, returned separately """
+    data = values.tobytes()
+    if not compressed:
+        return np.array([len(data)], dtype=header_type).tobytes(), data
+
+    blocks = [data[i:i + BLOCK_BYTES] for i in range(0, len(data), BLOCK_BYTES)]
+    compressed_blocks = [zlib.compress(block) for block in blocks]
+    header = [len(blocks), BLOCK_BYTES, len(blocks[-1])] + [len(block) for block in compressed_blocks]
+    return np.array(header, dtype=header_type).tobytes(), b''.join(compressed_blocks)
+
+
+def base64_block(values, header_type, compressed):
+    """ A base64 DataArray: vtk encodes the header and data of uncompressed data together, of compressed separately """
+    header, data = binary_block(values, header_type, compressed)
+    if not compressed:
+        return base64.b64encode(header + data)
+    return base64.b64encode(header) + base64.b64encode(data)
+
+
+def write_vtu(vtu_path, data_format, header_type='<u4', compressed=False, appended_encoding='raw'):
+    """ Write the square in one of the formats of a vtu file: 'ascii', 'binary' (inline base64) or 'appended' """
+    attributes = 'type="UnstructuredGrid" version="1.0" byte_order="LittleEndian" header_type="%s"' % \
+                 ('UInt32' if header_type == '<u4' else 'UInt64')
+    if compressed:
+        attributes += ' compressor="vtkZLibDataCompressor"'
+
+    sections = {}
+    appended = b''
+    for section, name, values, num_components in ARRAYS:
+        element = '<DataArray type="%s" Name="%s" NumberOfComponents="%d" format="%s"' % \
+                  (VTK_NAMES[values.dtype.str], name, num_components, data_format)
+        if data_format == 'ascii':
+            element += '>' + ' '.join(str(value) for value in values.flatten()) + '</DataArray>'
+        elif data_format == 'binary':
+            element += '>' + base64_block(values, header_type, compressed).decode('ascii') + '</DataArray>'
+        else:
+            element += ' offset="%d"/>' % len(appended)
+            if appended_encoding == 'raw':
+                appended += b''.join(binary_block(values, header_type, compressed))
+            else:
+                appended += base64_block(values, header_type, compressed)
+        sections.setdefault(section, []).append(element)
+
+    xml = '<?xml version="1.0"?>\n<VTKFile %s>\n<UnstructuredGrid>\n<Piece NumberOfPoints="4" NumberOfCells="2">\n' % \
+        attributes
+    for section in ['PointData', 'CellData', 'Points', 'Cells']:
+        xml += '<%s>\n%s\n</%s>\n' % (section, '\n'.join(sections[section]), section)
+    xml += '</Piece>\n</UnstructuredGrid>\n'
+
+    with open(vtu_path, 'wb') as vtu_file:
+        vtu_file.write(xml.encode('ascii'))
+        if data_format == 'appended':
+            vtu_file.write(('<AppendedData encoding="%s">\n   _' % appended_encoding).encode('ascii') + appended +
+                           b'\n</AppendedData>\n')
+        vtu_file.write(b'</VTKFile>\n')
+
+
+def check_mesh(mesh, description):
+    assert np.array_equal(mesh['points'], POINTS), description
+    assert mesh['points'].shape == (4, 3), description
+    assert list(mesh['connectivity']) == [0, 1, 2, 0, 2, 3], description
+    assert list(mesh['offsets']) == [3, 6], description
+    assert list(mesh['types']) == [5, 5], description
+    assert list(mesh['point_data']['region']) == [0, 1, 2, 8], description
+    assert list(mesh['cell_data']['cell_region']) == [-1, 2], description
+
+
+def test_read_vtu_encodings():
+    """ Every encoding of a vtu file, with 32 and 64 bit headers, decodes to the same points, cells and arrays """
+    vtu_dir = tempfile.mkdtemp()
+    try:
+        vtu_path = os.path.join(vtu_dir, 'results_0.vtu')
+
+        write_vtu(vtu_path, 'ascii')
+        check_mesh(vtu_render.read_vtu(vtu_path), 'ascii')
+
+        for header_type in ['<u4', '<u8']:
+            for compressed in [False, True]:
+                for data_format, appended_encoding in [('binary', None), ('appended', 'raw'), ('appended', 'base64')]:
+                    description = '%s %s, %s header%s' % (data_format, appended_encoding or 'inline', header_type,
+                                                          ', zlib' if compressed else '')
+                    write_vtu(vtu_path, data_format, header_type, compressed, appended_encoding)
+                    check_mesh(vtu_render.read_vtu(vtu_path), description)
+    finally:
+        shutil.rmtree(vtu_dir)
+
+
+def test_read_vtu_memmap():
+    """ Uncompressed raw appended arrays are memory-mapped, and only the data arrays asked for are decoded """
+    vtu_dir = tempfile.mkdtemp()
+    try:
+        vtu_path = os.path.join(vtu_dir, 'results_0.vtu')
+        write_vtu(vtu_path, 'appended', '<u8', compressed=False, appended_encoding='raw')
+
+        mesh = vtu_render.read_vtu(vtu_path, point_arrays=[], cell_arrays=['cell_region'])
+        assert isinstance(mesh['connectivity'], np.memmap)
+        assert mesh['point_data'] == {}
+        assert list(mesh['cell_data']) == ['cell_region']
+        del mesh
+    finally:
+        shutil.rmtree(vtu_dir)
+
+
+def test_read_invalid_vtu():
+    """ An unsupported compressor, and a file that is not a vtu file, are errors """
+    vtu_dir = tempfile.mkdtemp()
+    try:
+        vtu_path = os.path.join(vtu_dir, 'results_0.vtu')
+        write_vtu(vtu_path, 'binary', compressed=True)
+        with open(vtu_path, 'rb') as vtu_file:
+            contents = vtu_file.read().replace(b'vtkZLibDataCompressor', b'vtkLZ4DataCompressor')
+
+        for invalid_contents in [contents, b'<VTKFile><UnstructuredGrid>', b'not xml']:
+            with open(vtu_path, 'wb') as vtu_file:
+                vtu_file.write(invalid_contents)
+            try:
+                vtu_render.read_vtu(vtu_path)
+            except Exception:
+                continue
+            raise AssertionError('Expected an exception for ' + repr(invalid_contents[:40]))
+    finally:
+        shutil.rmtree(vtu_dir)
+
+
+if __name__ == '__main__':
+    test_read_vtu_encodings()
+    test_read_vtu_memmap()
+    test_read_invalid_vtu()
+    print('test_vtu_render: All tests passed')
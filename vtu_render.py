@@ -0,0 +1,369 @@
+import base64
+import io
+import math
+import xml.parsers.expat
+import zlib
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PolyCollection
+from matplotlib.figure import Figure
+from matplotlib.patches import Rectangle
+
+# numpy type codes of the vtk data types
+VTK_TYPES = {'Int8': 'i1', 'UInt8': 'u1', 'Int16': 'i2', 'UInt16': 'u2', 'Int32': 'i4', 'UInt32': 'u4',
+             'Int64': 'i8', 'UInt64': 'u8', 'Float32': 'f4', 'Float64': 'f8'}
+
+# Bytes read at a time while parsing the xml part of a vtu file
+VTU_CHUNK_BYTES = 64 * 1024
+
+# Colours of node regions 0 to 8, and of cell regions -1 to 2, as in immersed_boundary.set_up_scene()
+NODE_REGION_COLOURS = np.array([[1.0, 0.0, 0.0],   # LEFT_APICAL_REGION, red
+                                [1.0, 0.0, 0.0],   # RIGHT_APICAL_REGION, red
+                                [1.0, 0.0, 1.0],   # LEFT_PERIAPICAL_REGION, purple
+                                [1.0, 0.0, 1.0],   # RIGHT_PERIAPICAL_REGION, purple
+                                [0.0, 0.0, 1.0],   # LEFT_LATERAL_REGION, blue
+                                [0.0, 0.0, 1.0],   # RIGHT_LATERAL_REGION, blue
+                                [1.0, 1.0, 1.0],   # LEFT_BASAL_REGION, white
+                                [1.0, 1.0, 1.0],   # RIGHT_BASAL_REGION, white
+                                [1.0, 1.0, 1.0]])  # LAMINA_REGION, white
+CELL_REGION_COLOURS = np.array([[0.0, 0.0, 0.0],   # basal lamina, black
+                                [0.0, 0.0, 1.0],   # left region, blue
+                                [1.0, 1.0, 1.0],   # centre_region, white
+                                [1.0, 0.0, 0.0]])  # right_region, red
+
+
+def read_vtu(vtu_path, point_arrays=None, cell_arrays=None):
+    """ Read the points, cells and data arrays of a vtu file, without vtk.
+
+    Ascii, inline binary and appended (raw or base64) data are supported, compressed with zlib or not.  Uncompressed
+    raw appended arrays are memory-mapped rather than read.  Only the arrays asked for are decoded.
+
+    :param vtu_path: path to the vtu file
+    :param point_arrays: names of the point data arrays to read (default None, meaning all)
+    :param cell_arrays: names of the cell data arrays to read (default None, meaning all)
+    :return: a dict of 'points' (an n x 3 array), 'connectivity', 'offsets' and 'types' (as in the vtu file), and
+             'point_data' and 'cell_data' (dicts of arrays by name)
+
+    :raise Exception: if the vtu file is not valid, or uses an unsupported compressor or data type
+    """
+    header = read_vtu_header(vtu_path)
+
+    file_attributes = header['file']
+    byte_order = '<' if file_attributes.get('byte_order', 'LittleEndian') == 'LittleEndian' else '>'
+    header_dtype = np.dtype(VTK_TYPES[file_attributes.get('header_type', 'UInt32')]).newbyteorder(byte_order)
+
+    compressor = file_attributes.get('compressor')
+    if compressor not in [None, 'vtkZLibDataCompressor']:
+        raise Exception('vtu_render: Unsupported compressor in ' + vtu_path + ': ' + compressor)
+
+    mesh = {'point_data': {}, 'cell_data': {}}
+    with open(vtu_path, 'rb') as vtu_file:
+        for array in header['arrays']:
+            if array['section'] == 'Points':
+                key, wanted = 'points', True
+            elif array['section'] == 'Cells':
+                key, wanted = array.get('Name'), array.get('Name') in ['connectivity', 'offsets', 'types']
+            elif array['section'] == 'PointData':
+                key, wanted = array.get('Name'), point_arrays is None or array.get('Name') in point_arrays
+            elif array['section'] == 'CellData':
+                key, wanted = array.get('Name'), cell_arrays is None or array.get('Name') in cell_arrays
+            else:
+                wanted = False
+            if not wanted:
+                continue
+
+            values = decode_data_array(vtu_path, vtu_file, array, header, byte_order, header_dtype,
+                                       compressed=compressor is not None)
+            num_components = int(array.get('NumberOfComponents', 1))
+            if num_components > 1:
+                values = values.reshape(-1, num_components)
+
+            if array['section'] == 'PointData':
+                mesh['point_data'][key] = values
+            elif array['section'] == 'CellData':
+                mesh['cell_data'][key] = values
+            else:
+                mesh[key] = values
+
+    if 'points' not in mesh:
+        raise Exception('vtu_render: No points found in ' + vtu_path)
+
+    return mesh
+
+
+def read_vtu_header(vtu_path):
+    """ Parse the xml part of a vtu file as a stream, stopping at any appended data, so that arrays in the appended
+    data can be read or memory-mapped directly
+
+    :param vtu_path: path to the vtu file
+    :return: a dict of 'file' (the VTKFile attributes), 'arrays' (a list of dicts of each DataArray's attributes,
+             'section' (the parent element) and 'text'), 'data_start' (the file offset of the appended data, or None
+             if there is none) and 'appended_encoding' ('raw' or 'base64')
+
+    :raise Exception: if the vtu file is not valid xml before any appended data
+    """
+    state = {'file': {}, 'arrays': [], 'path': [], 'array': None, 'appended_index': None, 'appended_encoding': None}
+
+    def start_element(name, attributes):
+        if name == 'VTKFile':
+            state['file'] = dict(attributes)
+        elif name == 'DataArray':
+            array = dict(attributes)
+            array['section'] = state['path'][-1] if len(state['path']) > 0 else None
+            array['text'] = []
+            state['arrays'].append(array)
+            state['array'] = array
+        elif name == 'AppendedData' and state['appended_index'] is None:
+            state['appended_index'] = parser.CurrentByteIndex
+            state['appended_encoding'] = attributes.get('encoding', 'raw')
+        state['path'].append(name)
+
+    def end_element(name):
+        state['path'].pop()
+        if name == 'DataArray':
+            state['array']['text'] = ''.join(state['array']['text'])
+            state['array'] = None
+
+    def character_data(data):
+        # Values are the text of the DataArray itself, not of any InformationKey elements within it
+        if state['array'] is not None and state['path'][-1] == 'DataArray':
+            state['array']['text'].append(data)
+
+    parser = xml.parsers.expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+
+    data_start = None
+    with open(vtu_path, 'rb') as vtu_file:
+        while state['appended_index'] is None:
+            chunk = vtu_file.read(VTU_CHUNK_BYTES)
+            try:
+                parser.Parse(chunk, len(chunk) == 0)
+            except xml.parsers.expat.ExpatError as e:
+                # Raw appended data is not xml, but is of no concern to the parser
+                if state['appended_index'] is None:
+                    raise Exception('vtu_render: Invalid vtu file ' + vtu_path + ': ' + str(e))
+            if len(chunk) == 0:
+                break
+
+        if state['appended_index'] is not None:
+            # The appended data starts after the '_' that follows the AppendedData start tag
+            vtu_file.seek(state['appended_index'])
+            tag = vtu_file.read(1024)
+            underscore = tag.find(b'_', tag.find(b'>'))
+            if underscore < 0:
+                raise Exception('vtu_render: Invalid appended data in ' + vtu_path)
+            data_start = state['appended_index'] + underscore + 1
+
+    return {'file': state['file'], 'arrays': state['arrays'], 'data_start': data_start,
+            'appended_encoding': state['appended_encoding']}
+
+
+def decode_data_array(vtu_path, vtu_file, array, header, byte_order, header_dtype, compressed):
+    """ Decode a single DataArray of a vtu file
+
+    :param vtu_path: path to the vtu file
+    :param vtu_file: the vtu file, open in binary mode
+    :param array: the DataArray's dict, as from read_vtu_header()
+    :param header: the dict from read_vtu_header()
+    :param byte_order: '<' or '>'
+    :param header_dtype: numpy dtype of the block headers of binary data
+    :param compressed: whether binary data is compressed with zlib
+    :return: a flat numpy array of the values
+    """
+    if array.get('type') not in VTK_TYPES:
+        raise Exception('vtu_render: Unsupported data type in ' + vtu_path + ': ' + str(array.get('type')))
+    dtype = np.dtype(VTK_TYPES[array['type']]).newbyteorder(byte_order)
+
+    data_format = array.get('format', 'ascii')
+    if data_format == 'ascii':
+        return np.array(array['text'].split()).astype(dtype)
+
+    if data_format == 'binary':
+        data = read_base64_block(io.BytesIO(''.join(array['text'].split()).encode('ascii')), header_dtype, compressed)
+    elif data_format == 'appended':
+        if header['data_start'] is None:
+            raise Exception('vtu_render: Appended DataArray without AppendedData in ' + vtu_path)
+        vtu_file.seek(header['data_start'] + int(array.get('offset', 0)))
+        if header['appended_encoding'] == 'base64':
+            data = read_base64_block(vtu_file, header_dtype, compressed)
+        elif not compressed:
+            # Raw, uncompressed values can be used in place, without reading them
+            num_bytes = int(np.frombuffer(vtu_file.read(header_dtype.itemsize), header_dtype)[0])
+            return np.memmap(vtu_path, dtype=dtype, mode='r', offset=vtu_file.tell(),
+                             shape=(num_bytes // dtype.itemsize,))
+        else:
+            data = read_binary_block(vtu_file.read, header_dtype, compressed)
+    else:
+        raise Exception('vtu_render: Unsupported DataArray format in ' + vtu_path + ': ' + str(data_format))
+
+    return np.frombuffer(data, dtype)
+
+
+def read_base64_block(encoded_file, header_dtype, compressed):
+    """ Read the header and data of a base64 encoded DataArray.  vtk encodes the header and data of uncompressed data
+    together, but the header and data of compressed data separately.
+
+    :param encoded_file: a binary file object positioned at the start of the base64 text
+    :param header_dtype: numpy dtype of the header values
+    :param compressed: whether the data is split into zlib compressed blocks
+    :return: the data, decoded and uncompressed, as bytes
+    """
+    def decode(num_bytes):
+        return base64.b64decode(encoded_file.read(4 * int(math.ceil(num_bytes / 3.0))))[:num_bytes]
+
+    if compressed:
+        return read_binary_block(decode, header_dtype, compressed)
+
+    # Decode the start to find the size of the data, then decode the header and data as one
+    start = encoded_file.tell()
+    header_size = header_dtype.itemsize
+    num_bytes = int(np.frombuffer(decode(header_size), header_dtype)[0])
+    encoded_file.seek(start)
+    return decode(header_size + num_bytes)[header_size:]
+
+
+def read_binary_block(read, header_dtype, compressed):
+    """ Read the header and data of a binary DataArray
+
+    :param read: a function reading a given number of bytes
+    :param header_dtype: numpy dtype of the header values
+    :param compressed: whether the data is split into zlib compressed blocks
+    :return: the data, uncompressed, as bytes
+    """
+    header_size = header_dtype.itemsize
+    if not compressed:
+        num_bytes = int(np.frombuffer(read(header_size), header_dtype)[0])
+        return read(num_bytes)
+
+    # The header of compressed data is the number of blocks, the uncompressed size of each block and of the last, and
+    # the compressed size of each block
+    num_blocks = int(np.frombuffer(read(3 * header_size), header_dtype)[0])
+    if num_blocks == 0:
+        return b''
+    compressed_sizes = np.frombuffer(read(num_blocks * header_size), header_dtype).astype(np.int64)
+    compressed_data = read(int(compressed_sizes.sum()))
+
+    starts = np.concatenate([[0], np.cumsum(compressed_sizes)])
+    return b''.join(zlib.decompress(compressed_data[starts[i]:starts[i + 1]]) for i in range(num_blocks))
+
+
+class VtuRenderer(object):
+    """ Draws immersed boundary vtu output as immersed_boundary.pvd_to_mp4() does with ParaView, using matplotlib's
+    Agg backend and no ParaView.
+
+    The figure and the black unit square are drawn once and saved; each frame restores the saved background and draws
+    only the artists holding the data, which are reused from frame to frame.
+    """
+
+    def __init__(self, representation='Surface', num_regions=0, frame_size=(1600, 900), dpi=100):
+        """
+        :param representation: 'Surface' or 'Points' (default 'Surface')
+        :param num_regions: 0, or 9 to colour by node and cell region (default 0)
+        :param frame_size: (width, height) of each frame in pixels (default (1600, 900))
+        :param dpi: resolution of the figure, which sets the size of markers in pixels (default 100)
+        :raise Exception: if representation or num_regions is invalid
+        """
+        if representation not in ['Surface', 'Points']:
+            raise Exception('vtu_render: Representation must be either Surface or Points')
+
+        if num_regions not in [0, 9]:
+            raise Exception('vtu_render: Currently there is only support for 9 node regions')
+
+        self.representation = representation
+        self.num_regions = num_regions
+        self.frame_size = tuple(frame_size)
+
+        self.figure = Figure(figsize=(frame_size[0] / float(dpi), frame_size[1] / float(dpi)), dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.figure.patch.set_facecolor((0.5, 0.5, 0.5))
+
+        # The view and the black box are both the unit square, 9/16 high, as in immersed_boundary.set_up_scene()
+        self.axes = self.figure.add_axes([0.0, 0.0, 1.0, 1.0])
+        self.axes.set_xlim(0.0, 1.0)
+        self.axes.set_ylim(0.5 - 0.5 * 9.0 / 16.0, 0.5 + 0.5 * 9.0 / 16.0)
+        self.axes.set_axis_off()
+        self.axes.add_patch(Rectangle((0.0, 0.5 - 0.5 * 9.0 / 16.0), 1.0, 9.0 / 16.0, facecolor=(0.0, 0.0, 0.0),
+                                      edgecolor='none'))
+
+        # Sizes of glyphs, in points, given their size in the scene
+        points_per_unit = frame_size[0] * 72.0 / dpi
+
+        # Artists holding the data, excluded from the saved background and drawn on each frame
+        self.cells = PolyCollection([], facecolors=[(1.0, 1.0, 1.0)], edgecolors='none', animated=True)
+        self.axes.add_collection(self.cells)
+        self.points = self.axes.scatter([], [], s=4.0, c=[(1.0, 1.0, 1.0)], marker='o', linewidths=0,
+                                        animated=True)
+        self.cell_glyphs = self.axes.scatter([], [], s=(0.02 * points_per_unit) ** 2, marker='d', linewidths=0,
+                                             alpha=0.5, animated=True)
+        self.node_glyphs = self.axes.scatter([], [], s=(0.002 * points_per_unit) ** 2, marker='o', linewidths=0,
+                                             animated=True)
+
+        self.canvas.draw()
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+
+    def render(self, meshes):
+        """ Draw a frame
+
+        :param meshes: list of dicts, as from read_vtu(), to draw together
+        :return: the frame as raw rgb24 bytes, row by row from the top
+        """
+        self.canvas.restore_region(self.background)
+
+        for mesh in meshes:
+            points = mesh['points'][:, :2]
+
+            if self.representation == 'Surface':
+                # Each cell is a polygon, whose vertices are a slice of the connectivity
+                self.cells.set_verts(np.split(points[mesh['connectivity']], mesh['offsets'][:-1]))
+                self.axes.draw_artist(self.cells)
+                continue
+
+            if self.num_regions == 9:
+                node_colours = NODE_REGION_COLOURS[mesh['point_data']['Node Regions'].astype(int)]
+            else:
+                node_colours = np.ones((len(points), 3))
+            self.points.set_offsets(points)
+            self.points.set_facecolors(node_colours)
+            self.axes.draw_artist(self.points)
+
+            if self.num_regions == 9:
+                # Glyphs sit on every point, coloured by the region of the (last) cell each point belongs to
+                cell_sizes = np.diff(np.concatenate([[0], mesh['offsets']]))
+                point_cell_regions = np.full(len(points), -1, dtype=int)
+                point_cell_regions[mesh['connectivity']] = np.repeat(
+                    mesh['cell_data']['Cell Regions'].astype(int), cell_sizes)
+
+                self.cell_glyphs.set_offsets(points)
+                self.cell_glyphs.set_facecolors(CELL_REGION_COLOURS[point_cell_regions + 1])
+                self.axes.draw_artist(self.cell_glyphs)
+
+                self.node_glyphs.set_offsets(points)
+                self.node_glyphs.set_facecolors(node_colours)
+                self.axes.draw_artist(self.node_glyphs)
+
+        return np.asarray(self.canvas.buffer_rgba())[:, :, :3].tobytes()
+
+
+def render_frames(time_steps, representation='Surface', num_regions=0, frame_size=(1600, 900)):
+    """ Render a sequence of time steps, reading each time step's vtu files only when it is rendered
+
+    :param time_steps: a list of (time step, list of vtu paths) tuples, as from pvd_index.read_pvd()
+    :param representation: 'Surface' or 'Points' (default 'Surface')
+    :param num_regions: 0, or 9 to colour by node and cell region (default 0)
+    :param frame_size: (width, height) of each frame in pixels (default (1600, 900))
+    :return: a generator of raw rgb24 frames as bytes, one per time step, for frame_pipe.stream_frames_to_ffmpeg()
+    """
+    renderer = VtuRenderer(representation=representation, num_regions=num_regions, frame_size=frame_size)
+    point_arrays = ['Node Regions'] if num_regions == 9 else []
+    cell_arrays = ['Cell Regions'] if num_regions == 9 else []
+
+    for _, vtu_paths in time_steps:
+        yield renderer.render([read_vtu(vtu_path, point_arrays=point_arrays, cell_arrays=cell_arrays)
+                               for vtu_path in vtu_paths])
+
+
+if __name__ == '__main__':
+    quit('Call immersed_boundary.pvd_to_mp4_matplotlib(), or vtu_render.render_frames()')